@@ -8,8 +8,10 @@ usage: teuthology-queue -h
        teuthology-queue [-d|-f] -m MACHINE_TYPE
        teuthology-queue [-r] -m MACHINE_TYPE
        teuthology-queue -m MACHINE_TYPE -D PATTERN
+       teuthology-queue -w [--since HOURS]
 
-List Jobs in queue.
+List Jobs in queue, newest first. Jobs are only peeked at, so workers can
+keep running them while the queue is listed.
 If -D is passed, then jobs with PATTERN in the job name are deleted from the
 queue.
 
@@ -23,6 +25,11 @@ optional arguments:
   -d, --description     Show job descriptions
   -r, --runs            Only show run names
   -f, --full            Print the entire job config. Use with caution.
+  -w, --wait-stats      Show how long each owner's jobs waited in the queue
+                        before being dispatched, in seconds. Needs
+                        queue_backend: local in teuthology.yaml; beanstalkd
+                        keeps no such statistics.
+  --since HOURS         Only count jobs dispatched in the last HOURS hours
 """.format(archive_base=teuthology.config.config.archive_base)
 
 
@@ -20,6 +20,11 @@ Miscellaneous arguments:
   -h, --help                  Show this help message and exit
   -v, --verbose               Be more verbose
   --dry-run                   Do a dry run; do not schedule anything
+  --count                     Print how many jobs the suite (or the subset
+                              given with --subset) consists of, then exit
+                              without scheduling anything
+  --stats                     Like --count, but also print how many of the
+                              jobs each yaml fragment appears in
 
 Standard arguments:
   <config_yaml>               Optional extra job yaml to include
@@ -77,6 +82,14 @@ Scheduler arguments:
   --filter-out KEYWORDS       Do not run jobs whose name contains any of
                               the keywords in the comma separated keyword
                               string specified.
+  --rerun <run_name>          Only schedule the jobs that failed or died in
+                              the run named <run_name>, as reported by the
+                              results server or found in the archive. The
+                              other arguments should match those of the
+                              original run.
+  --rerun-statuses <statuses> The comma separated statuses of the jobs to
+                              schedule with --rerun
+                              [default: fail,dead]
 """.format(default_machine_type=config.default_machine_type,
            default_results_timeout=config.results_timeout)
 
@@ -10,7 +10,7 @@ def main():
 def parse_args():
     parser = argparse.ArgumentParser(description="""
 Grab jobs from a beanstalk queue and run the teuthology tests they
-describe. One job is run at a time.
+describe. One job is run at a time unless --slots is given.
 """)
     parser.add_argument(
         '-v', '--verbose',
@@ -33,5 +33,11 @@ describe. One job is run at a time.
         help='which beanstalk tube to read jobs from',
         required=True,
     )
+    parser.add_argument(
+        '--slots',
+        type=int,
+        default=1,
+        help='how many jobs to run concurrently from this process',
+    )
 
     return parser.parse_args()
@@ -1,23 +1,45 @@
 import beanstalkc
+import json
 import yaml
 import logging
+import os
 import pprint
 import sys
+import time
 from collections import OrderedDict
 
 from .config import config
+from . import local_queue
 from . import report
 
 log = logging.getLogger(__name__)
 
 
 def connect():
+    """
+    Connect to the job queue. This is beanstalkd at queue_host:queue_port,
+    unless queue_backend is 'local', in which case it is the SQLite queue at
+    queue_path; see teuthology.local_queue. Only the local queue supports
+    fair_share.
+    """
+    if config.queue_backend == 'local':
+        if config.queue_path is None:
+            raise RuntimeError(
+                'queue_path not found in {conf_path}'.format(
+                    conf_path=config.teuthology_yaml))
+        return local_queue.Connection(
+            config.queue_path,
+            fair_share=local_queue.FairShare.from_config(
+                config.fair_share, config.max_job_time))
     host = config.queue_host
     port = config.queue_port
     if host is None or port is None:
         raise RuntimeError(
             'Beanstalk queue information not found in {conf_path}'.format(
                 conf_path=config.teuthology_yaml))
+    if config.fair_share:
+        log.warning("Ignoring fair_share in %s: it needs queue_backend: "
+                    "local", config.teuthology_yaml)
     return beanstalkc.Connection(host=host, port=port)
 
 
@@ -34,9 +56,216 @@ def watch_tube(connection, tube_name):
     return tube_name
 
 
+# Jobs are put into this tube, and immediately deleted, to learn the newest
+# job id on the server. Nothing watches it.
+probe_tube = 'teuthology-queue-probe'
+header_fields = ('name', 'description', 'priority')
+# After this many ids in a row that aren't ready jobs in the tube, a walk
+# checks whether it is worth going on; see iter_jobs()
+max_misses = 1000
+
+# libyaml's loader is an order of magnitude faster, when it is available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def newest_job_id(connection):
+    """
+    Return the id of the newest job on the server. Job ids are assigned
+    sequentially across all tubes, so this bounds the ids a walk needs to
+    look at.
+    """
+    using = connection.using()
+    connection.use(probe_tube)
+    try:
+        # Clear out probes left by walks that died before deleting them
+        job = connection.peek_ready()
+        while job is not None:
+            _delete_probe(connection, job.jid)
+            job = connection.peek_ready()
+        jid = connection.put('')
+        _delete_probe(connection, jid)
+    finally:
+        connection.use(using)
+    return jid
+
+
+def _delete_probe(connection, jid):
+    try:
+        connection.delete(jid)
+    except beanstalkc.CommandFailed:
+        # Another walk cleared it out first
+        pass
+
+
+def job_created(stats, now=None):
+    """
+    When a job was put, to the second, according to its stats-job age.
+    """
+    if now is None:
+        now = time.time()
+    return int(now) - stats['age']
+
+
+class JobHeaderCache(object):
+    """
+    The name, description and priority of queued jobs, keyed by job id, and
+    the oldest ready job found in each tube. They are stored as JSON at
+    path; if path is None, nothing is read or written.
+
+    A job's body never changes, but beanstalkd reuses ids once it is
+    restarted without a binlog, so each header is stored with the time its
+    job was put and is only trusted while that still matches the job's
+    stats.
+    """
+    # Seconds a job's age may drift between two looks at it
+    created_slop = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = dict()
+        self.lowest = dict()
+        self.seen = dict()
+        if path and os.path.exists(path):
+            try:
+                with file(path) as f:
+                    cached = json.load(f)
+                self.jobs = cached['jobs']
+                self.lowest = cached['lowest']
+            except (ValueError, KeyError, TypeError):
+                log.warning("Ignoring corrupt queue cache %s", path)
+
+    @classmethod
+    def for_connection(cls, connection):
+        """
+        The cache for a queue server, in config.suite_cache_dir. If that is
+        empty, the cache is not kept between walks.
+        """
+        if not config.suite_cache_dir:
+            return cls(None)
+        queue_id = getattr(connection, 'queue_id', None) or \
+            '{host}.{port}'.format(host=connection.host, port=connection.port)
+        return cls(os.path.join(
+            config.suite_cache_dir, 'queue.{id}.json'.format(id=queue_id)))
+
+    def get(self, job_id, stats):
+        """
+        Return the cached header for a job, or None if it isn't cached or
+        belongs to an older job that had the same id.
+        """
+        entry = self.jobs.get(str(job_id))
+        if entry is None or 'age' not in stats:
+            return None
+        if abs(entry['created'] - job_created(stats)) > self.created_slop:
+            return None
+        self.seen[str(job_id)] = entry
+        return entry['header']
+
+    def add(self, job_id, stats, job_config):
+        header = dict((key, job_config.get(key)) for key in header_fields)
+        if 'age' in stats:
+            self.seen[str(job_id)] = dict(header=header,
+                                          created=job_created(stats))
+        return header
+
+    def save(self):
+        """
+        Write out the headers of the jobs seen since this cache was loaded.
+        """
+        if not self.path:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = self.path + '.tmp'
+        with file(tmp_path, 'w') as f:
+            json.dump(dict(jobs=self.seen, lowest=self.lowest), f)
+        os.rename(tmp_path, self.path)
+
+
+def _ready_job(connection, jid, tube_name, cache, full):
+    try:
+        stats = connection.stats_job(jid)
+    except beanstalkc.CommandFailed:
+        # Deleted, or never existed
+        return None
+    if stats['tube'] != tube_name or stats['state'] != 'ready':
+        return None
+    job_config = None
+    if cache is not None and not full:
+        job_config = cache.get(jid, stats)
+    if job_config is None:
+        job = connection.peek(jid)
+        if job is None or not job.body:
+            return None
+        job_config = yaml.load(job.body, Loader=YamlLoader)
+        if cache is not None:
+            header = cache.add(jid, stats, job_config)
+            if not full:
+                job_config = header
+    return (jid, job_config,
+            beanstalkc.Job(connection, jid, None, reserved=False))
+
+
+def iter_jobs(connection, tube_name, cache=None, full=True):
+    """
+    Yield (job_id, job_config, job) for each ready job in a tube, newest
+    first, without reserving any of them, so workers can keep taking jobs
+    while the queue is inspected. job is a beanstalkc.Job that may be used
+    to delete the job.
+
+    beanstalkd can't list a tube, so this looks at job ids one at a time,
+    down from the newest. It stops once it has found every ready job. Jobs
+    may be reserved or deleted while it walks, so after every max_misses ids
+    in a row that aren't ready jobs in the tube, it stops if it is below the
+    oldest job found by the last walk that used the same cache, or if it has
+    found as many jobs as the tube has ready now.
+
+    Unless full is set, job_config only holds the job's header fields, and
+    if cache is a JobHeaderCache, bodies are only fetched and parsed for
+    jobs it hasn't seen before. Pass full=True before acting on jobs, such
+    as deleting them; then every body is parsed, and the cache only bounds
+    the walk.
+    """
+    job_count = connection.stats_tube(tube_name)['current-jobs-ready']
+    if job_count == 0:
+        return
+    jid = newest_job_id(connection)
+    floor = None
+    if cache is not None:
+        floor = cache.lowest.get(tube_name)
+    if floor is not None and floor > jid:
+        # Left over from before the server was restarted
+        floor = None
+    found = 0
+    lowest = None
+    misses = 0
+    while found < job_count and jid > 1:
+        jid -= 1
+        job = _ready_job(connection, jid, tube_name, cache, full)
+        if job is not None:
+            found += 1
+            lowest = jid
+            misses = 0
+            yield job
+            continue
+        misses += 1
+        if misses < max_misses:
+            continue
+        if floor is not None and jid < floor:
+            break
+        job_count = connection.stats_tube(tube_name)['current-jobs-ready']
+        misses = 0
+    if cache is not None and lowest is not None:
+        cache.lowest[tube_name] = lowest
+
+
 def walk_jobs(connection, tube_name, processor, pattern=None):
     """
-    def callback(jobs_dict)
+    Feed each ready job in a tube to processor.add_job() as soon as it is
+    found. Jobs are peeked at rather than reserved; see iter_jobs().
+
+    Unless processor.needs_body is set, the processor only gets each job's
+    header fields, and headers are cached between calls; see iter_jobs().
     """
     log.info("Checking Beanstalk Queue...")
     job_count = connection.stats_tube(tube_name)['current-jobs-ready']
@@ -44,20 +273,17 @@ def walk_jobs(connection, tube_name, processor, pattern=None):
         log.info('No jobs in Beanstalk Queue')
         return
 
-    # Try to figure out a sane timeout based on how many jobs are in the queue
-    timeout = job_count / 2000.0 * 60
-    for i in range(1, job_count + 1):
+    cache = JobHeaderCache.for_connection(connection)
+    jobs = iter_jobs(connection, tube_name, cache, full=processor.needs_body)
+    i = 0
+    for job_id, job_config, job in jobs:
+        i += 1
         print_progress(i, job_count, "Loading")
-        job = connection.reserve(timeout=timeout)
-        if job is None or job.body is None:
-            continue
-        job_config = yaml.safe_load(job.body)
-        job_name = job_config['name']
-        job_id = job.stats()['id']
-        if pattern is not None and pattern not in job_name:
+        if pattern is not None and pattern not in job_config['name']:
             continue
         processor.add_job(job_id, job_config, job)
     end_progress()
+    cache.save()
     processor.complete()
 
 
@@ -74,6 +300,10 @@ def end_progress():
 
 
 class JobProcessor(object):
+    # Whether process_job() needs each job's complete config, rather than
+    # just its header fields
+    needs_body = False
+
     def __init__(self):
         self.jobs = OrderedDict()
 
@@ -102,6 +332,7 @@ class JobPrinter(JobProcessor):
         super(JobPrinter, self).__init__()
         self.show_desc = show_desc
         self.full = full
+        self.needs_body = full
 
     def process_job(self, job_id):
         job_config = self.jobs[job_id]['job_config']
@@ -133,6 +364,9 @@ class RunPrinter(JobProcessor):
 
 
 class JobDeleter(JobProcessor):
+    # Cached headers are never trusted to decide what to delete
+    needs_body = True
+
     def __init__(self, pattern):
         self.pattern = pattern
         super(JobDeleter, self).__init__()
@@ -155,6 +389,19 @@ class JobDeleter(JobProcessor):
         report.try_delete_jobs(job_name, job_id)
 
 
+def print_wait_stats(connection, since_hours=None):
+    if not hasattr(connection, 'wait_stats'):
+        log.error("Wait statistics are only kept by the local queue "
+                  "backend; set queue_backend: local in %s",
+                  config.teuthology_yaml)
+        return
+    since = None
+    if since_hours is not None:
+        since = time.time() - float(since_hours) * 60 * 60
+    stats = connection.wait_stats(since=since)
+    print yaml.safe_dump(stats, default_flow_style=False),
+
+
 def main(args):
     machine_type = args['--machine_type']
     delete = args['--delete']
@@ -163,6 +410,9 @@ def main(args):
     full = args['--full']
     try:
         connection = connect()
+        if args.get('--wait-stats'):
+            print_wait_stats(connection, args.get('--since'))
+            return
         watch_tube(connection, machine_type)
         if delete:
             walk_jobs(connection, machine_type,
@@ -126,18 +126,25 @@ class TeuthologyConfig(YamlConfig):
     yaml_path = os.path.join(os.path.expanduser('~/.teuthology.yaml'))
     _defaults = {
         'archive_base': '/var/lib/teuthworker/archive',
+        'archive_compression': 'gzip',
+        'archive_concurrency': 5,
+        'archive_bandwidth_limit': None,
         'automated_scheduling': False,
         'reserve_machines': 5,
         'ceph_git_base_url': 'https://github.com/ceph/',
+        'command_timing': False,
         'gitbuilder_host': 'gitbuilder.ceph.com',
         'lab_domain': 'front.sepia.ceph.com',
         'lock_server': 'http://paddles.front.sepia.ceph.com/',
         'max_job_time': 259200,  # 3 days
+        'package_versions_cache_ttl': 3600,
+        'queue_backend': 'beanstalk',
         'results_server': 'http://paddles.front.sepia.ceph.com/',
         'results_ui_server': 'http://pulpito.ceph.com/',
         'results_sending_email': 'teuthology',
         'results_timeout': 43200,
         'src_base_path': os.path.expanduser('~/src'),
+        'suite_cache_dir': os.path.expanduser('~/.cache/teuthology'),
         'verify_host_keys': True,
         'watchdog_interval': 120,
         'kojihub_url': 'http://koji.fedoraproject.org/kojihub',
@@ -10,7 +10,6 @@ import getpass
 
 from . import beanstalk
 from . import report
-from .config import config
 from . import misc
 
 log = logging.getLogger(__name__)
@@ -113,27 +112,25 @@ def remove_paddles_jobs(run_name):
 
 
 def remove_beanstalk_jobs(run_name, tube_name):
-    qhost = config.queue_host
-    qport = config.queue_port
-    if qhost is None or qport is None:
-        raise RuntimeError(
-            'Beanstalk queue information not found in {conf_path}'.format(
-                conf_path=config.yaml_path))
     log.info("Checking Beanstalk Queue...")
     beanstalk_conn = beanstalk.connect()
     real_tube_name = beanstalk.watch_tube(beanstalk_conn, tube_name)
 
+    if hasattr(beanstalk_conn, 'delete_run'):
+        # The local queue indexes jobs by run, so there's no need to walk it
+        for job_id in beanstalk_conn.delete_run(run_name, real_tube_name):
+            log.info("Deleted job from queue. ID: %s Name: %s", job_id,
+                     run_name)
+        beanstalk_conn.close()
+        return
+
     curjobs = beanstalk_conn.stats_tube(real_tube_name)['current-jobs-ready']
     if curjobs != 0:
-        x = 1
-        while x != curjobs:
-            x += 1
-            job = beanstalk_conn.reserve(timeout=20)
-            if job is None:
-                continue
-            job_config = yaml.safe_load(job.body)
+        cache = beanstalk.JobHeaderCache.for_connection(beanstalk_conn)
+        jobs = beanstalk.iter_jobs(beanstalk_conn, real_tube_name, cache,
+                                   full=True)
+        for (job_id, job_config, job) in jobs:
             if run_name == job_config['name']:
-                job_id = job.stats()['id']
                 msg = "Deleting job from queue. ID: " + \
                     "{id} Name: {name} Desc: {desc}".format(
                         id=str(job_id),
@@ -142,6 +139,7 @@ def remove_beanstalk_jobs(run_name, tube_name):
                     )
                 log.info(msg)
                 job.delete()
+        cache.save()
     else:
         print "No jobs in Beanstalk Queue"
     beanstalk_conn.close()
@@ -0,0 +1,534 @@
+"""
+An embedded job queue, stored in SQLite, for labs and CI setups that don't
+want to run beanstalkd.
+
+Connection implements the subset of beanstalkc.Connection that teuthology
+uses, with the same semantics: tubes, priorities (lower runs first), delays,
+time-to-run, and bury/kick. Failed commands raise beanstalkc.CommandFailed,
+and reserve() and peek() return beanstalkc.Job objects, so callers can't tell
+the two backends apart. Several processes may share one queue file.
+
+On top of that, every job is indexed by its run name, so run-level
+operations like delete_run() only touch the jobs in that run. Jobs may also
+be dispatched fairly between owners rather than strictly in priority order;
+see FairShare.
+"""
+import beanstalkc
+import contextlib
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import time
+import yaml
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PRIORITY = beanstalkc.DEFAULT_PRIORITY
+DEFAULT_TTR = beanstalkc.DEFAULT_TTR
+
+# How often a blocked reserve() looks for new jobs, in seconds
+poll_interval = 0.5
+
+# AUTOINCREMENT keeps ids from being reused, so that, as with beanstalkd, job
+# ids only ever increase
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tube TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    ready_at REAL NOT NULL,
+    ttr INTEGER NOT NULL,
+    deadline REAL,
+    run_name TEXT,
+    owner TEXT,
+    created REAL,
+    dispatched_at REAL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_tube
+    ON jobs (tube, state, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_by_run ON jobs (run_name);
+CREATE TABLE IF NOT EXISTS dispatches (
+    owner TEXT,
+    run_name TEXT,
+    waited REAL NOT NULL,
+    dispatched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dispatches_by_time ON dispatches (dispatched_at);
+"""
+
+# Indexes that cover the queries FairShare makes on every reserve(). They
+# are created after any columns they need have been added.
+fair_share_schema = """
+CREATE INDEX IF NOT EXISTS jobs_by_owner
+    ON jobs (state, owner, run_name, dispatched_at);
+CREATE INDEX IF NOT EXISTS jobs_by_share
+    ON jobs (tube, state, owner, run_name, priority, id, ready_at);
+"""
+
+# How long the dispatches table keeps each dispatch, in seconds
+dispatch_retention = 30 * 24 * 60 * 60
+
+# A job's state as beanstalkd would report it, given the current time as the
+# only parameter
+state_sql = """
+CASE WHEN state = 'reserved' AND deadline <= :now THEN 'ready'
+     WHEN state = 'ready' AND ready_at > :now THEN 'delayed'
+     ELSE state END
+"""
+
+
+def job_header(body):
+    """
+    Pull the run name and owner out of a job body, without failing on bodies
+    that aren't job configs.
+    """
+    try:
+        job_config = yaml.load(body, Loader=getattr(yaml, 'CSafeLoader',
+                                                    yaml.SafeLoader))
+    except yaml.YAMLError:
+        return (None, None)
+    if not isinstance(job_config, dict):
+        return (None, None)
+    return (job_config.get('name'), job_config.get('owner'))
+
+
+def percentile(values, pct):
+    """
+    Return the pct'th percentile of a sorted list, by the nearest-rank
+    method.
+    """
+    index = max(int(math.ceil(pct / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
+class FairShare(object):
+    """
+    Decide which ready job to dispatch next, sharing workers fairly between
+    owners, and between each owner's runs.
+
+    Priorities are still strict: a job is only dispatched once no job with a
+    better (lower) priority is ready. Among jobs of the best ready priority,
+    the owner using the least of their share of the lab goes first, where
+    usage is the owner's running jobs divided by their weight; within an
+    owner, the run with the fewest running jobs goes first; and after that,
+    the oldest job.
+
+    :param weights: A dict mapping owners to their weight, which must be
+                    positive. An owner with weight 2 gets twice as many
+                    workers as one with weight 1 when both have jobs
+                    waiting.
+    :param aging:   If set, every aging seconds a job waits improves its
+                    priority by one, up to the best ready priority, so that
+                    low-priority jobs aren't starved forever.
+    :param running_window: Workers bury the jobs they are running, so a
+                    buried job counts as running for this many seconds
+                    after it was dispatched. If unset, buried jobs always
+                    count.
+    """
+    default_weight = 1
+
+    def __init__(self, weights=None, aging=None, running_window=None):
+        self.weights = weights or dict()
+        for (owner, weight) in self.weights.items():
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                raise ValueError(
+                    "fair_share weight for {owner} must be a positive "
+                    "number, not {weight!r}".format(owner=owner,
+                                                    weight=weight))
+        self.aging = aging
+        self.running_window = running_window
+
+    @classmethod
+    def from_config(cls, fair_share, max_job_time=None):
+        """
+        Build a FairShare from the fair_share config option, or return None
+        if it is unset. No job runs longer than max_job_time, so it is the
+        default running_window. Raises ValueError if a weight isn't a
+        positive number, since it would break every reserve().
+        """
+        if not fair_share:
+            return None
+        if not isinstance(fair_share, dict):
+            fair_share = dict()
+        return cls(weights=fair_share.get('weights'),
+                   aging=fair_share.get('aging'),
+                   running_window=fair_share.get('running_window',
+                                                 max_job_time))
+
+    def weight(self, owner):
+        return float(self.weights.get(owner, self.default_weight))
+
+    def choose(self, candidates, running, now):
+        """
+        :param candidates: A list of (job_id, owner, run_name, priority,
+                           ready_at) tuples.
+        :param running:    A dict mapping owners, and (owner, run_name)
+                           tuples, to their number of running jobs.
+        :param now:        The current time.
+        :returns:          The job_id to dispatch, or None.
+        """
+        if not candidates:
+            return None
+        best = min(candidate[3] for candidate in candidates)
+
+        def key(candidate):
+            (job_id, owner, run_name, priority, ready_at) = candidate
+            effective = priority
+            if self.aging:
+                effective -= int((now - ready_at) // self.aging)
+            return (
+                max(effective, best),
+                running.get(owner, 0) / self.weight(owner),
+                running.get((owner, run_name), 0),
+                priority,
+                job_id,
+            )
+        return min(candidates, key=key)[0]
+
+
+class Connection(object):
+    """
+    A connection to a queue stored in the SQLite database at path, which is
+    created if needed.
+    """
+    def __init__(self, path, fair_share=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.fair_share = fair_share
+        # Names the queue's cache files; queues in different directories
+        # may have the same file name
+        self.queue_id = 'local.{name}.{digest}'.format(
+            name=os.path.basename(self.path),
+            digest=hashlib.sha1(self.path).hexdigest()[:12])
+        self._tube = 'default'
+        self._watching = ['default']
+        self._reserved = set()
+        self.connect()
+
+    def connect(self):
+        # isolation_level=None leaves transactions to us, so that reserve()
+        # can take the write lock before looking for a job
+        self._db = sqlite3.connect(self.path, timeout=60,
+                                   isolation_level=None)
+        self._db.text_factory = str
+        self._db.executescript(schema)
+        columns = [row[1] for row in
+                   self._execute("PRAGMA table_info(jobs)").fetchall()]
+        if 'owner' not in columns:
+            # Queues created before jobs were indexed by owner
+            self._execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        if 'created' not in columns:
+            # Queues created before jobs had an age
+            self._execute("ALTER TABLE jobs ADD COLUMN created REAL")
+        if 'dispatched_at' not in columns:
+            # Queues created before buried jobs stopped counting as running
+            self._execute("ALTER TABLE jobs ADD COLUMN dispatched_at REAL")
+        self._db.executescript(fair_share_schema)
+
+    def close(self):
+        # beanstalkd releases a connection's reserved jobs when it closes
+        for jid in list(self._reserved):
+            self.release(jid)
+        self._db.close()
+
+    def reconnect(self):
+        self._db.close()
+        self.connect()
+
+    def _execute(self, sql, *args):
+        return self._db.execute(sql, args)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Run the body with the write lock held, committing if it succeeds and
+        rolling back if it raises.
+        """
+        self._execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self._execute("ROLLBACK")
+            raise
+        self._execute("COMMIT")
+
+    def _fail(self, command, status='NOT_FOUND'):
+        raise beanstalkc.CommandFailed(command, status, [])
+
+    def _job(self, row, reserved):
+        (jid, body) = row
+        return beanstalkc.Job(self, jid, body, reserved=reserved)
+
+    def _timeout_reserved(self, now):
+        # Reserved jobs whose time-to-run is up go back to being ready
+        self._execute(
+            "UPDATE jobs SET state = 'ready', ready_at = ?, deadline = NULL "
+            "WHERE state = 'reserved' AND deadline <= ?", now, now)
+
+    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        assert isinstance(body, str), 'Job body must be a str instance'
+        (run_name, owner) = job_header(body)
+        now = time.time()
+        cursor = self._execute(
+            "INSERT INTO jobs (tube, priority, state, ready_at, ttr, "
+            "run_name, owner, created, body) "
+            "VALUES (?, ?, 'ready', ?, ?, ?, ?, ?, ?)",
+            self._tube, priority, now + delay, ttr, run_name, owner, now,
+            body)
+        return cursor.lastrowid
+
+    def _next_job(self, now):
+        placeholders = ', '.join('?' * len(self._watching))
+        ready = ("FROM jobs WHERE tube IN ({tubes}) AND state = 'ready' "
+                 "AND ready_at <= ?".format(tubes=placeholders))
+        args = self._watching + [now]
+        if self.fair_share is None:
+            row = self._execute(
+                "SELECT id " + ready + " ORDER BY priority, id LIMIT 1",
+                *args).fetchone()
+            return row and row[0]
+        # Within a run, owner and priority the oldest job always goes first,
+        # so that is the only one of them worth considering. SQLite takes
+        # ready_at from the row that has MIN(id).
+        candidates = self._execute(
+            "SELECT MIN(id), owner, run_name, priority, ready_at " + ready +
+            " GROUP BY owner, run_name, priority", *args).fetchall()
+        # Workers bury the jobs they run, but a worker that dies leaves its
+        # job buried, so buried jobs only count for a while after they were
+        # dispatched
+        buried = "state = 'buried'"
+        buried_args = []
+        if self.fair_share.running_window:
+            buried += " AND dispatched_at >= ?"
+            buried_args.append(now - self.fair_share.running_window)
+        running = dict()
+        # Two queries, so that each one is a range of the jobs_by_owner index
+        rows = self._execute(
+            "SELECT owner, run_name, COUNT(*) FROM jobs "
+            "WHERE state = 'reserved' GROUP BY owner, run_name").fetchall()
+        rows += self._execute(
+            "SELECT owner, run_name, COUNT(*) FROM jobs WHERE " + buried +
+            " GROUP BY owner, run_name", *buried_args).fetchall()
+        for (owner, run_name, count) in rows:
+            running[owner] = running.get(owner, 0) + count
+            running[(owner, run_name)] = \
+                running.get((owner, run_name), 0) + count
+        return self.fair_share.choose(candidates, running, now)
+
+    def reserve(self, timeout=None):
+        if timeout is not None:
+            stop = time.time() + timeout
+        while True:
+            now = time.time()
+            row = None
+            with self._transaction():
+                self._timeout_reserved(now)
+                jid = self._next_job(now)
+                if jid is not None:
+                    row = self._execute(
+                        "SELECT body, ttr, owner, run_name, ready_at "
+                        "FROM jobs WHERE id = ?", jid).fetchone()
+                    (body, ttr, owner, run_name, ready_at) = row
+                    self._execute(
+                        "UPDATE jobs SET state = 'reserved', deadline = ?, "
+                        "dispatched_at = ? WHERE id = ?", now + ttr, now, jid)
+                    self._execute(
+                        "INSERT INTO dispatches (owner, run_name, waited, "
+                        "dispatched_at) VALUES (?, ?, ?, ?)",
+                        owner, run_name, max(now - ready_at, 0), now)
+                    self._execute(
+                        "DELETE FROM dispatches WHERE dispatched_at < ?",
+                        now - dispatch_retention)
+            if row is not None:
+                self._reserved.add(jid)
+                return self._job((jid, body), reserved=True)
+            if timeout is not None and now >= stop:
+                return None
+            if timeout is None:
+                wait = poll_interval
+            else:
+                wait = min(poll_interval, stop - now)
+            time.sleep(wait)
+
+    def _update(self, command, sql, *args):
+        cursor = self._execute(sql, *args)
+        if cursor.rowcount == 0:
+            self._fail(command)
+
+    def delete(self, jid):
+        self._update('delete', "DELETE FROM jobs WHERE id = ?", jid)
+        self._reserved.discard(jid)
+
+    def release(self, jid, priority=DEFAULT_PRIORITY, delay=0):
+        self._update(
+            'release',
+            "UPDATE jobs SET state = 'ready', priority = ?, ready_at = ?, "
+            "deadline = NULL WHERE id = ? AND state = 'reserved'",
+            priority, time.time() + delay, jid)
+        self._reserved.discard(jid)
+
+    def bury(self, jid, priority=DEFAULT_PRIORITY):
+        self._update(
+            'bury',
+            "UPDATE jobs SET state = 'buried', priority = ?, deadline = NULL "
+            "WHERE id = ? AND state = 'reserved'", priority, jid)
+        self._reserved.discard(jid)
+
+    def touch(self, jid):
+        self._update(
+            'touch',
+            "UPDATE jobs SET deadline = ? + ttr "
+            "WHERE id = ? AND state = 'reserved'", time.time(), jid)
+
+    def kick(self, bound=1):
+        """
+        Kick up to bound buried jobs in the tube in use back into the ready
+        queue, and return how many were kicked.
+        """
+        cursor = self._execute(
+            "UPDATE jobs SET state = 'ready', ready_at = ? WHERE id IN "
+            "(SELECT id FROM jobs WHERE tube = ? AND state = 'buried' "
+            "ORDER BY id LIMIT ?)", time.time(), self._tube, bound)
+        return cursor.rowcount
+
+    def kick_job(self, jid):
+        self._update(
+            'kick-job',
+            "UPDATE jobs SET state = 'ready', ready_at = ? "
+            "WHERE id = ? AND state = 'buried'", time.time(), jid)
+
+    def peek(self, jid):
+        row = self._execute("SELECT id, body FROM jobs WHERE id = ?",
+                            jid).fetchone()
+        if row is not None:
+            return self._job(row, reserved=False)
+
+    def _peek_state(self, state):
+        row = self._execute(
+            "SELECT id, body FROM jobs WHERE tube = ? AND state = ? "
+            "ORDER BY priority, id LIMIT 1", self._tube, state).fetchone()
+        if row is not None:
+            return self._job(row, reserved=False)
+
+    def peek_ready(self):
+        return self._peek_state('ready')
+
+    def peek_buried(self):
+        return self._peek_state('buried')
+
+    def tubes(self):
+        rows = self._execute("SELECT DISTINCT tube FROM jobs").fetchall()
+        return sorted(set([row[0] for row in rows] + self._watching +
+                          [self._tube]))
+
+    def using(self):
+        return self._tube
+
+    def use(self, name):
+        self._tube = name
+        return name
+
+    def watching(self):
+        return list(self._watching)
+
+    def watch(self, name):
+        if name not in self._watching:
+            self._watching.append(name)
+        return len(self._watching)
+
+    def ignore(self, name):
+        if name in self._watching:
+            if len(self._watching) == 1:
+                self._fail('ignore', 'NOT_IGNORED')
+            self._watching.remove(name)
+        return len(self._watching)
+
+    def stats_tube(self, name):
+        counts = dict(ready=0, delayed=0, reserved=0, buried=0)
+        rows = self._db.execute(
+            "SELECT {state} AS current, COUNT(*) FROM jobs "
+            "WHERE tube = :tube GROUP BY current".format(state=state_sql),
+            dict(now=time.time(), tube=name))
+        for (state, count) in rows:
+            counts[state] += count
+        stats = dict(('current-jobs-' + state, count)
+                     for (state, count) in counts.items())
+        stats['name'] = name
+        return stats
+
+    def stats_job(self, jid):
+        now = time.time()
+        row = self._db.execute(
+            "SELECT id, tube, {state}, priority, ttr, "
+            "COALESCE(created, ready_at) FROM jobs "
+            "WHERE id = :id".format(state=state_sql),
+            dict(now=now, id=jid)).fetchone()
+        if row is None:
+            self._fail('stats-job')
+        (jid, tube, state, priority, ttr, created) = row
+        return dict(id=jid, tube=tube, state=state, pri=priority, ttr=ttr,
+                    age=int(max(now - created, 0)))
+
+    def run_job_ids(self, run_name, tube=None, state='ready'):
+        """
+        Return the ids of a run's jobs in the given state, oldest first,
+        using the run name index.
+        """
+        sql = "SELECT id FROM jobs WHERE run_name = ? AND state = ?"
+        args = [run_name, state]
+        if tube is not None:
+            sql += " AND tube = ?"
+            args.append(tube)
+        rows = self._execute(sql + " ORDER BY id", *args)
+        return [row[0] for row in rows]
+
+    def delete_run(self, run_name, tube=None):
+        """
+        Delete every ready or delayed job in a run, in one statement that
+        uses the run name index. Jobs that workers have reserved, and buried
+        while they run them, are left alone.
+
+        :returns: The ids of the deleted jobs.
+        """
+        sql = "DELETE FROM jobs WHERE run_name = ? AND state = 'ready'"
+        args = [run_name]
+        if tube is not None:
+            sql += " AND tube = ?"
+            args.append(tube)
+        with self._transaction():
+            job_ids = self.run_job_ids(run_name, tube)
+            self._execute(sql, *args)
+        return job_ids
+
+    def wait_stats(self, since=None):
+        """
+        Summarize how long jobs waited in the queue before being dispatched,
+        per owner.
+
+        :param since: Only count jobs dispatched after this time, as returned
+                      by time.time(). Defaults to every dispatch that is
+                      still kept; see dispatch_retention.
+        :returns:     A dict mapping each owner to a dict with the number of
+                      jobs and the mean, median, 90th and 99th percentile and
+                      maximum wait, in seconds.
+        """
+        rows = self._execute(
+            "SELECT owner, waited FROM dispatches WHERE dispatched_at >= ? "
+            "ORDER BY owner, waited", since or 0)
+        waits = dict()
+        for (owner, waited) in rows:
+            waits.setdefault(owner, list()).append(waited)
+        stats = dict()
+        for (owner, owner_waits) in waits.items():
+            stats[owner] = dict(
+                jobs=len(owner_waits),
+                mean=sum(owner_waits) / len(owner_waits),
+                p50=percentile(owner_waits, 50),
+                p90=percentile(owner_waits, 90),
+                p99=percentile(owner_waits, 99),
+                max=owner_waits[-1],
+            )
+        return stats
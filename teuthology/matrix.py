@@ -38,6 +38,23 @@ class Matrix:
         """
         return self.size() / self.minscanlen()
 
+    def index_range(self, start, stop):
+        """
+        Yields index(i) for each i in [start, stop).  Subclasses may
+        override this to share work between consecutive indices.
+        """
+        for i in xrange(start, stop):
+            yield self.index(i)
+
+    def coverage(self):
+        """
+        coverage() should return a dict mapping each path (a tuple of
+        items, as generated by generate_lists()) to the number of indices
+        in [0, size()) whose result includes it.  It is computed from the
+        structure of the matrix, without generating any of its results.
+        """
+        pass
+
 
 class Cycle(Matrix):
     """
@@ -56,6 +73,10 @@ class Cycle(Matrix):
     def minscanlen(self):
         return self.mat.minscanlen()
 
+    def coverage(self):
+        return dict((path, count * self.num) for (path, count)
+                    in self.mat.coverage().iteritems())
+
 
 class Base(Matrix):
     """
@@ -73,6 +94,9 @@ class Base(Matrix):
     def minscanlen(self):
         return 1
 
+    def coverage(self):
+        return {(self.item,): 1}
+
 
 class Product(Matrix):
     """
@@ -96,16 +120,26 @@ class Product(Matrix):
 
         self._minscanlen = max([i.minscanlen() for i in _submats])
 
+        # Precompute, for each dimension but the last, the length of a
+        # cycle and the number of cycles; see _index().
+        self._levels = []
+        for (rsize, lmat) in self.submats[:-1]:
+            lsize = lmat.size()
+            cycles = gcd(rsize, lsize)
+            clen = (rsize * lsize) / cycles
+            self._levels.append((lmat, clen, cycles))
+        self._last = self.submats[-1][1]
+
     def minscanlen(self):
         return self._minscanlen
 
     def size(self):
         return self._size
 
-    def _index(self, i, submats):
+    def _index(self, i, _index_of=None):
         """
-        We recursively reduce the N dimension problem to a two
-        dimension problem.
+        Conceptually, we recursively reduce the N dimension problem to a
+        two dimension problem.
 
         index(i) = (lmat.index(i % lmat.size()), rmat.index(i %
         rmat.size())) would simply work if lmat.size() and rmat.size()
@@ -117,33 +151,62 @@ class Product(Matrix):
         number on each repeat.  Each of the N repeats must therefore
         be distinct from the previous ones resulting in lmat.size() *
         rmat.size() combinations.
+
+        Since i itself is passed unchanged down the recursion, each
+        dimension's offset only depends on i and the precomputed cycle
+        data, so we simply loop over the dimensions.
+
+        :param _index_of: Optional callable (mat, j) -> mat.index(j),
+                          used by index_range() to memoize.
+        """
+        if _index_of is None:
+            _index_of = _submat_index
+        items = set([_index_of(self._last, i)])
+        for (lmat, clen, cycles) in self._levels:
+            litems = _index_of(lmat, i + (i / clen) % cycles)
+            if type(litems) is frozenset:
+                items.update(litems)
+            else:
+                items.add(litems)
+        return frozenset(items)
+
+    def index(self, i):
+        items = self._index(i)
+        return (self.item, items)
+
+    def index_range(self, start, stop):
         """
-        assert len(submats) > 0, \
-            "_index requires non-empty submats"
-        if len(submats) == 1:
-            return frozenset([submats[0][1].index(i)])
+        index(j) is periodic in the size of the matrix, so the results
+        of the submatrices are memoized for the duration of the range.
+        """
+        cache = dict()
 
-        lmat = submats[0][1]
-        lsize = lmat.size()
+        def _index_of(mat, j):
+            key = (id(mat), j % mat.size())
+            if key not in cache:
+                cache[key] = mat.index(j)
+            return cache[key]
 
-        rsize = submats[0][0]
+        for i in xrange(start, stop):
+            yield (self.item, self._index(i, _index_of))
 
-        cycles = gcd(rsize, lsize)
-        clen = (rsize * lsize) / cycles
-        off = (i / clen) % cycles
+    def coverage(self):
+        """
+        Every combination appears exactly once, so each item of a
+        submatrix appears size() / submat.size() times as often as it
+        does in the submatrix itself.
+        """
+        out = dict()
+        for (_, submat) in self.submats:
+            mult = self._size / submat.size()
+            for (path, count) in submat.coverage().iteritems():
+                out[(self.item,) + path] = count * mult
+        return out
 
-        def combine(r, s=frozenset()):
-            if type(r) is frozenset:
-                return s | r
-            return s | frozenset([r])
 
-        litems = lmat.index(i + off)
-        ritems = self._index(i, submats[1:])
-        return combine(litems, combine(ritems))
+def _submat_index(mat, i):
+    return mat.index(i)
 
-    def index(self, i):
-        items = self._index(i, self.submats)
-        return (self.item, items)
 
 class Concat(Matrix):
     """
@@ -152,6 +215,7 @@ class Concat(Matrix):
     def __init__(self, item, submats):
         self.submats = submats
         self.item = item
+        self._out = None
 
     def size(self):
         return 1
@@ -160,11 +224,20 @@ class Concat(Matrix):
         return 1
 
     def index(self, i):
-        out = frozenset()
+        # The result does not depend on i; compute it once
+        if self._out is None:
+            out = set()
+            for submat in self.submats:
+                out.update(submat.index_range(0, submat.size()))
+            self._out = (self.item, frozenset(out))
+        return self._out
+
+    def coverage(self):
+        out = dict()
         for submat in self.submats:
-            for i in range(submat.size()):
-                out = out | frozenset([submat.index(i)])
-        return (self.item, out)
+            for path in submat.coverage():
+                out[(self.item,) + path] = 1
+        return out
 
 class Sum(Matrix):
     """
@@ -189,46 +262,62 @@ class Sum(Matrix):
             [(self._size / i.size()) *
              i.minscanlen() for i in _submats])
 
+        # Precompute the interleaving parameters of each sequence but the
+        # last; see _index().
+        self._levels = []
+        for (rsize, lmat) in self.submats[:-1]:
+            lsize = lmat.size()
+            mult = rsize / lsize
+            clen = mult + 1
+            thresh = lsize * clen
+            self._levels.append((lmat, lsize, rsize, mult, clen, thresh))
+        self._last = self.submats[-1][1]
+
     def minscanlen(self):
         return self._minscanlen
 
     def size(self):
         return self._size
 
-    def _index(self, _i, submats):
+    def _index(self, _i):
         """
-        We reduce the N sequence problem to a two sequence problem recursively.
+        Conceptually, we reduce the N sequence problem to a two sequence
+        problem recursively.
 
         If we have two sequences M and N of length m and n (n > m wlog), we
         want to mix an M item into the stream every N / M items.  Once we run
         out of N, we want to simply finish the M stream.
+
+        Each step either picks an item from the current M sequence or
+        descends into the remaining sequences, so we loop instead of
+        recursing.
         """
-        assert len(submats) > 0, \
-            "_index requires non-empty submats"
-        if len(submats) == 1:
-            return submats[0][1].index(_i)
-        lmat = submats[0][1]
-        lsize = lmat.size()
-
-        rsize = submats[0][0]
-
-        mult = rsize / lsize
-        clen = mult + 1
-        thresh = lsize * clen
-        i = _i % (rsize + lsize)
-        base = (_i / (rsize + lsize))
-        if i < thresh:
-            if i % clen == 0:
-                return lmat.index((i / clen) + (base * lsize))
+        for (lmat, lsize, rsize, mult, clen, thresh) in self._levels:
+            i = _i % (rsize + lsize)
+            base = (_i / (rsize + lsize))
+            if i < thresh:
+                if i % clen == 0:
+                    return lmat.index((i / clen) + (base * lsize))
+                else:
+                    _i = ((i / clen) * mult + ((i % clen) - 1)) + \
+                        (base * rsize)
             else:
-                return self._index(((i / clen) * mult + ((i % clen) - 1)) +
-                                   (base * rsize),
-                                   submats[1:])
-        else:
-            return self._index(i - lsize, submats[1:])
+                _i = i - lsize
+        return self._last.index(_i)
 
     def index(self, i):
-        return (self.item, self._index(i, self.submats))
+        return (self.item, self._index(i))
+
+    def coverage(self):
+        """
+        Each index of each submatrix appears exactly once.
+        """
+        out = dict()
+        for (_, submat) in self.submats:
+            for (path, count) in submat.coverage().iteritems():
+                path = (self.item,) + path
+                out[path] = out.get(path, 0) + count
+        return out
 
 
 def generate_lists(result):
@@ -11,14 +11,12 @@ import configobj
 import getpass
 import socket
 import sys
-import tarfile
 import time
 import urllib2
 import urlparse
 import yaml
 import json
 import re
-import tempfile
 import pprint
 
 from teuthology import safepath
@@ -723,18 +721,22 @@ def get_file(remote, path, sudo=False, dest_dir='/tmp'):
     return file_data
 
 
-def pull_directory(remote, remotedir, localdir):
+def pull_directory(remote, remotedir, localdir, bandwidth_limit=None):
     """
     Copy a remote directory to a local directory.
+
+    :param bandwidth_limit: If set, transfer at no more than this many bytes
+                            per second
+    :returns:               The total size, in bytes, of the files copied
     """
     log.debug('Transferring archived files from %s:%s to %s',
               remote.shortname, remotedir, localdir)
     if not os.path.exists(localdir):
         os.mkdir(localdir)
-    _, local_tarfile = tempfile.mkstemp(dir=localdir)
-    remote.get_tar(remotedir, local_tarfile, sudo=True)
-    with open(local_tarfile, 'r+') as fb1:
-        tar = tarfile.open(mode='r|gz', fileobj=fb1)
+    total_bytes = 0
+    with remote.tar_stream(remotedir, sudo=True,
+                           compression=config.archive_compression,
+                           bandwidth_limit=bandwidth_limit) as tar:
         while True:
             ti = tar.next()
             if ti is None:
@@ -747,6 +749,7 @@ def pull_directory(remote, remotedir, localdir):
                 sub = safepath.munge(ti.name)
                 safepath.makedirs(root=localdir, path=os.path.dirname(sub))
                 tar.makefile(ti, targetpath=os.path.join(localdir, sub))
+                total_bytes += ti.size
             else:
                 if ti.isdev():
                     type_ = 'device'
@@ -758,7 +761,7 @@ def pull_directory(remote, remotedir, localdir):
                     type_ = 'unknown'
                     log.info('Ignoring tar entry: %r type %r', ti.name, type_)
                     continue
-    os.remove(local_tarfile)
+    return total_bytes
 
 
 def pull_directory_tarball(remote, remotedir, localfile):
@@ -840,27 +843,27 @@ def get_scratch_devices(remote):
     log.debug('devs={d}'.format(d=devs))
 
     retval = []
-    for dev in devs:
-        try:
-            # FIXME: Split this into multiple calls.
-            remote.run(
-                args=[
-                    # node exists
-                    'stat',
-                    dev,
-                    run.Raw('&&'),
-                    # readable
-                    'sudo', 'dd', 'if=%s' % dev, 'of=/dev/null', 'count=1',
-                    run.Raw('&&'),
-                    # not mounted
-                    run.Raw('!'),
-                    'mount',
-                    run.Raw('|'),
-                    'grep', '-q', dev,
-                ]
-            )
+    # Check all of the devices in one go
+    results = remote.run_batch([
+        [
+            # node exists
+            'stat',
+            dev,
+            run.Raw('&&'),
+            # readable
+            'sudo', 'dd', 'if=%s' % dev, 'of=/dev/null', 'count=1',
+            run.Raw('&&'),
+            # not mounted
+            run.Raw('!'),
+            'mount',
+            run.Raw('|'),
+            'grep', '-q', dev,
+        ] for dev in devs
+    ], check_status=False)
+    for (dev, result) in zip(devs, results):
+        if result.exitstatus == 0:
             retval.append(dev)
-        except CommandFailedError:
+        else:
             log.debug("get_scratch_devices: %s is in use" % dev)
     return retval
 
@@ -1080,6 +1083,38 @@ def deep_merge(a, b):
     return b
 
 
+def deep_merged(a, b):
+    """
+    Like deep_merge(), but neither a nor b is modified; the merged result is
+    returned instead.
+
+    New dicts and lists are only created where a and b overlap. Anything
+    found in only one of them is shared with the result rather than copied,
+    so the result should be treated as read-only.
+    :param a: object items will be merged into
+    :param b: object items will be merged from
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if isinstance(a, list):
+        assert isinstance(b, list)
+        return a + b
+    if isinstance(a, dict):
+        assert isinstance(b, dict)
+        if not b:
+            return a
+        result = dict(a)
+        for (k, v) in b.iteritems():
+            if k in result:
+                result[k] = deep_merged(result[k], v)
+            else:
+                result[k] = v
+        return result
+    return b
+
+
 def get_valgrind_args(testdir, name, preamble, v):
     """
     Build a command line for running valgrind.
@@ -1145,17 +1180,21 @@ def get_system_type(remote, distro=False, version=False):
     If neither, return 'deb' or 'rpm' if distro is known to be one of those
     Finally, if unknown, return the unfiltered distro (from lsb_release -is)
     """
-    r = remote.run(
-        args=[
-            'sudo', 'lsb_release', '-is',
-        ],
-        stdout=StringIO(),
-    )
-    system_value = r.stdout.getvalue().strip()
-    log.debug("System to be installed: %s" % system_value)
+    facts = remote.facts
+    system_value = facts.get('lsb_id')
     if version:
-        v = remote.run(args=['sudo', 'lsb_release', '-rs'], stdout=StringIO())
-        version = v.stdout.getvalue().strip()
+        version = facts.get('lsb_version')
+    if system_value is None or version is None:
+        # lsb_release failed when the facts were gathered; try again, and
+        # fail loudly this time
+        commands = [['sudo', 'lsb_release', '-is']]
+        if version is None:
+            commands.append(['sudo', 'lsb_release', '-rs'])
+        results = remote.run_batch(commands)
+        system_value = results[0].stdout.strip()
+        if version is None:
+            version = results[1].stdout.strip()
+    log.debug("System to be installed: %s" % system_value)
     if distro and version:
         return system_value.lower(), version
     if distro:
@@ -2,7 +2,17 @@
 Cluster definition
 part of context, Cluster is used to save connection information.
 """
+import logging
+import sys
+import time
+from cStringIO import StringIO
+
 import teuthology.misc
+from ..exceptions import CommandFailedError
+from ..parallel import parallel
+from .run import quote
+
+log = logging.getLogger(__name__)
 
 
 class Cluster(object):
@@ -63,6 +73,31 @@ class Cluster(object):
         remotes = sorted(self.remotes.iterkeys(), key=lambda rem: rem.name)
         return [remote.run(**kwargs) for remote in remotes]
 
+    def run_parallel(self, max_concurrency=None, **kwargs):
+        """
+        Run a command on all the nodes in this cluster at once, or on at
+        most max_concurrency of them at a time, and wait for it to finish
+        everywhere.
+
+        A failure on some of the nodes doesn't stop the command on the
+        others, and doesn't raise an exception; check the result's ok or
+        failed attributes, or call its raise_for_status() method.
+
+        Takes the same arguments as `Remote.run`, except for check_status
+        and wait. Unless stdout or stderr are given, they are captured and
+        made available in the result.
+
+        Returns a `ClusterRunResult`.
+        """
+        assert 'wait' not in kwargs and 'check_status' not in kwargs, \
+            "run_parallel() always waits, and never checks the status"
+        remotes = sorted(self.remotes.iterkeys(), key=lambda rem: rem.name)
+        results = [RunResult(remote) for remote in remotes]
+        with parallel(max_concurrency=max_concurrency) as p:
+            for result in results:
+                p.spawn(result.run, **kwargs)
+        return ClusterRunResult(quote(kwargs.get('args', '')), results)
+
     def write_file(self, file_name, content, sudo=False, perms=None, owner=None):
         """
         Write text to a file on each node.
@@ -133,3 +168,119 @@ class Cluster(object):
             if remote not in matches.remotes:
                 c.add(remote, has_roles)
         return c
+
+
+class RunResult(object):
+    """
+    The outcome of running a command on one remote, for
+    `Cluster.run_parallel`.
+
+    exitstatus is None if the command died from a signal, the connection
+    was lost, or it could not be run at all; in the last case, exception is
+    set. stdout and stderr are strings, unless the caller passed its own.
+    """
+    def __init__(self, remote):
+        self.remote = remote
+        self.exitstatus = None
+        self.stdout = None
+        self.stderr = None
+        self.start_time = None
+        self.end_time = None
+        self.exception = None
+        self._exc_info = None
+
+    def run(self, **kwargs):
+        kwargs.setdefault('stdout', StringIO())
+        kwargs.setdefault('stderr', StringIO())
+        self.start_time = time.time()
+        try:
+            proc = self.remote.run(check_status=False, **kwargs)
+            self.exitstatus = proc.exitstatus
+            self.stdout = proc.stdout
+            self.stderr = proc.stderr
+            if hasattr(self.stdout, 'getvalue'):
+                self.stdout = self.stdout.getvalue()
+            if hasattr(self.stderr, 'getvalue'):
+                self.stderr = self.stderr.getvalue()
+        except Exception as e:
+            log.exception("Could not run command on %s", self.remote.name)
+            self.exception = e
+            self._exc_info = sys.exc_info()
+        finally:
+            self.end_time = time.time()
+
+    @property
+    def duration(self):
+        """
+        How long the command ran for, in seconds
+        """
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    @property
+    def ok(self):
+        return self.exception is None and self.exitstatus == 0
+
+    def raise_for_status(self, command):
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        if not self.ok:
+            raise CommandFailedError(command=command,
+                                     exitstatus=self.exitstatus,
+                                     node=self.remote.shortname)
+
+    def __repr__(self):
+        return '{classname}(remote={remote!r}, exitstatus={status!r})'.format(
+            classname=self.__class__.__name__,
+            remote=self.remote,
+            status=self.exitstatus,
+            )
+
+
+class ClusterRunResult(object):
+    """
+    The outcome of `Cluster.run_parallel`: a `RunResult` for each remote, in
+    name order. Iterating over it yields the RunResults; indexing it with a
+    remote gets that remote's.
+    """
+    def __init__(self, command, results):
+        self.command = command
+        self.results = results
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, remote):
+        for result in self.results:
+            if result.remote is remote:
+                return result
+        raise KeyError(remote)
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def raise_for_status(self):
+        """
+        If the command failed anywhere, raise the error from the first
+        remote, in name order, that it failed on. The others are logged.
+        """
+        failed = self.failed
+        for result in failed[1:]:
+            log.error("Command %r failed on %s with status %r",
+                      self.command, result.remote.shortname,
+                      result.exitstatus)
+        if failed:
+            failed[0].raise_for_status(self.command)
@@ -2,9 +2,11 @@
 Connection utilities
 """
 import base64
+import gevent
 import paramiko
 import os
 import logging
+import threading
 
 from ..config import config
 from ..contextutil import safe_while
@@ -37,6 +39,31 @@ def create_key(keytype, key):
         raise ValueError('keytype must be ssh-rsa or ssh-dsa')
 
 
+_ssh_config_cache = dict()
+
+
+def get_ssh_config(path="~/.ssh/config"):
+    """
+    Parse the ssh config file at path. It is only parsed again if it has
+    changed since the last call.
+
+    :returns: A paramiko.SSHConfig, or None if there is no such file
+    """
+    path = os.path.expanduser(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        _ssh_config_cache.pop(path, None)
+        return None
+    cached = _ssh_config_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        ssh_config = paramiko.SSHConfig()
+        with open(path) as f:
+            ssh_config.parse(f)
+        cached = _ssh_config_cache[path] = (mtime, ssh_config)
+    return cached[1]
+
+
 def connect(user_at_host, host_key=None, keep_alive=False, timeout=60,
             _SSHClient=None, _create_key=None):
     """
@@ -77,10 +104,8 @@ def connect(user_at_host, host_key=None, keep_alive=False, timeout=60,
         timeout=timeout
     )
 
-    ssh_config_path = os.path.expanduser("~/.ssh/config")
-    if os.path.exists(ssh_config_path):
-        ssh_config = paramiko.SSHConfig()
-        ssh_config.parse(open(ssh_config_path))
+    ssh_config = get_ssh_config()
+    if ssh_config is not None:
         opts = ssh_config.lookup(host)
         opts_to_args = {
             'identityfile': 'key_filename',
@@ -106,3 +131,181 @@ def connect(user_at_host, host_key=None, keep_alive=False, timeout=60,
                 log.exception("Error connecting to {host}".format(host=host))
     ssh.get_transport().set_keepalive(keep_alive)
     return ssh
+
+
+def is_active(ssh):
+    """
+    :returns: True if ssh's transport is still up
+    """
+    transport = ssh.get_transport()
+    return transport is not None and transport.is_active()
+
+
+class ConnectionPool(object):
+    """
+    A pool of ssh connections, keyed by user@host, host key and whether
+    keepalives are on.
+
+    A paramiko.SSHClient can run any number of channels - commands, SFTP
+    sessions - over its one transport, so one connection per host is all we
+    need. A connection is handed out again for as long as its transport is
+    active; one that has gone away is transparently replaced.
+
+    The pool counts the users of each connection it hands out: a connection
+    is only closed once the last of them releases or discards it, so one
+    user reconnecting doesn't pull the connection out from under the others.
+
+    The counters in stats are: 'hits', the connections that were reused;
+    'misses', the hosts we connected to for the first time; 'reconnects',
+    the connections that had to be re-established; and 'dead', the
+    connections the health check found to be gone.
+    """
+    def __init__(self, health_check_interval=60, _connect=None):
+        """
+        :param health_check_interval: How often, in seconds, to check on
+                                      the pooled connections in the
+                                      background. None disables the check.
+        :param _connect:              The function that opens a connection;
+                                      defaults to connect()
+        """
+        self.health_check_interval = health_check_interval
+        self._connect = _connect
+        self._clients = dict()
+        self._users = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+        self._health_check = None
+        self.stats = dict(hits=0, misses=0, reconnects=0, dead=0)
+
+    def _get_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, user_at_host, host_key=None, keep_alive=False, timeout=60):
+        """
+        Get a connection to user_at_host, connecting if we don't already
+        have an active one. The arguments are the same as connect()'s;
+        timeout only applies if a new connection is made.
+
+        Each call must be matched by a call to release() or discard().
+        """
+        key = (user_at_host, host_key, keep_alive)
+        # Only one connection attempt per host at a time, but don't hold up
+        # connections to other hosts.
+        with self._get_lock(key):
+            ssh = self._clients.get(key)
+            if ssh is not None:
+                if is_active(ssh):
+                    self.stats['hits'] += 1
+                    self._add_user(ssh)
+                    return ssh
+                ssh.close()
+            if key in self._clients:
+                self.stats['reconnects'] += 1
+            else:
+                self.stats['misses'] += 1
+            self._clients[key] = None
+            _connect = self._connect or connect
+            ssh = _connect(user_at_host, host_key=host_key,
+                           keep_alive=keep_alive, timeout=timeout)
+            self._clients[key] = ssh
+            self._add_user(ssh)
+        self.start_health_check()
+        return ssh
+
+    def _add_user(self, ssh):
+        self._users[ssh] = self._users.get(ssh, 0) + 1
+
+    def _keys_for(self, ssh):
+        return [key for (key, client) in self._clients.items()
+                if client is ssh]
+
+    def discard(self, ssh):
+        """
+        Stop handing ssh out, so that the next get() for its host
+        reconnects, and release() it. It is closed once no one else is using
+        it.
+        """
+        for key in self._keys_for(ssh):
+            self._clients[key] = None
+        self.release(ssh)
+
+    def release(self, ssh):
+        """
+        Called when a user of ssh no longer needs it. Once it has no users
+        left, a pooled connection is kept open for the next get(); any other
+        connection is closed.
+        """
+        users = self._users.pop(ssh, 0) - 1
+        if users > 0:
+            self._users[ssh] = users
+        elif not self._keys_for(ssh):
+            ssh.close()
+
+    def is_stale(self, ssh):
+        """
+        Whether ssh was handed out by this pool and has since gone away.
+        """
+        return ssh in self._users and not is_active(ssh)
+
+    def check(self):
+        """
+        Check each pooled connection's transport, closing and forgetting the
+        ones that have gone away.
+
+        :returns: The number of connections that were found to be dead
+        """
+        dead = 0
+        for (key, ssh) in self._clients.items():
+            if ssh is None:
+                continue
+            try:
+                if is_active(ssh):
+                    # Send a packet that the server ignores, so that a peer
+                    # that went away is noticed now rather than mid-command
+                    ssh.get_transport().send_ignore()
+                    continue
+            except Exception:
+                log.debug("Connection to %s failed its health check",
+                          key[0], exc_info=True)
+            if self._clients.get(key) is ssh:
+                self._clients[key] = None
+            ssh.close()
+            dead += 1
+        self.stats['dead'] += dead
+        return dead
+
+    def _check_forever(self):
+        while True:
+            gevent.sleep(self.health_check_interval)
+            self.check()
+
+    def start_health_check(self):
+        """
+        Start checking on the pooled connections in the background, every
+        health_check_interval seconds. Does nothing if the check is already
+        running or health_check_interval is None.
+        """
+        if not self.health_check_interval or self._health_check is not None:
+            return
+        self._health_check = gevent.spawn(self._check_forever)
+
+    def stop_health_check(self):
+        if self._health_check is not None:
+            self._health_check.kill()
+            self._health_check = None
+
+    def close_all(self):
+        """
+        Close every pooled connection, and stop the health check.
+        """
+        self.stop_health_check()
+        for (key, ssh) in self._clients.items():
+            if ssh is not None:
+                ssh.close()
+        self._clients.clear()
+        self._users.clear()
+
+
+# The process-wide connection pool
+pool = ConnectionPool()
@@ -5,7 +5,11 @@ from . import run
 from .opsys import OS
 import connection
 from teuthology import misc
+from teuthology.config import config
+from teuthology.exceptions import CommandFailedError
+import contextlib
 import time
+import paramiko
 import pexpect
 import re
 import logging
@@ -13,16 +17,58 @@ from cStringIO import StringIO
 from teuthology import lockstatus as ls
 import os
 import pwd
+import shutil
+import tarfile
 import tempfile
+import uuid
 
 try:
     import libvirt
 except ImportError:
     libvirt = None
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 log = logging.getLogger(__name__)
 
 
+class _RateLimitedReader(object):
+    """
+    Wraps a file-like object, sleeping as needed to keep reads from it under
+    rate bytes per second on average.
+    """
+    def __init__(self, fileobj, rate):
+        self.fileobj = fileobj
+        self.rate = float(rate)
+        self.bytes_read = 0
+        self.start_time = time.time()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        ahead = self.bytes_read / self.rate - (time.time() - self.start_time)
+        if ahead > 0:
+            time.sleep(ahead)
+        return data
+
+
+def _zstd_reader(fileobj):
+    return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+# The kinds of compression Remote.tar_stream() supports. For each: the
+# arguments that make tar compress its output, the tarfile mode to read it
+# with, and, if tarfile can't decompress it itself, a function that wraps the
+# stream to do so.
+tar_compressions = {
+    'none': ([], 'r|', None),
+    'gzip': (['--gzip'], 'r|gz', None),
+    'zstd': (['--use-compress-program=zstd'], 'r|', _zstd_reader),
+}
+
+
 class Remote(object):
 
     """
@@ -52,6 +98,9 @@ class Remote(object):
         self.keep_alive = keep_alive
         self.console = console
         self.ssh = ssh
+        self._sftp = None
+        self._sftp_ssh = None
+        self._facts = None
 
     def connect(self, timeout=None):
         args = dict(user_at_host=self.name, host_key=self._host_key,
@@ -59,7 +108,10 @@ class Remote(object):
         if timeout:
             args['timeout'] = timeout
 
-        self.ssh = connection.connect(**args)
+        old_ssh = self.ssh
+        self.ssh = connection.pool.get(**args)
+        if old_ssh is not None:
+            connection.pool.release(old_ssh)
         return self.ssh
 
     def reconnect(self, timeout=None):
@@ -67,8 +119,10 @@ class Remote(object):
         Attempts to re-establish connection. Returns True for success; False
         for failure.
         """
+        self._close_sftp()
         if self.ssh is not None:
-            self.ssh.close()
+            connection.pool.discard(self.ssh)
+            self.ssh = None
         if not timeout:
             return self._reconnect(timeout=timeout)
         start_time = time.time()
@@ -151,12 +205,61 @@ class Remote(object):
 
         TODO refactor to move run.run here?
         """
-        if self.ssh is None:
+        if self.ssh is None or connection.pool.is_stale(self.ssh):
             self.reconnect()
         r = self._runner(client=self.ssh, name=self.shortname, **kwargs)
         r.remote = self
         return r
 
+    def run_batch(self, commands, check_status=True):
+        """
+        Run several short commands, one after the other, over a single SSH
+        channel rather than one each. Each command runs in its own subshell
+        with stdin from /dev/null, so a cd or an exit in one doesn't affect
+        the others.
+
+        :param commands:     A list of commands; each may be a string or a
+                             list of args, as for `run`
+        :param check_status: If True, stop at the first command that fails,
+                             and raise CommandFailedError for it. If False,
+                             run all of them regardless.
+        :returns:            A list of `CommandResult`, one per command that
+                             was run
+        """
+        if not commands:
+            return []
+        marker = 'teuthology-batch-' + uuid.uuid4().hex
+        script = []
+        for (i, command) in enumerate(commands):
+            script.append(
+                "( {cmd} ) </dev/null; s=$?; "
+                "printf '\\n{marker} {i} %d\\n' $s; "
+                "printf '\\n{marker} {i}\\n' >&2".format(
+                    cmd=run.quote(command), marker=marker, i=i))
+            if check_status:
+                script.append('[ $s -eq 0 ] || exit 0')
+        proc = self.run(args='\n'.join(script), stdout=StringIO(),
+                        stderr=StringIO())
+        stdouts = re.split('\n{marker} \\d+ (-?\\d+)\n'.format(marker=marker),
+                           proc.stdout.getvalue())
+        stderrs = re.split('\n{marker} \\d+\n'.format(marker=marker),
+                           proc.stderr.getvalue())
+        results = []
+        for (i, status) in enumerate(stdouts[1::2]):
+            results.append(CommandResult(
+                args=commands[i],
+                exitstatus=int(status),
+                stdout=stdouts[2 * i],
+                stderr=stderrs[i],
+            ))
+        if check_status:
+            for result in results:
+                if result.exitstatus != 0:
+                    raise CommandFailedError(
+                        command=run.quote(result.args),
+                        exitstatus=result.exitstatus, node=self.shortname)
+        return results
+
     def mktemp(self):
         """
         Make a remote temporary file
@@ -195,29 +298,87 @@ class Remote(object):
             args=args,
             )
 
+    # How much we read from or write to an SFTPFile at a time
+    _sftp_chunk_size = 1024 * 1024
+
+    @property
+    def sftp(self):
+        """
+        A paramiko.SFTPClient, opened on first use and then reused until we
+        reconnect.
+
+        If config.sftp_window_size is set, it is used as the SSH window size
+        of the SFTP channel. A bigger window lets more data be in flight at
+        once, which helps on links with a high bandwidth-delay product.
+        """
+        if self._sftp is not None:
+            if self._sftp_ssh is self.ssh and \
+                    not self._sftp.get_channel().closed:
+                return self._sftp
+            self._close_sftp()
+        if self.ssh is None or connection.pool.is_stale(self.ssh):
+            self.reconnect()
+        if config.sftp_window_size:
+            self._sftp = paramiko.SFTPClient.from_transport(
+                self.ssh.get_transport(),
+                window_size=config.sftp_window_size)
+        else:
+            self._sftp = self.ssh.open_sftp()
+        self._sftp_ssh = self.ssh
+        return self._sftp
+
+    def _close_sftp(self):
+        if self._sftp is None:
+            return
+        try:
+            self._sftp.close()
+        except Exception:
+            log.debug("Error closing SFTP session to %s", self.name,
+                      exc_info=True)
+        self._sftp = None
+        self._sftp_ssh = None
+
     def _sftp_put_file(self, local_path, remote_path):
         """
         Use the paramiko.SFTPClient to put a file. Returns the remote filename.
-        """
-        sftp = self.ssh.open_sftp()
-        sftp.put(local_path, remote_path)
+
+        Writes are pipelined: we don't wait for the server to acknowledge
+        each one before sending the next.
+        """
+        with open(local_path, 'rb') as local_file:
+            remote_file = self.sftp.open(remote_path, 'wb')
+            try:
+                remote_file.set_pipelined(True)
+                shutil.copyfileobj(local_file, remote_file,
+                                   self._sftp_chunk_size)
+            finally:
+                remote_file.close()
         return
 
     def _sftp_get_file(self, remote_path, local_path):
         """
         Use the paramiko.SFTPClient to get a file. Returns the local filename.
+
+        The whole file is requested up front, so that reads don't each wait
+        for a round trip.
         """
-        sftp = self.ssh.open_sftp()
-        sftp.get(remote_path, local_path)
+        remote_file = self._sftp_open_file(remote_path)
+        try:
+            with open(local_path, 'wb') as local_file:
+                shutil.copyfileobj(remote_file, local_file,
+                                   self._sftp_chunk_size)
+        finally:
+            remote_file.close()
         return local_path
 
     def _sftp_open_file(self, remote_path):
         """
         Use the paramiko.SFTPClient to open a file. Returns a
-        paramiko.SFTPFile object.
+        paramiko.SFTPFile object, which will prefetch the file's contents.
         """
-        sftp = self.ssh.open_sftp()
-        return sftp.open(remote_path)
+        remote_file = self.sftp.open(remote_path, 'rb')
+        remote_file.prefetch()
+        return remote_file
 
     def remove(self, path):
         self.run(args=['rm', '-fr', path])
@@ -249,14 +410,10 @@ class Remote(object):
         if sudo:
             orig_path = path
             path = self.mktemp()
-            args = [
-                'sudo',
-                'cp',
-                orig_path,
-                path,
-                ]
-            self.run(args=args)
-            self.chmod(path, '0666')
+            self.run_batch([
+                ['sudo', 'cp', orig_path, path],
+                ['sudo', 'chmod', '0666', path],
+            ])
 
         if dest_dir == '/tmp':
             # If we're storing in /tmp, generate a unique filename
@@ -274,55 +431,163 @@ class Remote(object):
 
     def get_tar(self, path, to_path, sudo=False):
         """
-        Tar a remote directory and copy it locally
+        Tar a remote directory and copy it locally, as a gzipped tarball
         """
-        remote_temp_path = self.mktemp()
         args = []
         if sudo:
             args.append('sudo')
         args.extend([
             'tar',
             'cz',
-            '-f', remote_temp_path,
+            '-f', '-',
             '-C', path,
             '--',
             '.',
             ])
-        self.run(args=args)
+        with open(to_path, 'wb') as to_file:
+            self.run(args=args, stdout=to_file)
+
+    @contextlib.contextmanager
+    def tar_stream(self, path, sudo=False, compression='gzip',
+                   bandwidth_limit=None):
+        """
+        Tar a remote directory, and read the archive as tar writes it to
+        its stdout. Nothing is written to disk on the remote end.
+
+        Use as a context manager::
+
+            with remote.tar_stream('/var/log/ceph') as tar:
+                for tarinfo in tar:
+                    ...
+
+        :param path:        The directory to archive
+        :param sudo:        Use sudo to run tar
+        :param compression: One of the keys in tar_compressions. zstd
+                            needs the zstandard module; without it, gzip is
+                            used instead.
+        :param bandwidth_limit: If set, read the archive at no more than
+                                this many bytes per second
+        :returns:           A tarfile.TarFile in stream mode; its members
+                            must be read in order
+        """
+        if compression == 'zstd' and zstandard is None:
+            log.warning("The zstandard module is not installed; using gzip "
+                        "instead of zstd")
+            compression = 'gzip'
+        (tar_args, mode, wrap) = tar_compressions[compression]
+        args = []
         if sudo:
-            self.chmod(remote_temp_path, '0666')
-        self._sftp_get_file(remote_temp_path, to_path)
-        self.remove(remote_temp_path)
+            args.append('sudo')
+        args.extend(['tar', 'c'])
+        args.extend(tar_args)
+        args.extend([
+            '-f', '-',
+            '-C', path,
+            '--',
+            '.',
+            ])
+        proc = self.run(args=args, stdout=run.PIPE, wait=False)
+        stream = proc.stdout
+        if bandwidth_limit:
+            stream = _RateLimitedReader(stream, bandwidth_limit)
+        if wrap is not None:
+            stream = wrap(stream)
+        try:
+            try:
+                tar = tarfile.open(mode=mode, fileobj=stream)
+            except tarfile.ReadError:
+                # tar exited before writing an archive, e.g. because path
+                # doesn't exist; if it failed, raise that instead
+                proc.wait()
+                raise
+            try:
+                yield tar
+                # Read what tar didn't need, e.g. the padding after the end
+                # of the archive, so that the remote command can exit
+                while proc.stdout.read(self._sftp_chunk_size):
+                    pass
+            finally:
+                tar.close()
+        except Exception:
+            # Don't leave tar blocked writing to a channel nobody reads
+            proc.stdout.channel.close()
+            raise
+        proc.wait()
+
+    # The commands gather_facts() runs, and the names of the facts they find
+    _fact_commands = [
+        ('arch', ['uname', '-m']),
+        ('python_distro', [
+            'python', '-c',
+            'import platform; print platform.linux_distribution()']),
+        ('os_release', ['cat', '/etc/os-release']),
+        ('lsb_release', ['lsb_release', '-a']),
+        ('lsb_id', ['lsb_release', '-is']),
+        ('lsb_version', ['lsb_release', '-rs']),
+    ]
+
+    def gather_facts(self):
+        """
+        Find out about the remote's OS and architecture, running all of the
+        commands needed in one go.
+
+        :returns: A dict of facts, keyed by the names in _fact_commands. A
+                  fact is None if its command failed. The host key is
+                  included as 'host_key'.
+        """
+        results = self.run_batch(
+            [args for (name, args) in self._fact_commands],
+            check_status=False)
+        facts = dict(host_key=self.host_key)
+        for ((name, args), result) in zip(self._fact_commands, results):
+            if result.exitstatus == 0:
+                facts[name] = result.stdout.strip()
+            else:
+                facts[name] = None
+        self._facts = facts
+        return facts
+
+    @property
+    def facts(self):
+        """
+        The remote's facts, as returned by gather_facts(). They are gathered
+        the first time they are needed, unless they were set already, e.g.
+        from a job's archive.
+        """
+        if self._facts is None:
+            self.gather_facts()
+        return self._facts
+
+    @facts.setter
+    def facts(self, facts):
+        self._facts = facts
 
     @property
     def os(self):
         if not hasattr(self, '_os'):
-            proc = self.run(
-                args=[
-                    'python', '-c',
-                    'import platform; print platform.linux_distribution()'],
-                stdout=StringIO(), stderr=StringIO(), check_status=False)
-            if proc.exitstatus == 0:
-                self._os = OS.from_python(proc.stdout.getvalue().strip())
-                return self._os
-
-            proc = self.run(args=['cat', '/etc/os-release'], stdout=StringIO(),
-                            stderr=StringIO(), check_status=False)
-            if proc.exitstatus == 0:
-                self._os = OS.from_os_release(proc.stdout.getvalue().strip())
-                return self._os
-
-            proc = self.run(args=['lsb_release', '-a'], stdout=StringIO(),
-                            stderr=StringIO())
-            self._os = OS.from_lsb_release(proc.stdout.getvalue().strip())
+            facts = self.facts
+            if facts.get('python_distro'):
+                self._os = OS.from_python(facts['python_distro'])
+            elif facts.get('os_release'):
+                self._os = OS.from_os_release(facts['os_release'])
+            elif facts.get('lsb_release'):
+                self._os = OS.from_lsb_release(facts['lsb_release'])
+            else:
+                # Try again, and fail loudly this time
+                proc = self.run(args=['lsb_release', '-a'], stdout=StringIO(),
+                                stderr=StringIO())
+                self._os = OS.from_lsb_release(
+                    proc.stdout.getvalue().strip())
         return self._os
 
     @property
     def arch(self):
         if not hasattr(self, '_arch'):
-            proc = self.run(args=['uname', '-m'], stdout=StringIO())
-            proc.wait()
-            self._arch = proc.stdout.getvalue().strip()
+            self._arch = self.facts.get('arch')
+            if not self._arch:
+                # Try again, and fail loudly this time
+                proc = self.run(args=['uname', '-m'], stdout=StringIO())
+                self._arch = proc.stdout.getvalue().strip()
         return self._arch
 
     @property
@@ -346,8 +611,27 @@ class Remote(object):
         return node
 
     def __del__(self):
+        self._close_sftp()
         if self.ssh is not None:
-            self.ssh.close()
+            connection.pool.release(self.ssh)
+
+
+class CommandResult(object):
+    """
+    The outcome of one of the commands run by `Remote.run_batch`
+    """
+    def __init__(self, args, exitstatus, stdout, stderr):
+        self.args = args
+        self.exitstatus = exitstatus
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __repr__(self):
+        return '{classname}(args={args!r}, exitstatus={status!r})'.format(
+            classname=self.__class__.__name__,
+            args=self.args,
+            status=self.exitstatus,
+            )
 
 
 def getShortName(name):
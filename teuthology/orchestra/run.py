@@ -10,8 +10,10 @@ import socket
 import pipes
 import logging
 import shutil
+import time
+import yaml
 
-from ..contextutil import safe_while
+from ..contextutil import MaxWhileTries
 from ..exceptions import (CommandCrashedError, CommandFailedError,
                           ConnectionLostError)
 
@@ -31,6 +33,8 @@ class RemoteProcess(object):
         # for orchestra.remote.Remote to place a backreference
         'remote',
         'label',
+        # see CommandTimings
+        'start_time', 'first_byte_time', 'end_time', 'bytes_in', 'bytes_out',
         ]
 
     def __init__(self, client, args, check_status=True, hostname=None, label=None):
@@ -65,6 +69,8 @@ class RemoteProcess(object):
         self.greenlets = []
         self.stdin, self.stdout, self.stderr = (None, None, None)
         self.returncode = self.exitstatus = None
+        self.start_time = self.first_byte_time = self.end_time = None
+        self.bytes_in = self.bytes_out = 0
 
     def execute(self):
         """
@@ -76,11 +82,20 @@ class RemoteProcess(object):
         log.getChild(self.hostname).info(u"{prefix} {cmd!r}".format(
             cmd=self.command, prefix=prefix))
 
+        self.start_time = time.time()
         (self._stdin_buf, self._stdout_buf, self._stderr_buf) = \
             self.client.exec_command(self.command)
         (self.stdin, self.stdout, self.stderr) = \
             (self._stdin_buf, self._stdout_buf, self._stderr_buf)
 
+    def _sent(self, data):
+        self.bytes_in += len(data)
+
+    def _received(self, data):
+        if self.first_byte_time is None:
+            self.first_byte_time = time.time()
+        self.bytes_out += len(data)
+
     def add_greenlet(self, greenlet):
         self.greenlets.append(greenlet)
 
@@ -95,6 +110,10 @@ class RemoteProcess(object):
 
         status = self._get_exitstatus()
         self.exitstatus = self.returncode = status
+        if self.end_time is None:
+            self.end_time = time.time()
+            if timings is not None:
+                timings.add(self)
         if self.check_status:
             if status is None:
                 # command either died due to a signal, or the connection
@@ -129,6 +148,30 @@ class RemoteProcess(object):
     def finished(self):
         return self._stdout_buf.channel.exit_status_ready()
 
+    # How often to check on a process whose channel has no status_event
+    _poll_interval = 0.1
+
+    def wait_for_exit(self, timeout=None):
+        """
+        Block until the remote process exits, or until timeout seconds have
+        passed. Unlike wait(), this doesn't check the exit status.
+
+        :returns: True if the process has exited
+        """
+        channel = self._stdout_buf.channel
+        # paramiko sets this event as soon as it receives the exit status
+        event = getattr(channel, 'status_event', None)
+        if event is not None:
+            event.wait(timeout)
+            return event.is_set()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.finished:
+            if timeout is not None and time.time() >= deadline:
+                return False
+            gevent.sleep(self._poll_interval)
+        return True
+
     def poll(self):
         """
         :returns: self.returncode if the process is finished; else None
@@ -181,51 +224,110 @@ def quote(args):
     return ' '.join(_quote(args))
 
 
-def copy_to_log(f, logger, loglevel=logging.INFO):
+# How much output to read at a time
+_chunk_size = 64 * 1024
+
+
+def read_chunks(f, size=_chunk_size, on_data=None):
     """
-    Interface to older xreadlines api.
+    Read f until EOF, yielding whatever data is available, up to size bytes
+    at a time. If on_data is given, it is called with each chunk, too.
     """
-    # Work-around for http://tracker.ceph.com/issues/8313
     if isinstance(f, ChannelFile):
-        f._flags += ChannelFile.FLAG_BINARY
+        # ChannelFile.read() waits until it has all size bytes; we want
+        # output as soon as it arrives. _read() returns what the channel
+        # has, from stdout or stderr as appropriate.
+        read = f._read
+    else:
+        read = f.read
+    while True:
+        data = read(size)
+        if not data:
+            break
+        if on_data is not None:
+            on_data(data)
+        yield data
 
-    # i can't seem to get fudge to fake an iterable, so using this old
-    # api for now
-    for line in f.xreadlines():
-        line = line.rstrip()
-        # Second part of work-around for http://tracker.ceph.com/issues/8313
-        try:
-            line = unicode(line, 'utf-8', 'replace').encode('utf-8')
+
+def _log_lines(lines, logger, loglevel):
+    """
+    Log each of lines as its own record.
+    """
+    if not isinstance(logger, logging.Logger):
+        for line in lines:
             logger.log(loglevel, line)
-        except (UnicodeDecodeError, UnicodeEncodeError):
-            logger.exception("Encountered unprintable line in command output")
+        return
+    if not logger.isEnabledFor(loglevel):
+        return
+    # Logger.log() walks the stack to find out where it was called from
+    # for every record; we already know.
+    for line in lines:
+        logger.handle(logger.makeRecord(
+            logger.name, loglevel, __file__, 0, line, None, None,
+            'copy_to_log'))
+
+
+def copy_to_log(f, logger, loglevel=logging.INFO, on_data=None):
+    """
+    Log each line read from f.
 
+    Output is read and decoded in large chunks, rather than a line at a
+    time. Lines are decoded as UTF-8; anything else is replaced.
+    """
+    partial = ''
+    for data in read_chunks(f, on_data=on_data):
+        data = partial + data
+        end = data.rfind('\n') + 1
+        partial = data[end:]
+        if end:
+            _log_chunk(data[:end - 1], logger, loglevel)
+    if partial:
+        _log_chunk(partial, logger, loglevel)
+
+
+def _log_chunk(chunk, logger, loglevel):
+    """
+    Log each of the lines in chunk, which must not end in the middle of a
+    multi-byte character.
+    """
+    # Work-around for http://tracker.ceph.com/issues/8313
+    try:
+        chunk = unicode(chunk, 'utf-8', 'replace').encode('utf-8')
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        logger.exception("Encountered unprintable line in command output")
+        return
+    _log_lines([line.rstrip() for line in chunk.split('\n')], logger,
+               loglevel)
 
-def copy_and_close(src, fdst):
+
+def copy_and_close(src, fdst, on_data=None):
     """
     copyfileobj call wrapper.
     """
     if src is not None:
         if isinstance(src, basestring):
             src = StringIO(src)
-        shutil.copyfileobj(src, fdst)
+        if on_data is None:
+            shutil.copyfileobj(src, fdst, _chunk_size)
+        else:
+            for data in read_chunks(src, on_data=on_data):
+                fdst.write(data)
     fdst.close()
 
 
-def copy_file_to(f, dst):
+def copy_file_to(f, dst, on_data=None):
     """
     Copy file
     :param f: file to be copied.
     :param dst: destination
-    :param host: original host location
+    :param on_data: called with each chunk of data read from f
     """
     if hasattr(dst, 'log'):
         # looks like a Logger to me; not using isinstance to make life
         # easier for unit tests
-        handler = copy_to_log
-    else:
-        handler = shutil.copyfileobj
-    return handler(f, dst)
+        return copy_to_log(f, dst, on_data=on_data)
+    for data in read_chunks(f, on_data=on_data):
+        dst.write(data)
 
 
 def spawn_asyncresult(fn, *args, **kwargs):
@@ -313,7 +415,9 @@ def run(
     :param stdout: What to do with standard output. Either a file-like object,
                    a `logging.Logger`, `PIPE`, or `None` for copying to default
                    log. `PIPE` means caller is responsible for reading, or
-                   command may never exit.
+                   command may never exit. Output is written to a file-like
+                   object as is, without going through `logging`, which is
+                   much cheaper for commands with a lot of output.
     :param stderr: What to do with standard error. See `stdout`.
     :param logger: If logging, write stdout/stderr to "out" and "err" children
                    of this logger. Defaults to logger named after this module.
@@ -340,9 +444,15 @@ def run(
 
     r.stdin = KludgeFile(wrapped=r.stdin)
 
+    # Only count bytes when something will look at the counts
+    on_sent = on_received = None
+    if timings is not None:
+        on_sent = r._sent
+        on_received = r._received
+
     g_in = None
     if stdin is not PIPE:
-        g_in = gevent.spawn(copy_and_close, stdin, r.stdin)
+        g_in = gevent.spawn(copy_and_close, stdin, r.stdin, on_sent)
         r.add_greenlet(g_in)
         r.stdin = None
     else:
@@ -356,7 +466,7 @@ def run(
     if stderr is not PIPE:
         if stderr is None:
             stderr = logger.getChild(name).getChild('stderr')
-        g_err = gevent.spawn(copy_file_to, r.stderr, stderr)
+        g_err = gevent.spawn(copy_file_to, r.stderr, stderr, on_received)
         r.add_greenlet(g_err)
         r.stderr = stderr
     else:
@@ -367,7 +477,7 @@ def run(
     if stdout is not PIPE:
         if stdout is None:
             stdout = logger.getChild(name).getChild('stdout')
-        g_out = gevent.spawn(copy_file_to, r.stdout, stdout)
+        g_out = gevent.spawn(copy_file_to, r.stdout, stdout, on_received)
         r.add_greenlet(g_out)
         r.stdout = stdout
     else:
@@ -380,22 +490,78 @@ def run(
     return r
 
 
+class CommandTimings(object):
+    """
+    Totals, per task and per host, of how long remote commands took and how
+    much data they moved. For each, we record:
+
+    commands:        How many commands ran
+    wall_time:       How long they took, in seconds, in total
+    max_wall_time:   How long the slowest one took
+    first_byte_time: The total time between starting a command and the
+                     first output arriving from it, for the commands that
+                     had any output
+    bytes_in:        How many bytes were sent to their stdin
+    bytes_out:       How many bytes were read from their stdout and stderr
+
+    Output read by the caller, through PIPE, isn't counted. Commands are
+    attributed to whichever task was running when they finished; set task
+    as tasks start and stop.
+    """
+    def __init__(self):
+        self.task = None
+        self.totals = dict()
+
+    def add(self, proc):
+        """
+        Add the timings of a RemoteProcess that has finished
+        """
+        totals = self.totals.setdefault(self.task, dict()).setdefault(
+            proc.hostname, dict(commands=0, wall_time=0.0, max_wall_time=0.0,
+                                first_byte_time=0.0, bytes_in=0,
+                                bytes_out=0))
+        totals['commands'] += 1
+        if proc.start_time is not None:
+            wall_time = proc.end_time - proc.start_time
+            totals['wall_time'] += wall_time
+            totals['max_wall_time'] = max(totals['max_wall_time'], wall_time)
+            if proc.first_byte_time is not None:
+                totals['first_byte_time'] += \
+                    proc.first_byte_time - proc.start_time
+        totals['bytes_in'] += proc.bytes_in
+        totals['bytes_out'] += proc.bytes_out
+
+    def save(self, path):
+        """
+        Write the totals to path, as yaml
+        """
+        with file(path, 'w') as f:
+            yaml.safe_dump(self.totals, f, default_flow_style=False)
+
+# Set to a CommandTimings to record the timings of every command that is
+# waited for
+timings = None
+
+
 def wait(processes, timeout=None):
     """
     Wait for all given processes to exit.
 
     Raise if any one of them fails.
 
-    Optionally, timeout after 'timeout' seconds.
+    Optionally, timeout after 'timeout' seconds, raising MaxWhileTries.
+    Returns as soon as the last process exits; processes aren't polled.
     """
     if timeout and timeout > 0:
-        with safe_while(tries=(timeout / 6)) as check_time:
-            not_ready = list(processes)
-            while len(not_ready) > 0:
-                check_time()
-                for proc in list(not_ready):
-                    if proc.finished:
-                        not_ready.remove(proc)
+        deadline = time.time() + timeout
+        for proc in processes:
+            remaining = max(0, deadline - time.time())
+            if not proc.wait_for_exit(timeout=remaining):
+                not_ready = [p for p in processes if not p.finished]
+                raise MaxWhileTries(
+                    "{count} processes had not exited after waiting for "
+                    "{timeout} seconds".format(count=len(not_ready),
+                                               timeout=timeout))
 
     for proc in processes:
         proc.wait()
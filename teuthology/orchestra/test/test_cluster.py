@@ -4,6 +4,7 @@ import pytest
 from mock import patch, Mock
 
 from .. import cluster, remote
+from ...exceptions import CommandFailedError
 
 
 class TestCluster(object):
@@ -238,3 +239,58 @@ class TestWriteFile(object):
     def test_with_sudo(self, m_sudo_write_file):
         self.c.write_file("filename", "content", sudo=True)
         m_sudo_write_file.assert_called_with(self.r1, "filename", "content", owner=None, perms=None)
+
+
+class TestRunParallel(object):
+    def make_remote(self, name, exitstatus=0, exception=None):
+        rem = Mock(shortname=name)
+        rem.name = name
+
+        def run(args, check_status, stdout, stderr):
+            assert check_status is False
+            if exception is not None:
+                raise exception
+            stdout.write('out ' + name)
+            stderr.write('err ' + name)
+            return Mock(exitstatus=exitstatus, stdout=stdout, stderr=stderr)
+        rem.run.side_effect = run
+        return rem
+
+    def test_success(self):
+        r1 = self.make_remote('r1')
+        r2 = self.make_remote('r2')
+        c = cluster.Cluster(remotes=[(r2, ['bar']), (r1, ['foo'])])
+        result = c.run_parallel(args=['echo', 'hi'], max_concurrency=1)
+        assert result.ok
+        assert [res.remote for res in result] == [r1, r2]
+        assert result[r1].exitstatus == 0
+        assert result[r1].stdout == 'out r1'
+        assert result[r2].stderr == 'err r2'
+        assert result[r2].duration >= 0
+        assert result.command == 'echo hi'
+        result.raise_for_status()
+
+    def test_partial_failure(self):
+        r1 = self.make_remote('r1')
+        r2 = self.make_remote('r2', exitstatus=1)
+        r3 = self.make_remote('r3', exception=RuntimeError('oops'))
+        c = cluster.Cluster(remotes=[(r1, ['foo']), (r2, ['bar']),
+                                     (r3, ['baz'])])
+        result = c.run_parallel(args=['false'])
+        assert not result.ok
+        assert [res.remote for res in result.succeeded] == [r1]
+        assert [res.remote for res in result.failed] == [r2, r3]
+        assert result[r2].exitstatus == 1
+        assert isinstance(result[r3].exception, RuntimeError)
+        with pytest.raises(CommandFailedError) as exc:
+            result.raise_for_status()
+        assert exc.value.node == 'r2'
+        assert exc.value.exitstatus == 1
+
+    def test_exception(self):
+        r1 = self.make_remote('r1', exception=RuntimeError('oops'))
+        c = cluster.Cluster(remotes=[(r1, ['foo'])])
+        result = c.run_parallel(args=['true'])
+        assert result[r1].exitstatus is None
+        with pytest.raises(RuntimeError):
+            result.raise_for_status()
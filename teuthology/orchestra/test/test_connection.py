@@ -1,8 +1,10 @@
 import fudge
+from mock import patch, Mock
 
 from teuthology import config
 from .util import assert_raises
 from .. import connection
+from .. import remote
 
 
 class TestConnection(object):
@@ -104,3 +106,164 @@ class TestConnection(object):
             _create_key=create_key,
             )
         assert got is ssh
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+        self.ignored = 0
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        self.ignored += 1
+
+
+class FakeSSH(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+class TestConnectionPool(object):
+    def setup(self):
+        self.connected = []
+        self.pool = connection.ConnectionPool(health_check_interval=None,
+                                              _connect=self.fake_connect)
+
+    def fake_connect(self, user_at_host, **kwargs):
+        ssh = FakeSSH()
+        self.connected.append((user_at_host, ssh))
+        return ssh
+
+    def test_reuse(self):
+        ssh = self.pool.get('jdoe@host1')
+        assert self.pool.get('jdoe@host1') is ssh
+        assert self.pool.get('jdoe@host2') is not ssh
+        assert len(self.connected) == 2
+        assert self.pool.stats == dict(hits=1, misses=2, reconnects=0,
+                                       dead=0)
+
+    def test_reconnect_when_inactive(self):
+        ssh = self.pool.get('jdoe@host1')
+        ssh.transport.active = False
+        new_ssh = self.pool.get('jdoe@host1')
+        assert new_ssh is not ssh
+        assert ssh.closed
+        assert self.pool.stats['reconnects'] == 1
+
+    def test_discard(self):
+        ssh = self.pool.get('jdoe@host1')
+        self.pool.discard(ssh)
+        assert ssh.closed
+        assert self.pool.get('jdoe@host1') is not ssh
+        assert self.pool.stats['reconnects'] == 1
+
+    def test_discard_shared(self):
+        ssh = self.pool.get('jdoe@host1')
+        assert self.pool.get('jdoe@host1') is ssh
+        self.pool.discard(ssh)
+        # Still in use by the other caller
+        assert not ssh.closed
+        assert self.pool.get('jdoe@host1') is not ssh
+        self.pool.release(ssh)
+        assert ssh.closed
+
+    def test_keep_alive_is_part_of_key(self):
+        ssh = self.pool.get('jdoe@host1', keep_alive=True)
+        assert self.pool.get('jdoe@host1', keep_alive=False) is not ssh
+
+    def test_is_stale(self):
+        ssh = self.pool.get('jdoe@host1')
+        assert not self.pool.is_stale(ssh)
+        ssh.transport.active = False
+        assert self.pool.is_stale(ssh)
+        assert not self.pool.is_stale(FakeSSH())
+
+    def test_release(self):
+        ssh = self.pool.get('jdoe@host1')
+        self.pool.release(ssh)
+        assert not ssh.closed
+        other = FakeSSH()
+        self.pool.release(other)
+        assert other.closed
+
+    def test_check(self):
+        ssh1 = self.pool.get('jdoe@host1')
+        ssh2 = self.pool.get('jdoe@host2')
+        ssh2.transport.active = False
+        assert self.pool.check() == 1
+        assert ssh1.transport.ignored == 1
+        assert ssh2.closed
+        assert self.pool.stats['dead'] == 1
+        assert self.pool.get('jdoe@host1') is ssh1
+        assert self.pool.get('jdoe@host2') is not ssh2
+
+    def test_close_all(self):
+        ssh = self.pool.get('jdoe@host1')
+        self.pool.close_all()
+        assert ssh.closed
+        assert self.pool.get('jdoe@host1') is not ssh
+        assert self.pool.stats['misses'] == 2
+
+
+class TestRemotesSharingConnections(object):
+    def setup(self):
+        self.pool = connection.ConnectionPool(health_check_interval=None,
+                                              _connect=self.fake_connect)
+        self.patcher = patch.object(connection, 'pool', self.pool)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def fake_connect(self, user_at_host, **kwargs):
+        return FakeSSH()
+
+    def test_reconnect_leaves_others_alone(self):
+        a = remote.Remote('jdoe@host1')
+        b = remote.Remote('jdoe@host1')
+        a.connect()
+        b.connect()
+        assert a.ssh is b.ssh
+        old_ssh = a.ssh
+        with patch.object(remote.Remote, 'is_online', True):
+            a.reconnect()
+        assert a.ssh is not old_ssh
+        assert b.ssh is old_ssh
+        assert not b.ssh.closed
+        b._runner = Mock()
+        b.run(args=['true'])
+        assert b._runner.call_args[1]['client'] is old_ssh
+
+    def test_run_reconnects_when_stale(self):
+        r = remote.Remote('jdoe@host1')
+        r.connect()
+        old_ssh = r.ssh
+        old_ssh.transport.active = False
+        r._runner = Mock()
+        with patch.object(remote.Remote, 'is_online', True):
+            r.run(args=['true'])
+        assert r.ssh is not old_ssh
+        assert r._runner.call_args[1]['client'] is r.ssh
+
+
+class TestGetSSHConfig(object):
+    def test_missing(self, tmpdir):
+        path = str(tmpdir.join('config'))
+        assert connection.get_ssh_config(path) is None
+
+    def test_parsed_once(self, tmpdir):
+        path = tmpdir.join('config')
+        path.write('Host foo\n  User bar\n')
+        ssh_config = connection.get_ssh_config(str(path))
+        assert ssh_config.lookup('foo')['user'] == 'bar'
+        assert connection.get_ssh_config(str(path)) is ssh_config
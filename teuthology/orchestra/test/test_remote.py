@@ -1,11 +1,16 @@
 import fudge
 import fudge.inspector
-from pytest import skip
+from mock import Mock, patch
+from pytest import raises, skip
 
+import subprocess
+import tarfile
 from cStringIO import StringIO, OutputType
 
 from .. import remote
-from ..run import RemoteProcess
+from teuthology import misc
+from ...exceptions import CommandFailedError
+from ..run import PIPE, RemoteProcess
 
 
 class TestRemote(object):
@@ -93,38 +98,9 @@ class TestRemote(object):
         r._runner = run
         assert r.hostname == 'test_hostname'
 
-    @fudge.with_fakes
     def test_arch(self):
-        fudge.clear_expectations()
-        ssh = fudge.Fake('SSHConnection')
-        ssh.expects('get_transport').returns_fake().expects('getpeername')\
-            .returns(('name', 22))
-        run = fudge.Fake('run')
-        args = [
-            'uname',
-            '-m',
-            ]
-        stdout = StringIO('test_arch')
-        stdout.seek(0)
-        ret = RemoteProcess(
-            client=ssh,
-            args='fakey',
-            )
-        # status = self._stdout_buf.channel.recv_exit_status()
-        ret._stdout_buf = fudge.Fake()
-        ret._stdout_buf.channel = fudge.Fake()
-        ret._stdout_buf.channel.expects('recv_exit_status').returns(0)
-        ret.stdout = stdout
-        r = remote.Remote(name='jdoe@xyzzy.example.com', ssh=ssh)
-        run.expects_call().with_args(
-            client=ssh,
-            args=args,
-            stdout=fudge.inspector.arg.passes_test(
-                lambda v: isinstance(v, OutputType)),
-            name=r.shortname,
-            ).returns(ret)
-        # monkey patch ook ook
-        r._runner = run
+        r = remote.Remote(name='jdoe@xyzzy.example.com', ssh=Mock())
+        r.facts = dict(arch='test_arch')
         assert r.arch == 'test_arch'
 
     @fudge.with_fakes
@@ -137,3 +113,259 @@ class TestRemote(object):
         key.expects('get_base64').returns('test ssh key')
         r = remote.Remote(name='jdoe@xyzzy.example.com', ssh=ssh)
         assert r.host_key == 'key_type test ssh key'
+
+
+class FakeSFTPFile(file):
+    def prefetch(self):
+        self.prefetched = True
+
+    def set_pipelined(self, pipelined=True):
+        self.pipelined = pipelined
+
+
+class FakeSFTPClient(object):
+    """
+    Reads and writes local files
+    """
+    def __init__(self):
+        self.channel = Mock(closed=False)
+        self.opened = []
+
+    def get_channel(self):
+        return self.channel
+
+    def open(self, path, mode='r'):
+        f = FakeSFTPFile(path, mode)
+        self.opened.append(f)
+        return f
+
+    def close(self):
+        self.channel.closed = True
+
+
+class TestRemoteSFTP(object):
+    def setup(self):
+        self.ssh = Mock()
+        self.ssh.open_sftp.side_effect = FakeSFTPClient
+        self.remote = remote.Remote(name='jdoe@xyzzy.example.com',
+                                    ssh=self.ssh)
+
+    def test_get_and_put(self, tmpdir):
+        src = tmpdir.join('src')
+        src.write('x' * 100000)
+        self.remote._sftp_put_file(str(src), str(tmpdir.join('remote')))
+        local_path = self.remote._sftp_get_file(str(tmpdir.join('remote')),
+                                                str(tmpdir.join('dst')))
+        assert open(local_path).read() == 'x' * 100000
+        put_file, get_file = self.remote.sftp.opened
+        assert put_file.pipelined
+        assert get_file.prefetched
+
+    def test_sftp_reused(self):
+        sftp = self.remote.sftp
+        assert self.remote.sftp is sftp
+        assert self.ssh.open_sftp.call_count == 1
+
+    def test_sftp_reopened_when_closed(self):
+        sftp = self.remote.sftp
+        sftp.close()
+        assert self.remote.sftp is not sftp
+        assert self.ssh.open_sftp.call_count == 2
+
+    def test_sftp_reopened_after_reconnect(self):
+        sftp = self.remote.sftp
+        new_ssh = Mock()
+        new_ssh.open_sftp.side_effect = FakeSFTPClient
+        with patch.object(remote.connection.pool, 'get') as m_get:
+            m_get.return_value = new_ssh
+            self.remote.reconnect()
+        assert sftp.channel.closed
+        assert self.remote.sftp is not sftp
+        assert new_ssh.open_sftp.call_count == 1
+
+    def test_window_size(self):
+        transport = self.ssh.get_transport.return_value
+        with patch.dict(remote.config._conf, sftp_window_size=4194304):
+            with patch('paramiko.SFTPClient.from_transport') as m_from:
+                assert self.remote.sftp is m_from.return_value
+        m_from.assert_called_once_with(transport, window_size=4194304)
+
+
+def make_tar(files, mode='w'):
+    buf = StringIO()
+    tar = tarfile.open(mode=mode, fileobj=buf)
+    for (name, data) in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    return buf.getvalue()
+
+
+class TestRemoteTar(object):
+    def setup(self):
+        self.remote = remote.Remote(name='jdoe@xyzzy.example.com',
+                                    ssh=Mock())
+        self.runs = []
+        self.remote._runner = self.fake_run
+
+    def fake_run(self, client, args, stdout=None, wait=True, **kwargs):
+        self.runs.append(args)
+        proc = Mock()
+        if stdout is PIPE:
+            assert not wait
+            proc.stdout = StringIO(self.output)
+        else:
+            stdout.write(self.output)
+        return proc
+
+    def test_get_tar(self, tmpdir):
+        self.output = make_tar([('./a', 'aaa')], mode='w:gz')
+        to_path = str(tmpdir.join('out.tgz'))
+        self.remote.get_tar('/some/dir', to_path, sudo=True)
+        assert self.runs == [['sudo', 'tar', 'cz', '-f', '-', '-C',
+                              '/some/dir', '--', '.']]
+        assert tarfile.open(to_path).getnames() == ['./a']
+
+    def check_stream(self, compression, tar_args, mode):
+        files = [('./a', 'aaa'), ('./b/c', 'c' * 100000)]
+        self.output = make_tar(files, mode=mode)
+        with self.remote.tar_stream('/some/dir',
+                                    compression=compression) as tar:
+            got = [(ti.name, tar.extractfile(ti).read()) for ti in tar]
+        assert got == files
+        assert self.runs == [['tar', 'c'] + tar_args +
+                             ['-f', '-', '-C', '/some/dir', '--', '.']]
+
+    def test_tar_stream_gzip(self):
+        self.check_stream('gzip', ['--gzip'], 'w:gz')
+
+    def test_tar_stream_none(self):
+        self.check_stream('none', [], 'w')
+
+    def test_tar_stream_zstd_unavailable(self):
+        with patch.object(remote, 'zstandard', None):
+            self.check_stream('zstd', ['--gzip'], 'w:gz')
+
+    def test_tar_stream_command_fails(self):
+        procs = []
+
+        def failing_run(client, args, stdout=None, wait=True, **kwargs):
+            # tar exits without writing anything, e.g. because the
+            # directory is missing
+            proc = Mock()
+            proc.stdout = Mock(wraps=StringIO(''))
+            proc.stdout.channel = Mock()
+            proc.wait.side_effect = CommandFailedError(
+                command='tar', exitstatus=2, node='xyzzy')
+            procs.append(proc)
+            return proc
+        self.remote._runner = failing_run
+        with raises(CommandFailedError):
+            with self.remote.tar_stream('/some/dir'):
+                pass
+        assert procs[0].wait.called
+        assert procs[0].stdout.channel.close.called
+
+    def test_tar_stream_bandwidth_limit(self):
+        self.output = make_tar([('./a', 'a' * 10000)], mode='w')
+        with patch('teuthology.orchestra.remote.time.sleep') as m_sleep:
+            with self.remote.tar_stream('/some/dir', compression='none',
+                                        bandwidth_limit=1000) as tar:
+                assert [ti.name for ti in tar] == ['./a']
+        # At 1000 bytes per second, reading the whole archive should take
+        # len(self.output) / 1000 seconds. time.sleep() is mocked, so each
+        # sleep is for the whole time we're ahead by.
+        expected = len(self.output) / 1000.0
+        slept = max(call[0][0] for call in m_sleep.call_args_list)
+        assert expected - 1 < slept <= expected
+
+
+class TestRunBatch(object):
+    def setup(self):
+        self.remote = remote.Remote(name='jdoe@xyzzy.example.com',
+                                    ssh=Mock())
+        self.runs = []
+        self.remote._runner = self.local_run
+
+    def local_run(self, client, args, stdout, stderr, **kwargs):
+        """
+        Run the script locally
+        """
+        self.runs.append(args)
+        proc = subprocess.Popen(['bash', '-c', args], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        stdout.write(out)
+        stderr.write(err)
+        return Mock(stdout=stdout, stderr=stderr, exitstatus=proc.returncode)
+
+    def test_results(self):
+        results = self.remote.run_batch([
+            ['echo', 'one two'],
+            'printf foo; echo bar >&2; exit 3',
+            ['cat'],
+            'cd /; exit 0',
+            ['pwd'],
+        ], check_status=False)
+        assert len(self.runs) == 1
+        assert [r.exitstatus for r in results] == [0, 3, 0, 0, 0]
+        assert [r.stdout for r in results] == ['one two\n', 'foo', '', '',
+                                               self.cwd()]
+        assert results[1].stderr == 'bar\n'
+        assert results[0].args == ['echo', 'one two']
+
+    def cwd(self):
+        return subprocess.check_output(['pwd'])
+
+    def test_check_status(self, tmpdir):
+        path = tmpdir.join('not-created')
+        with raises(CommandFailedError) as exc:
+            self.remote.run_batch([['true'], ['false'], ['touch', str(path)]])
+        assert exc.value.exitstatus == 1
+        assert exc.value.command == 'false'
+        # Nothing runs after the first failure
+        assert not path.check()
+
+    def test_empty(self):
+        assert self.remote.run_batch([]) == []
+        assert self.runs == []
+
+
+class TestRemoteFacts(object):
+    def setup(self):
+        self.remote = remote.Remote(name='jdoe@xyzzy.example.com',
+                                    ssh=Mock(), host_key='ssh-rsa KEY')
+        outputs = dict(
+            arch='x86_64\n',
+            python_distro="('Ubuntu', '14.04', 'trusty')\n",
+            os_release=None,
+            lsb_release=None,
+            lsb_id='Ubuntu\n',
+            lsb_version='14.04\n',
+        )
+        results = []
+        for (name, args) in remote.Remote._fact_commands:
+            output = outputs[name]
+            results.append(remote.CommandResult(
+                args=args, exitstatus=0 if output is not None else 1,
+                stdout=output or '', stderr=''))
+        self.m_run_batch = Mock(return_value=results)
+        self.remote.run_batch = self.m_run_batch
+
+    def test_gathered_once(self):
+        assert self.remote.arch == 'x86_64'
+        assert self.remote.os.name == 'ubuntu'
+        assert self.remote.os.version == '14.04'
+        assert misc.get_system_type(self.remote) == 'deb'
+        assert misc.get_system_type(self.remote, distro=True,
+                                    version=True) == ('ubuntu', '14.04')
+        assert self.m_run_batch.call_count == 1
+        facts = self.remote.facts
+        assert facts['host_key'] == 'ssh-rsa KEY'
+        assert facts['os_release'] is None
+
+    def test_set(self):
+        self.remote.facts = dict(arch='aarch64')
+        assert self.remote.arch == 'aarch64'
+        assert self.m_run_batch.call_count == 0
@@ -1,10 +1,17 @@
 from cStringIO import StringIO
 
 import fudge
+import gevent
 import logging
 import socket
+import threading
+import time
+
+from mock import Mock
+from pytest import raises
 
 from .. import run
+from teuthology.contextutil import MaxWhileTries
 from teuthology.exceptions import (CommandCrashedError, CommandFailedError,
                                    ConnectionLostError)
 
@@ -28,8 +35,8 @@ class TestRun(object):
         in_chan = fudge.Fake('channel')
         in_chan.expects('shutdown_write').with_args()
         in_.has_attr(channel=in_chan)
-        out.expects('xreadlines').with_args().returns(['foo', 'bar'])
-        err.expects('xreadlines').with_args().returns(['bad'])
+        out.expects('read').returns('foo\nbar\n').next_call().returns('')
+        err.expects('read').returns('bad\n').next_call().returns('')
         logger = fudge.Fake('logger')
         log_host = fudge.Fake('log_host')
         logger.expects('getChild').with_args('HOST').returns(log_host)
@@ -70,7 +77,7 @@ class TestRun(object):
         out.expects('read').with_args().returns('foo\nb')
         out.expects('read').with_args().returns('ar\n')
         out.expects('read').with_args().returns('')
-        err.expects('xreadlines').with_args().returns(['bad'])
+        err.expects('read').returns('bad\n').next_call().returns('')
         logger = fudge.Fake('logger')
         log_host = fudge.Fake('log_host')
         logger.expects('getChild').with_args('HOST').returns(log_host)
@@ -103,8 +110,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -132,8 +139,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -159,8 +166,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -187,8 +194,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -211,8 +218,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -264,8 +271,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -290,8 +297,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -322,8 +329,8 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
-        err.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -358,7 +365,7 @@ class TestRun(object):
         out.expects('read').with_args().returns('one')
         out.expects('read').with_args().returns('two')
         out.expects('read').with_args().returns('')
-        err.expects('xreadlines').with_args().returns([])
+        err.expects('read').returns('')
         logger = fudge.Fake('logger').is_a_stub()
         channel = fudge.Fake('channel')
         out.has_attr(channel=channel)
@@ -393,7 +400,7 @@ class TestRun(object):
         out = fudge.Fake('ChannelFile').is_a_stub()
         err = fudge.Fake('ChannelFile').is_a_stub()
         cmd.returns((in_, out, err))
-        out.expects('xreadlines').with_args().returns([])
+        out.expects('read').returns('')
         err.expects('read').with_args().returns('one')
         err.expects('read').with_args().returns('two')
         err.expects('read').with_args().returns('')
@@ -431,3 +438,139 @@ class TestRun(object):
     def test_quote_and_raw(self):
         got = run.quote(['true', run.Raw('&&'), 'echo', 'yay'])
         assert got == "true && echo yay"
+
+
+class TestWait(object):
+    def make_proc(self, event=True):
+        channel = Mock(spec=['recv_exit_status', 'exit_status_ready'])
+        channel.recv_exit_status.return_value = 0
+        channel.exit_status_ready.return_value = False
+        if event:
+            channel.status_event = threading.Event()
+        proc = run.RemoteProcess(client=Mock(), args=['true'],
+                                 hostname='host')
+        proc._stdout_buf = Mock(channel=channel)
+        return proc
+
+    def finish(self, proc):
+        channel = proc._stdout_buf.channel
+        channel.exit_status_ready.return_value = True
+        if hasattr(channel, 'status_event'):
+            channel.status_event.set()
+
+    def test_returns_on_exit(self):
+        procs = [self.make_proc(), self.make_proc()]
+        for proc in procs:
+            gevent.spawn_later(0.1, self.finish, proc)
+        start = time.time()
+        run.wait(procs, timeout=300)
+        assert time.time() - start < 1
+        assert [proc.exitstatus for proc in procs] == [0, 0]
+
+    def test_timeout(self):
+        procs = [self.make_proc(), self.make_proc()]
+        gevent.spawn_later(0.05, self.finish, procs[0])
+        start = time.time()
+        with raises(MaxWhileTries) as exc:
+            run.wait(procs, timeout=0.2)
+        assert 0.2 <= time.time() - start < 1
+        assert str(exc.value).startswith('1 processes had not exited')
+
+    def test_without_status_event(self):
+        proc = self.make_proc(event=False)
+        assert not proc.wait_for_exit(timeout=0.1)
+        gevent.spawn_later(0.1, self.finish, proc)
+        assert proc.wait_for_exit(timeout=5)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestCopyToLog(object):
+    def setup(self):
+        self.logger = logging.getLogger('teuthology.test.copy_to_log')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+
+    def teardown(self):
+        self.logger.removeHandler(self.handler)
+
+    def copy(self, chunks, loglevel=logging.INFO):
+        f = Mock()
+        f.read.side_effect = list(chunks) + ['']
+        run.copy_to_log(f, self.logger, loglevel)
+        return [(r.levelno, r.getMessage()) for r in self.handler.records]
+
+    def test_lines_split_across_chunks(self):
+        got = self.copy(['foo\nb', 'ar  \n\nba', 'z'])
+        assert got == [(logging.INFO, 'foo'), (logging.INFO, 'bar'),
+                       (logging.INFO, ''), (logging.INFO, 'baz')]
+
+    def test_utf8(self):
+        snowman = u'\u2603'.encode('utf-8')
+        got = self.copy(['a' + snowman[:1], snowman[1:] + '\n\xff\n'])
+        assert got == [(logging.INFO, 'a' + snowman),
+                       (logging.INFO, u'\ufffd'.encode('utf-8'))]
+
+    def test_disabled_level(self):
+        self.logger.setLevel(logging.WARNING)
+        assert self.copy(['foo\n'], loglevel=logging.INFO) == []
+
+    def test_copy_file_to_file(self):
+        f = Mock()
+        f.read.side_effect = ['foo\nb', 'ar\n', '']
+        dst = StringIO()
+        run.copy_file_to(f, dst)
+        assert dst.getvalue() == 'foo\nbar\n'
+
+
+class TestCommandTimings(object):
+    def setup(self):
+        run.timings = run.CommandTimings()
+
+    def teardown(self):
+        run.timings = None
+
+    def make_client(self, output):
+        from StringIO import StringIO as PyStringIO
+        client = Mock()
+        client.get_transport.return_value.getpeername.return_value = \
+            ('HOST', 22)
+        stdin = Mock()
+        stdout = PyStringIO(output)
+        stdout.channel = Mock()
+        stdout.channel.recv_exit_status.return_value = 0
+        stderr = PyStringIO('err\n')
+        client.exec_command.return_value = (stdin, stdout, stderr)
+        return client
+
+    def test_run(self):
+        run.timings.task = 'mytask'
+        run.run(client=self.make_client('hello\n'), args=['true'],
+                stdin='abc', stdout=StringIO(), stderr=StringIO())
+        run.run(client=self.make_client('bye\n'), args=['true'],
+                stdout=StringIO(), stderr=StringIO())
+        totals = run.timings.totals['mytask']['HOST']
+        assert totals['commands'] == 2
+        assert totals['bytes_in'] == 3
+        assert totals['bytes_out'] == len('hello\nerr\nbye\nerr\n')
+        assert totals['wall_time'] >= totals['max_wall_time'] >= 0
+        assert totals['first_byte_time'] >= 0
+
+    def test_save(self, tmpdir):
+        run.timings.task = 'mytask'
+        run.run(client=self.make_client('hello\n'), args=['true'],
+                stdout=StringIO(), stderr=StringIO())
+        path = str(tmpdir.join('timing.yaml'))
+        run.timings.save(path)
+        import yaml
+        saved = yaml.safe_load(open(path))
+        assert saved['mytask']['HOST']['commands'] == 1
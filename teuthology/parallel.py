@@ -54,10 +54,16 @@ class parallel(object):
     At the end of the with block, the main thread waits until all
     spawned functions have completed, or, if one exited with an exception,
     kills the rest and raises the exception.
+
+    If max_concurrency is given, at most that many functions run at once;
+    spawn() blocks until one of them finishes.
     """
 
-    def __init__(self):
-        self.group = gevent.pool.Group()
+    def __init__(self, max_concurrency=None):
+        if max_concurrency:
+            self.group = gevent.pool.Pool(max_concurrency)
+        else:
+            self.group = gevent.pool.Group()
         self.results = gevent.queue.Queue()
         self.count = 0
         self.any_spawned = False
@@ -321,6 +321,39 @@ class ResultsReporter(object):
 
         return job_id
 
+    def report_heartbeats(self, job_infos):
+        """
+        Tell the results server that several running jobs are still alive,
+        over this reporter's session. Each job is updated in place with a
+        single PUT, falling back to report_job() for a job the server does
+        not know about yet. Failures are logged, not raised, so one bad job
+        doesn't hold up the others.
+
+        :param job_infos: A list of dicts, each with at least 'name' and
+                          'job_id'.
+        :returns:         The number of jobs successfully reported.
+        """
+        headers = {'content-type': 'application/json'}
+        reported = 0
+        for job_info in job_infos:
+            run_name = job_info['name']
+            job_id = job_info['job_id']
+            job_uri = "{base}/runs/{name}/jobs/{job_id}/".format(
+                base=self.base_uri, name=run_name, job_id=job_id)
+            try:
+                response = self.session.put(job_uri,
+                                            data=json.dumps(job_info),
+                                            headers=headers)
+                if response.status_code == 404:
+                    self.report_job(run_name, job_id, job_info)
+                else:
+                    response.raise_for_status()
+                reported += 1
+            except report_exceptions:
+                self.log.exception("Could not report heartbeat for job %s",
+                                   job_id)
+        return reported
+
     @property
     def last_run(self):
         """
@@ -1,3 +1,4 @@
+import os
 import sys
 import logging
 from .sentry import get_client as get_sentry_client
@@ -5,6 +6,7 @@ from .job_status import set_status
 from .misc import get_http_log_path
 from .config import config as teuth_config
 from .exceptions import ConnectionLostError
+from .orchestra import run
 from copy import deepcopy
 
 log = logging.getLogger(__name__)
@@ -43,6 +45,9 @@ def run_one_task(taskname, **kwargs):
 
 def run_tasks(tasks, ctx):
     stack = []
+    timings = None
+    if teuth_config.command_timing:
+        timings = run.timings = run.CommandTimings()
     try:
         for taskdict in tasks:
             try:
@@ -50,6 +55,8 @@ def run_tasks(tasks, ctx):
             except (ValueError, AttributeError):
                 raise RuntimeError('Invalid task definition: %s' % taskdict)
             log.info('Running task %s...', taskname)
+            if timings is not None:
+                timings.task = taskname
             manager = run_one_task(taskname, ctx=ctx, config=config)
             if hasattr(manager, '__enter__'):
                 stack.append((taskname, manager))
@@ -121,6 +128,8 @@ def run_tasks(tasks, ctx):
             while stack:
                 taskname, manager = stack.pop()
                 log.debug('Unwinding manager %s', taskname)
+                if timings is not None:
+                    timings.task = taskname
                 try:
                     suppress = manager.__exit__(*exc_info)
                 except Exception as e:
@@ -155,3 +164,12 @@ def run_tasks(tasks, ctx):
         finally:
             # be careful about cyclic references
             del exc_info
+            if timings is not None:
+                run.timings = None
+                if ctx.archive:
+                    # Don't let a failure here hide the job's own outcome
+                    try:
+                        timings.save(os.path.join(ctx.archive,
+                                                  'timing.yaml'))
+                    except Exception:
+                        log.exception("Failed to save command timings")
@@ -3,8 +3,46 @@ import yaml
 
 import teuthology.beanstalk
 from teuthology.misc import get_user, merge_configs
+from teuthology.parallel import parallel
 from teuthology import report
 
+# The usage of teuthology-schedule; teuthology-suite builds the same
+# command lines for the jobs it schedules
+doc = """
+usage: teuthology-schedule -h
+       teuthology-schedule [options] --name <name> [--] [<conf_file> ...]
+
+Schedule ceph integration tests
+
+positional arguments:
+  <conf_file>                          Config file to read
+
+optional arguments:
+  -h, --help                           Show this help message and exit
+  -v, --verbose                        Be more verbose
+  -n <name>, --name <name>             Name of suite run the job is part of
+  -d <desc>, --description <desc>      Job description
+  -o <owner>, --owner <owner>          Job owner
+  -w <worker>, --worker <worker>       Which worker to use (type of machine)
+                                       [default: plana]
+  -p <priority>, --priority <priority> Job priority (lower is sooner)
+                                       [default: 1000]
+  -N <num>, --num <num>                Number of times to run/queue the job
+                                       [default: 1]
+
+  --last-in-suite                      Mark the last job in a suite so suite
+                                       post-processing can be run
+                                       [default: False]
+  --email <email>                      Where to send the results of a suite.
+                                       Only applies to the last job in a suite.
+  --timeout <timeout>                  How many seconds to wait for jobs to
+                                       finish before emailing results. Only
+                                       applies to the last job in a suite.
+  --dry-run                            Instead of scheduling, just output the
+                                       job config.
+
+"""
+
 
 def main(args):
     if not args['--last-in-suite']:
@@ -25,12 +63,17 @@ def main(args):
         schedule_job(job_config, args['--num'])
 
 
-def build_config(args):
+def build_config(args, conf_dict=None):
     """
     Given a dict of arguments, build a job config
+
+    :param args:      A dict of arguments, as parsed by teuthology-schedule
+    :param conf_dict: The merged contents of args['<conf_file>'], if the
+                      caller already has them. It will be modified.
     """
-    config_paths = args.get('<conf_file>', list())
-    conf_dict = merge_configs(config_paths)
+    if conf_dict is None:
+        config_paths = args.get('<conf_file>', list())
+        conf_dict = merge_configs(config_paths)
     # strip out targets; the worker will allocate new ones when we run
     # the job with --lock.
     if 'targets' in conf_dict:
@@ -68,10 +111,53 @@ def schedule_job(job_config, num=1):
     :param job_config: The complete job dict
     :param num:      The number of times to schedule the job
     """
+    beanstalk = teuthology.beanstalk.connect()
+    try:
+        for queued_config in put_job(beanstalk, job_config, num):
+            report.try_push_job_info(queued_config, dict(status='queued'))
+    finally:
+        beanstalk.close()
+
+
+def schedule_jobs(job_configs, max_concurrency=10):
+    """
+    Schedule many jobs in-process, over a single beanstalk connection.
+
+    Each job is reported to the results server as 'queued', as
+    schedule_job() does; those reports are sent concurrently.
+
+    :param job_configs:     An iterable of (job_config, num) tuples; see
+                            schedule_job()
+    :param max_concurrency: The maximum number of concurrent reports to the
+                            results server
+    :returns:               The number of jobs put in the queue
+    """
+    count = 0
+    beanstalk = teuthology.beanstalk.connect()
+    try:
+        with parallel(max_concurrency=max_concurrency) as p:
+            for (job_config, num) in job_configs:
+                for queued_config in put_job(beanstalk, job_config, num):
+                    count += 1
+                    p.spawn(report.try_push_job_info, dict(queued_config),
+                            dict(status='queued'))
+    finally:
+        beanstalk.close()
+    return count
+
+
+def put_job(beanstalk, job_config, num=1):
+    """
+    Put a job in the queue num times. After each put, job_config['job_id'] is
+    set to the new job's ID and job_config is yielded.
+
+    :param beanstalk:  A beanstalkc.Connection
+    :param job_config: The complete job dict. Its 'tube' will be removed.
+    :param num:        The number of times to schedule the job
+    """
     num = int(num)
     job = yaml.safe_dump(job_config)
     tube = job_config.pop('tube')
-    beanstalk = teuthology.beanstalk.connect()
     beanstalk.use(tube)
     while num > 0:
         jid = beanstalk.put(
@@ -82,5 +168,5 @@ def schedule_job(job_config, num=1):
         print 'Job scheduled with name {name} and ID {jid}'.format(
             name=job_config['name'], jid=jid)
         job_config['job_id'] = str(jid)
-        report.try_push_job_info(job_config, dict(status='queued'))
+        yield job_config
         num -= 1
@@ -3,7 +3,10 @@
 # https://github.com/ceph/ceph-qa-suite.git
 
 import copy
+import cPickle as pickle
 from datetime import datetime
+import docopt
+import hashlib
 import logging
 import os
 import requests
@@ -12,17 +15,23 @@ import subprocess
 import smtplib
 import socket
 import sys
+import time
 import yaml
 import math
+import re
 from email.mime.text import MIMEText
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkstemp
 
 import teuthology
 import matrix
 from . import lock
+from . import schedule
 from .config import config, JobConfig
 from .exceptions import BranchNotFoundError, ScheduleFailError
-from .misc import deep_merge, get_results_url
+from .job_status import get_status
+from .misc import deep_merge, deep_merged, get_results_url
+from .parallel import parallel
+from .report import ResultsReporter, ResultsSerializer, report_exceptions
 from .repo_utils import fetch_qa_suite, fetch_teuthology
 from .task.install import get_flavor
 
@@ -68,9 +77,33 @@ def main(args):
         subset = tuple(map(int, args['--subset'].split('/')))
         log.info('Passed subset=%s/%s' % (str(subset[0]), str(subset[1])))
 
+    rerun_descriptions = None
+    if args['--rerun']:
+        statuses = [x.strip() for x in args['--rerun-statuses'].split(',')]
+        rerun_descriptions = get_rerun_descriptions(args['--rerun'],
+                                                    statuses)
+        if not rerun_descriptions:
+            log.info("No jobs with status %s found in run %s; nothing to "
+                     "rerun", '/'.join(statuses), args['--rerun'])
+            return
+
     name = make_run_name(suite, ceph_branch, kernel_branch, kernel_flavor,
                          machine_type)
 
+    if args['--count'] or args['--stats']:
+        # Only the suite's directory structure is needed
+        if suite_dir:
+            suite_repo_path = suite_dir
+        else:
+            suite_repo_path = fetch_repos(
+                get_suite_branch(suite_branch, ceph_branch, name),
+                test_name=name)
+        suite_path = os.path.join(suite_repo_path, 'suites',
+                                  suite.replace(':', '/'))
+        print_suite_stats(suite, suite_path, subset=subset,
+                          fragments=args['--stats'])
+        return
+
     job_config = create_initial_config(suite, suite_branch, ceph_branch,
                                        teuthology_branch, kernel_branch,
                                        kernel_flavor, distro, machine_type,
@@ -112,6 +145,7 @@ def main(args):
                          filter_in=filter_in,
                          filter_out=filter_out,
                          subset=subset,
+                         rerun_descriptions=rerun_descriptions,
                          )
     os.remove(base_yaml_path)
 
@@ -140,11 +174,10 @@ def fetch_repos(branch, test_name):
     Fetch the suite repo (and also the teuthology repo) so that we can use it
     to build jobs. Repos are stored in ~/src/.
 
-    The reason the teuthology repo is also fetched is that currently we use
-    subprocess to call teuthology-schedule to schedule jobs so we need to make
-    sure it is up-to-date. For that reason we always fetch the master branch
-    for test scheduling, regardless of what teuthology branch is requested for
-    testing.
+    The teuthology repo is also fetched so that the copy used for scheduling
+    (e.g. by automated runs of teuthology-suite) stays up-to-date. For that
+    reason we always fetch the master branch for test scheduling, regardless
+    of what teuthology branch is requested for testing.
 
     :returns: The path to the suite repo on disk
     """
@@ -221,19 +254,7 @@ def create_initial_config(suite, suite_branch, ceph_branch, teuthology_branch,
             teuthology_branch = 'master'
     log.info("teuthology branch: %s", teuthology_branch)
 
-    if suite_branch and suite_branch != 'master':
-        if not github_branch_exists('ceph-qa-suite', suite_branch):
-            exc = BranchNotFoundError(suite_branch, 'ceph-qa-suite.git')
-            schedule_fail(message=str(exc), name=name)
-    elif not suite_branch:
-        # Decide what branch of ceph-qa-suite to use
-        if github_branch_exists('ceph-qa-suite', ceph_branch):
-            suite_branch = ceph_branch
-        else:
-            log.info("branch {0} not in ceph-qa-suite.git; will use master for"
-                     " ceph-qa-suite".format(ceph_branch))
-            suite_branch = 'master'
-    log.info("ceph-qa-suite branch: %s", suite_branch)
+    suite_branch = get_suite_branch(suite_branch, ceph_branch, name)
 
     config_input = dict(
         suite=suite,
@@ -250,16 +271,92 @@ def create_initial_config(suite, suite_branch, ceph_branch, teuthology_branch,
     return job_config
 
 
+def get_suite_branch(suite_branch, ceph_branch, name=None):
+    """
+    Decide which branch of ceph-qa-suite to use: suite_branch if it is given
+    (and exists), otherwise ceph_branch if ceph-qa-suite has it, otherwise
+    master.
+
+    :returns: The branch name
+    """
+    if suite_branch and suite_branch != 'master':
+        if not github_branch_exists('ceph-qa-suite', suite_branch):
+            exc = BranchNotFoundError(suite_branch, 'ceph-qa-suite.git')
+            schedule_fail(message=str(exc), name=name)
+    elif not suite_branch:
+        # Decide what branch of ceph-qa-suite to use
+        if github_branch_exists('ceph-qa-suite', ceph_branch):
+            suite_branch = ceph_branch
+        else:
+            log.info("branch {0} not in ceph-qa-suite.git; will use master for"
+                     " ceph-qa-suite".format(ceph_branch))
+            suite_branch = 'master'
+    log.info("ceph-qa-suite branch: %s", suite_branch)
+    return suite_branch
+
+
+def print_suite_stats(suite, path, subset=None, fragments=False):
+    """
+    Print how many jobs a suite (or a subset of it) consists of, without
+    generating the jobs themselves.
+
+    :param suite:     The name of the suite
+    :param path:      The path to the suite directory
+    :param subset:    (index, outof)
+    :param fragments: Also print how many of the jobs include each yaml
+                      fragment, grouped by facet (directory)
+    """
+    (mat, first, matlimit) = get_matrix_range(path, subset=subset)
+    print 'Suite {suite}: {count} jobs'.format(suite=suite, count=mat.size())
+    print 'minscanlen: {minscanlen}, cyclicity: {cyclicity}'.format(
+        minscanlen=mat.minscanlen(), cyclicity=mat.cyclicity())
+    if subset:
+        print 'Subset {index}/{outof}: {count} jobs ({first}-{last})'.format(
+            index=subset[0], outof=subset[1], count=matlimit - first,
+            first=first, last=matlimit - 1)
+    if not fragments:
+        return
+
+    if first == 0 and matlimit == mat.size():
+        coverage = mat.coverage()
+    else:
+        # A subset doesn't cover the matrix uniformly; count the fragments
+        # of each of its jobs. This skips building descriptions and reading
+        # any yaml.
+        coverage = dict()
+        for result in mat.index_range(first, matlimit):
+            for item in matrix.generate_lists(result):
+                coverage[item] = coverage.get(item, 0) + 1
+    facets = dict()
+    for (item, count) in coverage.iteritems():
+        fragment = reduce(combine_path, item, '')
+        facet = os.path.dirname(fragment)
+        facets.setdefault(facet, list()).append(
+            (os.path.basename(fragment), count))
+    total = matlimit - first
+    for facet in sorted(facets):
+        print '{facet}/'.format(facet=facet)
+        for (fragment, count) in sorted(facets[facet]):
+            print '  {fragment:<50} {count:>8} {percent:>6.1f}%'.format(
+                fragment=fragment, count=count,
+                percent=100.0 * count / total)
+
+
 def prepare_and_schedule(job_config, suite_repo_path, base_yaml_paths, limit,
                          num, timeout, dry_run, verbose,
                          filter_in,
                          filter_out,
-                         subset):
+                         subset,
+                         rerun_descriptions=None):
     """
     Puts together some "base arguments" with which to execute
     teuthology-schedule for each job, then passes them and other parameters to
     schedule_suite(). Finally, schedules a "last-in-suite" job that sends an
     email to the specified address (if one is configured).
+
+    Jobs are scheduled in-process; the teuthology-schedule command lines are
+    only used for dry-run output. schedule_args holds the same arguments,
+    parsed by teuthology-schedule's own argument parser.
     """
     arch = get_arch(job_config.machine_type)
 
@@ -275,6 +372,7 @@ def prepare_and_schedule(job_config, suite_repo_path, base_yaml_paths, limit,
         base_args.append('-v')
     if job_config.owner:
         base_args.extend(['--owner', job_config.owner])
+    schedule_args = parse_schedule_args(base_args)
 
     suite_path = os.path.join(suite_repo_path, 'suites',
                               job_config.suite.replace(':', '/'))
@@ -295,11 +393,13 @@ def prepare_and_schedule(job_config, suite_repo_path, base_yaml_paths, limit,
         dry_run=dry_run,
         filter_in=filter_in,
         filter_out=filter_out,
-        subset=subset
+        subset=subset,
+        schedule_args=schedule_args,
+        rerun_descriptions=rerun_descriptions,
     )
 
     if job_config.email and num_jobs:
-        arg = copy.deepcopy(base_args)
+        arg = list(base_args)
         arg.append('--last-in-suite')
         arg.extend(['--email', job_config.email])
         if timeout:
@@ -307,14 +407,24 @@ def prepare_and_schedule(job_config, suite_repo_path, base_yaml_paths, limit,
         if dry_run:
             log.info('dry-run: %s' % ' '.join(arg))
         else:
-            subprocess.check_call(
-                args=arg,
-            )
+            last_args = parse_schedule_args(arg)
+            last_config = schedule.build_config(last_args)
+            schedule.schedule_job(last_config, last_args['--num'])
         results_url = get_results_url(job_config.name)
         if results_url:
             log.info("Test results viewable at %s", results_url)
 
 
+def parse_schedule_args(args):
+    """
+    Parse a teuthology-schedule command line the way teuthology-schedule
+    itself would.
+
+    :param args: The command line, starting with the program's path.
+    """
+    return docopt.docopt(schedule.doc, argv=args[1:])
+
+
 def schedule_fail(message, name=''):
     """
     If an email address has been specified anywhere, send an alert there. Then
@@ -493,55 +603,65 @@ def schedule_suite(job_config,
                    dry_run=True,
                    filter_in=None,
                    filter_out=None,
-                   subset=None
+                   subset=None,
+                   schedule_args=None,
+                   rerun_descriptions=None,
                    ):
     """
     schedule one suite.
     returns number of jobs scheduled
+
+    If schedule_args (a dict of teuthology-schedule arguments corresponding
+    to base_args) is passed, jobs are put in the queue in-process over a
+    single connection. Otherwise teuthology-schedule is run for each job.
+
+    If rerun_descriptions (a set of job descriptions) is passed, only the jobs
+    with those descriptions are scheduled; see get_rerun_descriptions().
     """
     suite_name = job_config.suite
     log.debug('Suite %s in %s' % (suite_name, path))
-    configs = [(combine_path(suite_name, item[0]), item[1]) for item in
-               build_matrix(path, subset=subset)]
+    (mat, first, matlimit) = get_matrix_range(path, subset=subset)
+    total_count = matlimit - first
+    configs = ((combine_path(suite_name, item[0]), item[1]) for item in
+               iter_combinations(path, mat, first, matlimit))
     log.info('Suite %s in %s generated %d jobs (not yet filtered)' % (
-        suite_name, path, len(configs)))
-
-    # used as a local cache for package versions from gitbuilder
-    package_versions = dict()
+        suite_name, path, total_count))
+
+    # Break apart the filter parameters (one string each) into comma
+    # separated components to be used in searches.
+    if filter_in:
+        filter_in = KeywordFilter(filter_in)
+    if filter_out:
+        filter_out = KeywordFilter(filter_out)
+    fragment_cache = FragmentCache()
+    rerun_found = set()
     jobs_to_schedule = []
     jobs_missing_packages = []
+    # maps each job (by index in jobs_to_schedule) to the
+    # (sha1, os_type, flavor) it needs packages for
+    job_packages = []
+    if dry_run:
+        job_dict = job_config.to_dict()
     for description, fragment_paths in configs:
         if limit > 0 and len(jobs_to_schedule) >= limit:
             log.info(
                 'Stopped after {limit} jobs due to --limit={limit}'.format(
                     limit=limit))
             break
-        # Break apart the filter parameter (one string) into comma separated
-        # components to be used in searches.
-        if filter_in:
-            filter_list = [x.strip() for x in filter_in.split(',')]
-            if not any([x in description for x in filter_list]):
-                all_filt = []
-                for filt_samp in filter_list:
-                    all_filt.extend([x.find(filt_samp) < 0 for x in fragment_paths])
-                if all(all_filt):
-                    continue
-        if filter_out:
-            filter_list = [x.strip() for x in filter_out.split(',')]
-            if any([x in description for x in filter_list]):
-                continue
-            all_filt_val = False
-            for filt_samp in filter_list:
-                flist = [filt_samp in x for x in fragment_paths]
-                if any(flist):
-                    all_filt_val = True
-                    continue
-            if all_filt_val:
+        if rerun_descriptions is not None:
+            if len(rerun_found) == len(rerun_descriptions):
+                # No need to look at the rest of the suite
+                break
+            if description not in rerun_descriptions or \
+                    description in rerun_found:
                 continue
+            rerun_found.add(description)
+        if filter_in and not filter_in.matches(description, fragment_paths):
+            continue
+        if filter_out and filter_out.matches(description, fragment_paths):
+            continue
 
-        raw_yaml = '\n'.join([file(a, 'r').read() for a in fragment_paths])
-
-        parsed_yaml = yaml.load(raw_yaml)
+        parsed_yaml = fragment_cache.load(fragment_paths)
         os_type = parsed_yaml.get('os_type') or job_config.os_type
         exclude_arch = parsed_yaml.get('exclude_arch')
         exclude_os_type = parsed_yaml.get('exclude_os_type')
@@ -555,7 +675,7 @@ def schedule_suite(job_config,
                      exclude_os_type, description)
             continue
 
-        arg = copy.deepcopy(base_args)
+        arg = list(base_args)
         arg.extend([
             '--description', description,
             '--',
@@ -566,24 +686,25 @@ def schedule_suite(job_config,
         job = dict(
             yaml=parsed_yaml,
             desc=description,
+            fragments=fragment_paths,
             args=arg
         )
 
         if dry_run:
-            full_job_config = dict()
-            deep_merge(full_job_config, job_config.to_dict())
-            deep_merge(full_job_config, parsed_yaml)
+            # Neither job_config nor parsed_yaml is modified; only the parts
+            # they have in common are copied.
+            full_job_config = deep_merged(job_dict, parsed_yaml)
             flavor = get_install_task_flavor(full_job_config)
-            sha1 = job_config.sha1
-            # Get package versions for this sha1, os_type and flavor. If we've
-            # already retrieved them in a previous loop, they'll be present in
-            # package_versions and gitbuilder will not be asked again for them.
-            package_versions = get_package_versions(
-                sha1,
-                os_type,
-                flavor,
-                package_versions
-            )
+            job_packages.append((job_config.sha1, str(os_type), flavor))
+
+        jobs_to_schedule.append(job)
+
+    if dry_run:
+        # Ask gitbuilder about every distinct sha1, os_type and flavor at
+        # once, instead of one at a time as we come across them.
+        package_versions = prefetch_package_versions(set(job_packages))
+        for job, (sha1, os_type, flavor) in zip(jobs_to_schedule,
+                                                job_packages):
             if not has_packages_for_distro(sha1, os_type, flavor,
                                            package_versions):
                 m = "Packages for os_type '{os}', flavor {flavor} and " + \
@@ -591,9 +712,15 @@ def schedule_suite(job_config,
                 log.info(m.format(os=os_type, flavor=flavor, ver=sha1))
                 jobs_missing_packages.append(job)
 
-        jobs_to_schedule.append(job)
+    if not dry_run and schedule_args is not None:
+        schedule.schedule_jobs(
+            _build_job_configs(jobs_to_schedule, base_yamls, schedule_args,
+                               fragment_cache))
+        jobs_to_schedule_now = []
+    else:
+        jobs_to_schedule_now = jobs_to_schedule
 
-    for job in jobs_to_schedule:
+    for job in jobs_to_schedule_now:
         log.info(
             'Scheduling %s', job['desc']
         )
@@ -616,23 +743,240 @@ def schedule_suite(job_config,
                 args=job['args'],
             )
 
+    if rerun_descriptions is not None and \
+            len(rerun_found) < len(rerun_descriptions):
+        log.warn('%d jobs to rerun were not found in suite %s',
+                 len(rerun_descriptions) - len(rerun_found), suite_name)
     count = len(jobs_to_schedule)
     missing_count = len(jobs_missing_packages)
     log.info('Suite %s in %s scheduled %d jobs.' % (suite_name, path, count))
     log.info('Suite %s in %s -- %d jobs were filtered out.' %
-             (suite_name, path, len(configs) - count))
+             (suite_name, path, total_count - count))
     if dry_run:
         log.info('Suite %s in %s scheduled %d jobs with missing packages.' %
                  (suite_name, path, missing_count))
     return count
 
 
+class KeywordFilter(object):
+    """
+    Matches jobs against the comma separated keywords passed to --filter or
+    --filter-out. A job matches if any keyword is a substring of its
+    description or of any of its fragment paths.
+
+    The keywords are compiled into a single regular expression, and since
+    the same fragments show up in many jobs, the result for each fragment
+    path is remembered.
+    """
+    def __init__(self, keywords):
+        self.keywords = [x.strip() for x in keywords.split(',')]
+        self._regex = re.compile(
+            '|'.join([re.escape(x) for x in self.keywords]))
+        self._fragment_matches = dict()
+
+    def matches(self, description, fragment_paths):
+        """
+        :returns: True if any keyword is found in description or any of
+                  fragment_paths
+        """
+        if self._regex.search(description):
+            return True
+        for path in fragment_paths:
+            matched = self._fragment_matches.get(path)
+            if matched is None:
+                matched = bool(self._regex.search(path))
+                self._fragment_matches[path] = matched
+            if matched:
+                return True
+        return False
+
+
+def _build_job_configs(jobs, base_yamls, schedule_args, fragment_cache):
+    """
+    For each job generated by schedule_suite(), build the job config that
+    teuthology-schedule would have built.
+
+    :returns: A generator of (job_config, num) tuples, for use with
+              schedule.schedule_jobs()
+    """
+    for job in jobs:
+        log.info('Scheduling %s', job['desc'])
+        args = dict(schedule_args)
+        args['--description'] = job['desc']
+        args['<conf_file>'] = base_yamls + job['fragments']
+        conf_dict = fragment_cache.merge_configs(args['<conf_file>'])
+        yield (schedule.build_config(args, conf_dict), args['--num'])
+
+
+# Use libyaml's loaders when they are available; they are much faster
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+SafeYamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class FragmentCache(object):
+    """
+    Reads and parses each yaml fragment at most once, so that building many
+    jobs out of the same few hundred fragments doesn't mean parsing them over
+    and over again.
+
+    load() returns the same result as concatenating the fragments' text and
+    parsing that. When the fragments are top-level mappings, that is
+    equivalent to a dict.update() with each fragment in turn. Fragments for
+    which that does not hold - e.g. ones using aliases defined elsewhere, or
+    containing document markers - cause load() to fall back to parsing the
+    concatenated text.
+    """
+    # Document markers and directives change the meaning of the text
+    # following them once fragments are concatenated
+    _doc_markers = re.compile(r'^(---|\.\.\.|%)', re.MULTILINE)
+
+    def __init__(self, loader=YamlLoader, safe_loader=SafeYamlLoader):
+        self.loader = loader
+        self.safe_loader = safe_loader
+        self._raw = dict()
+        self._parsed = dict()
+        self._safe_parsed = dict()
+
+    def read(self, path):
+        """
+        :returns: The raw text of the fragment at path
+        """
+        if path not in self._raw:
+            with file(path, 'r') as f:
+                self._raw[path] = f.read()
+        return self._raw[path]
+
+    def parse(self, path):
+        """
+        :returns: The parsed fragment at path (which must not be modified),
+                  or NotImplemented if the fragment can't be parsed on its
+                  own.
+        """
+        if path not in self._parsed:
+            text = self.read(path)
+            parsed = NotImplemented
+            if self._is_standalone(text):
+                try:
+                    parsed = yaml.load(text, Loader=self.loader)
+                except yaml.YAMLError:
+                    pass
+                if parsed is not None and not isinstance(parsed, dict):
+                    parsed = NotImplemented
+            self._parsed[path] = parsed
+        return self._parsed[path]
+
+    def _is_standalone(self, text):
+        """
+        :returns: False if parsing text on its own might not give the same
+                  result as parsing it as part of a concatenation.
+        """
+        if self._doc_markers.search(text):
+            return False
+        for line in text.splitlines():
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#'):
+                continue
+            # Leading indentation would continue the last block of the
+            # preceding fragment
+            return not line[0].isspace()
+        return True
+
+    def load(self, paths):
+        """
+        :param paths: A list of paths to yaml fragments
+        :returns:     The result of parsing the concatenation of all
+                      fragments. It is not shared with the cache, so callers
+                      are free to modify it.
+        """
+        result = dict()
+        for path in paths:
+            parsed = self.parse(path)
+            if parsed is NotImplemented:
+                raw_yaml = '\n'.join([self.read(a) for a in paths])
+                return yaml.load(raw_yaml, Loader=self.loader)
+            if parsed:
+                result.update(parsed)
+        return _copy_parsed_yaml(result)
+
+
+    def merge_configs(self, paths):
+        """
+        Like misc.merge_configs(), but each file is only read and parsed
+        once. Paths that don't exist are skipped.
+
+        :returns: The merged configuration; it is not shared with the cache.
+        """
+        conf_dict = dict()
+        for path in paths:
+            if path not in self._safe_parsed:
+                if not os.path.exists(path):
+                    log.debug("The config path {0} does not exist, "
+                              "skipping.".format(path))
+                    self._safe_parsed[path] = NotImplemented
+                else:
+                    self._safe_parsed[path] = yaml.load(
+                        self.read(path), Loader=self.safe_loader)
+            partial_dict = self._safe_parsed[path]
+            if partial_dict is NotImplemented:
+                continue
+            conf_dict = deep_merge(conf_dict, _copy_parsed_yaml(partial_dict))
+        return conf_dict
+
+
+def _copy_parsed_yaml(obj):
+    """
+    A faster copy.deepcopy() for the plain dicts, lists and scalars that
+    make up parsed yaml.
+    """
+    if isinstance(obj, dict):
+        return dict((k, _copy_parsed_yaml(v)) for (k, v) in obj.iteritems())
+    if isinstance(obj, list):
+        return [_copy_parsed_yaml(v) for v in obj]
+    if isinstance(obj, (basestring, int, long, float, bool, type(None))):
+        return obj
+    return copy.deepcopy(obj)
+
+
+def get_rerun_descriptions(run_name, statuses=('fail', 'dead')):
+    """
+    Find the descriptions of the jobs in a previous run that ended with one
+    of the given statuses. The results server is asked first; if it is not
+    configured or can't be reached, the run's archive is used.
+
+    :param run_name: The name of the previous run
+    :param statuses: The statuses of the jobs to rerun
+    :returns:        A set of job descriptions
+    """
+    jobs = None
+    if config.results_server:
+        try:
+            jobs = ResultsReporter().get_jobs(
+                run_name, fields=['description', 'status'])
+        except report_exceptions:
+            log.exception("Could not get jobs for %s from %s", run_name,
+                          config.results_server)
+    if jobs is None:
+        serializer = ResultsSerializer(config.archive_base)
+        jobs = []
+        for job_id in serializer.jobs_for_run(run_name):
+            job_info = serializer.job_info(run_name, job_id)
+            job_info['status'] = get_status(job_info)
+            jobs.append(job_info)
+    descriptions = set()
+    for job in jobs:
+        if job.get('status') in statuses and job.get('description'):
+            descriptions.add(job['description'])
+    log.info("Found %d jobs to rerun in %s", len(descriptions), run_name)
+    return descriptions
+
+
 def get_install_task_flavor(job_config):
     """
     Pokes through the install task's configuration (including its overrides) to
     figure out which flavor it will want to install.
 
     Only looks at the first instance of the install task in job_config.
+    job_config is not modified.
     """
     project, = job_config.get('project', 'ceph'),
     tasks = job_config.get('tasks', dict())
@@ -644,9 +988,10 @@ def get_install_task_flavor(job_config):
         if task.keys()[0] == 'install':
             first_install_config = task.values()[0] or dict()
             break
-    first_install_config = copy.deepcopy(first_install_config)
-    deep_merge(first_install_config, install_overrides)
-    deep_merge(first_install_config, project_overrides)
+    first_install_config = deep_merged(first_install_config,
+                                       install_overrides)
+    first_install_config = deep_merged(first_install_config,
+                                       project_overrides)
     return get_flavor(first_install_config)
 
 
@@ -707,6 +1052,152 @@ def get_package_versions(sha1, os_type, kernel_flavor, package_versions=None):
     return package_versions
 
 
+def prefetch_package_versions(combinations, package_versions=None,
+                              cache=None, max_concurrency=10):
+    """
+    Like get_package_versions(), but for many (sha1, os_type, kernel_flavor)
+    combinations at once. Results are looked up in a PackageVersionCache
+    first; the remaining combinations are resolved concurrently, with at most
+    max_concurrency requests to gitbuilder in flight.
+
+    :param combinations:     An iterable of (sha1, os_type, kernel_flavor)
+                             tuples
+    :param package_versions: Use this optionally to use cached results of
+                             previous calls to gitbuilder.
+    :param cache:            A PackageVersionCache. If None, one is created
+                             using the default location.
+    :param max_concurrency:  The maximum number of concurrent requests
+    :returns:                A dict of package versions, in the format
+                             described in get_package_versions()
+    """
+    if not package_versions:
+        package_versions = dict()
+    if cache is None:
+        cache = PackageVersionCache()
+
+    def _store(sha1, os_type, kernel_flavor, version):
+        package_versions.setdefault(sha1, dict()).setdefault(
+            os_type, dict())[kernel_flavor] = version
+
+    to_fetch = set()
+    for (sha1, os_type, kernel_flavor) in combinations:
+        os_type = str(os_type)
+        if kernel_flavor in package_versions.get(sha1, dict()).get(
+                os_type, dict()):
+            continue
+        version = cache.get(sha1, os_type, kernel_flavor)
+        if version:
+            _store(sha1, os_type, kernel_flavor, version)
+        else:
+            to_fetch.add((sha1, os_type, kernel_flavor))
+
+    def _fetch(sha1, os_type, kernel_flavor):
+        version = package_version_for_hash(sha1, kernel_flavor,
+                                           distro=os_type)
+        return (sha1, os_type, kernel_flavor, version)
+
+    if to_fetch:
+        log.debug("Querying gitbuilder for %d package versions",
+                  len(to_fetch))
+        with parallel(max_concurrency=max_concurrency) as p:
+            for combination in to_fetch:
+                p.spawn(_fetch, *combination)
+            for (sha1, os_type, kernel_flavor, version) in p:
+                _store(sha1, os_type, kernel_flavor, version)
+                if version:
+                    cache.set(sha1, os_type, kernel_flavor, version)
+        cache.save()
+    return package_versions
+
+
+class PackageVersionCache(object):
+    """
+    A cache of the package versions gitbuilder reported for combinations of
+    sha1, os_type and kernel flavor, kept in a yaml file so that it can be
+    shared between runs of teuthology-suite and jobs' package checks.
+
+    Only versions that were found are cached, and only for ttl seconds, since
+    packages that are missing now may be built later.
+    """
+    def __init__(self, path=None, ttl=None):
+        """
+        :param path: The cache file. Defaults to package_versions.yaml in
+                     config.suite_cache_dir. If neither is set, nothing is
+                     read or written.
+        :param ttl:  How long entries are valid, in seconds. Defaults to
+                     config.package_versions_cache_ttl.
+        """
+        if path is None and config.suite_cache_dir:
+            path = os.path.join(config.suite_cache_dir,
+                                'package_versions.yaml')
+        self.path = path
+        if ttl is None:
+            ttl = config.package_versions_cache_ttl
+        self.ttl = ttl
+        self.entries = self._load()
+        self.dirty = False
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return dict()
+        try:
+            with file(self.path) as f:
+                entries = yaml.safe_load(f)
+        except (IOError, yaml.YAMLError):
+            log.debug("Ignoring unreadable package version cache %s",
+                      self.path, exc_info=True)
+            return dict()
+        if not isinstance(entries, dict):
+            return dict()
+        return entries
+
+    def _key(self, sha1, os_type, kernel_flavor):
+        return '/'.join([str(sha1), str(os_type), str(kernel_flavor)])
+
+    def get(self, sha1, os_type, kernel_flavor):
+        """
+        :returns: The cached version, or None
+        """
+        entry = self.entries.get(self._key(sha1, os_type, kernel_flavor))
+        if not entry or time.time() - entry['timestamp'] > self.ttl:
+            return None
+        return entry['version']
+
+    def set(self, sha1, os_type, kernel_flavor, version):
+        self.entries[self._key(sha1, os_type, kernel_flavor)] = dict(
+            version=str(version),
+            timestamp=time.time(),
+        )
+        self.dirty = True
+
+    def save(self):
+        """
+        Write the cache back to disk, dropping expired entries. Failures are
+        logged and otherwise ignored.
+        """
+        if not self.path or not self.dirty:
+            return
+        now = time.time()
+        entries = dict(
+            (key, entry) for (key, entry) in self.entries.iteritems()
+            if now - entry['timestamp'] <= self.ttl)
+        cache_dir = os.path.dirname(self.path)
+        temp_path = None
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            (fd, temp_path) = mkstemp(dir=cache_dir, prefix='.package_')
+            with os.fdopen(fd, 'w') as temp_file:
+                yaml.safe_dump(entries, temp_file, default_flow_style=False)
+            os.rename(temp_path, self.path)
+            self.dirty = False
+        except (IOError, OSError):
+            log.debug("Could not write package version cache %s",
+                      self.path, exc_info=True)
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
 def has_packages_for_distro(sha1, os_type, kernel_flavor,
                             package_versions=None):
     """
@@ -786,13 +1277,18 @@ def generate_combinations(path, mat, generate_from, generate_to):
     component will appear as a file with braces listing the selection
     of chosen subitems.
     """
-    ret = []
-    for i in range(generate_from, generate_to):
-        output = mat.index(i)
-        ret.append((
+    return list(iter_combinations(path, mat, generate_from, generate_to))
+
+
+def iter_combinations(path, mat, generate_from, generate_to):
+    """
+    Like generate_combinations(), but yields the (description, [file list])
+    tuples one at a time instead of building the whole list up front.
+    """
+    for output in mat.index_range(generate_from, generate_to):
+        yield (
             matrix.generate_desc(combine_path, output),
-            matrix.generate_paths(path, output, combine_path)))
-    return ret
+            matrix.generate_paths(path, output, combine_path))
 
 
 def build_matrix(path, _isfile=os.path.isfile,
@@ -837,12 +1333,52 @@ def build_matrix(path, _isfile=os.path.isfile,
     :param _listdir:	Custom os.listdir(); for testing only
     :param subset:	(index, outof)
     """
+    return list(iter_matrix(path, _isfile, _isdir, _listdir, subset))
+
+
+def iter_matrix(path, _isfile=os.path.isfile,
+                _isdir=os.path.isdir,
+                _listdir=os.listdir,
+                subset=None):
+    """
+    A generator version of build_matrix(). Jobs are yielded one at a time as
+    (description, [file list]) tuples, so callers that stop early (e.g. due to
+    --limit) never pay for generating the rest of the suite.
+
+    See build_matrix() for a description of the parameters.
+    """
+    (mat, first, matlimit) = get_matrix_range(path, _isfile, _isdir,
+                                              _listdir, subset)
+    return iter_combinations(path, mat, first, matlimit)
+
+
+def get_matrix_range(path, _isfile=os.path.isfile,
+                     _isdir=os.path.isdir,
+                     _listdir=os.listdir,
+                     subset=None):
+    """
+    Build the matrix for path and figure out which of its indices belong to
+    the requested subset.
+
+    :param path:        The path to search for yaml fragments
+    :param subset:      (index, outof)
+    :returns:           A tuple: (matrix, first_index, index_limit)
+    """
+    # Only the real filesystem can be cached; the _isfile, _isdir and
+    # _listdir overrides are used by the tests to build matrices from fake
+    # directory trees.
+    use_cache = (_isfile is os.path.isfile and _isdir is os.path.isdir and
+                 _listdir is os.listdir)
     mat = None
     first = None
     matlimit = None
     if subset:
         (index, outof) = subset
-        mat = _build_matrix(path, _isfile, _isdir, _listdir, mincyclicity=outof)
+        if use_cache:
+            mat = build_matrix_cached(path, mincyclicity=outof)
+        else:
+            mat = _build_matrix(path, _isfile, _isdir, _listdir,
+                                mincyclicity=outof)
         first = (mat.size() / outof) * index
         if index == outof or index == outof - 1:
             matlimit = mat.size()
@@ -850,9 +1386,120 @@ def build_matrix(path, _isfile=os.path.isfile,
             matlimit = (mat.size() / outof) * (index + 1)
     else:
         first = 0
-        mat = _build_matrix(path, _isfile, _isdir, _listdir)
+        if use_cache:
+            mat = build_matrix_cached(path)
+        else:
+            mat = _build_matrix(path, _isfile, _isdir, _listdir)
         matlimit = mat.size()
-    return generate_combinations(path, mat, first, matlimit)
+    return (mat, first, matlimit)
+
+
+# Bump this whenever the layout of the matrix classes or of the cache files
+# changes, so that stale pickles are ignored
+MATRIX_CACHE_VERSION = 2
+
+
+def build_matrix_cached(path, mincyclicity=0, cache_dir=None):
+    """
+    Like _build_matrix(), but store the result on disk in cache_dir and reuse
+    it on subsequent calls.
+
+    The matrix only depends on the names and types of the entries in each
+    directory of the suite, never on the contents of the yaml fragments. Any
+    change to a directory's entries updates that directory's mtime, so the
+    cache entry records the mtime of every directory visited while building
+    the matrix. A cached matrix is used only if all of those mtimes are
+    unchanged; validating it costs one stat() per directory instead of a full
+    walk of the suite.
+
+    :param path:         The path to search for yaml fragments
+    :param mincyclicity: Passed to _build_matrix()
+    :param cache_dir:    Where to keep the cache. Defaults to
+                         config.suite_cache_dir. If that is empty as well,
+                         caching is disabled.
+    :returns:            A matrix.Matrix object
+    """
+    cache_dir = cache_dir or config.suite_cache_dir
+    if not cache_dir:
+        return _build_matrix(path, mincyclicity=mincyclicity)
+
+    path = os.path.abspath(path)
+    key = hashlib.sha1(
+        '{0}:{1}'.format(path, mincyclicity)).hexdigest()
+    cache_path = os.path.join(cache_dir, 'matrix', key + '.pickle')
+    mat = _load_cached_matrix(cache_path, path, mincyclicity)
+    if mat is not None:
+        log.debug("Using cached matrix for %s from %s", path, cache_path)
+        return mat
+
+    dir_mtimes = dict()
+
+    def _listdir(dir_path):
+        # stat() before listdir(), so that a change racing with us
+        # invalidates the entry we are about to write
+        dir_mtimes[dir_path] = os.stat(dir_path).st_mtime
+        return os.listdir(dir_path)
+
+    mat = _build_matrix(path, _listdir=_listdir, mincyclicity=mincyclicity)
+    if mat is not None:
+        _store_cached_matrix(cache_path, dict(
+            version=MATRIX_CACHE_VERSION,
+            path=path,
+            mincyclicity=mincyclicity,
+            dir_mtimes=dir_mtimes,
+            matrix=mat,
+        ))
+    return mat
+
+
+def _load_cached_matrix(cache_path, path, mincyclicity):
+    """
+    :returns: The cached matrix stored in cache_path, or None if there is no
+              such entry or it is out of date.
+    """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            entry = pickle.load(cache_file)
+    except IOError:
+        return None
+    except Exception:
+        log.debug("Ignoring unreadable matrix cache %s", cache_path,
+                  exc_info=True)
+        return None
+    if not isinstance(entry, dict) or \
+            entry.get('version') != MATRIX_CACHE_VERSION or \
+            entry.get('path') != path or \
+            entry.get('mincyclicity') != mincyclicity:
+        return None
+    for dir_path, mtime in entry['dir_mtimes'].iteritems():
+        try:
+            if os.stat(dir_path).st_mtime != mtime:
+                return None
+        except OSError:
+            return None
+    return entry['matrix']
+
+
+def _store_cached_matrix(cache_path, entry):
+    """
+    Atomically write a matrix cache entry. Failures are logged and otherwise
+    ignored, since the cache is only an optimization.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    temp_path = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        (fd, temp_path) = mkstemp(dir=cache_dir, prefix='.matrix_')
+        with os.fdopen(fd, 'wb') as temp_file:
+            pickle.dump(entry, temp_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError):
+        log.debug("Could not write matrix cache %s", cache_path,
+                  exc_info=True)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
 
 def _build_matrix(path, _isfile=os.path.isfile,
                   _isdir=os.path.isdir, _listdir=os.listdir, mincyclicity=0, item=''):
@@ -955,24 +1602,26 @@ def substitute_placeholders(input_dict, values_dict):
     :param values_dict: A dict, with keys matching the 'name' attributes of all
                         of the Placeholder instances in the input_dict, and
                         values to be substituted.
-    :returns:           The modified input_dict
+    :returns:           A modified copy of input_dict
     """
-    input_dict = copy.deepcopy(input_dict)
-
-    def _substitute(input_dict, values_dict):
-        for key, value in input_dict.items():
+    def _substitute(input_dict):
+        # Build the copy as we go rather than deep-copying input_dict and
+        # then walking it a second time.
+        output_dict = dict()
+        for key, value in input_dict.iteritems():
             if isinstance(value, dict):
-                _substitute(value, values_dict)
+                output_dict[key] = _substitute(value)
             elif isinstance(value, Placeholder):
-                if values_dict[value.name] is None:
-                    del input_dict[key]
-                    continue
                 # If there is a Placeholder without a corresponding entry in
                 # values_dict, we will hit a KeyError - we want this.
-                input_dict[key] = values_dict[value.name]
-        return input_dict
+                if values_dict[value.name] is None:
+                    continue
+                output_dict[key] = values_dict[value.name]
+            else:
+                output_dict[key] = _copy_parsed_yaml(value)
+        return output_dict
 
-    return _substitute(input_dict, values_dict)
+    return _substitute(input_dict)
 
 
 # Template for the config that becomes the base for each generated job config
@@ -18,7 +18,9 @@ from teuthology import provision
 from teuthology.job_status import get_status, set_status
 from teuthology.config import config as teuth_config
 from teuthology.parallel import parallel
-from teuthology.suite import has_packages_for_distro, get_install_task_flavor
+from teuthology.suite import (has_packages_for_distro,
+                              get_install_task_flavor,
+                              prefetch_package_versions)
 from ..orchestra import cluster, remote, run
 from .. import report
 
@@ -245,7 +247,11 @@ def check_packages(ctx, config):
                 ver=sha1,
             )
         )
-        if not has_packages_for_distro(sha1, os_type, flavor):
+        # Consult the same on-disk cache that teuthology-suite fills in
+        package_versions = prefetch_package_versions(
+            [(sha1, os_type, flavor)])
+        if not has_packages_for_distro(sha1, os_type, flavor,
+                                       package_versions):
             msg = "Packages for os_type '{os}' and ceph hash '{ver}' not found"
             msg = msg.format(
                 os=os_type,
@@ -299,6 +305,9 @@ def add_remotes(ctx, config):
             pass
         rem = remote.Remote(name=t, host_key=key, keep_alive=True)
         remotes.append(rem)
+    if ctx.archive:
+        # e.g. teuthology-nuke --archive can use what the job found out
+        load_facts(remotes, os.path.join(ctx.archive, 'facts.yaml'))
     ctx.cluster = cluster.Cluster()
     if 'roles' in ctx.config:
         for rem, roles in zip(remotes, ctx.config['roles']):
@@ -319,6 +328,46 @@ def connect(ctx, config):
     for rem in ctx.cluster.remotes.iterkeys():
         log.debug('connecting to %s', rem.name)
         rem.connect()
+    if ctx.archive:
+        facts_path = os.path.join(ctx.archive, 'facts.yaml')
+        if not os.path.exists(facts_path):
+            try:
+                save_facts(ctx.cluster.remotes.keys(), facts_path)
+            except Exception:
+                log.exception("Could not save facts about the remotes")
+
+
+def _get_facts(remote):
+    return (remote.name, remote.facts)
+
+
+def save_facts(remotes, path):
+    """
+    Gather the facts about each of remotes, if we don't have them already,
+    and write them to path as yaml.
+    """
+    facts = dict()
+    with parallel() as p:
+        for rem in remotes:
+            p.spawn(_get_facts, rem)
+        for (name, rem_facts) in p:
+            facts[name] = rem_facts
+    with file(path, 'w') as f:
+        yaml.safe_dump(facts, f, default_flow_style=False)
+
+
+def load_facts(remotes, path):
+    """
+    Set the facts about each of remotes from the yaml file at path, as
+    written by save_facts(), if there is one.
+    """
+    if not os.path.exists(path):
+        return
+    with file(path) as f:
+        facts = yaml.safe_load(f) or dict()
+    for rem in remotes:
+        if rem.name in facts:
+            rem.facts = facts[rem.name]
 
 
 def push_inventory(ctx, config):
@@ -431,6 +480,27 @@ def fetch_binaries_for_coredumps(path, remote):
             remote.get_file(debug_path, coredump_path)
 
 
+def pull_archive(remote, archive_dir, path):
+    """
+    Pull a remote's archive directory into path, along with the binaries for
+    any coredumps.
+
+    :returns: A tuple of remote.shortname and a dict with the total size of
+              the files pulled, uncompressed, in bytes, and how long it
+              took, in seconds
+    """
+    start = time.time()
+    size = misc.pull_directory(
+        remote, archive_dir, path,
+        bandwidth_limit=teuth_config.archive_bandwidth_limit)
+    # Check for coredumps and pull binaries
+    fetch_binaries_for_coredumps(path, remote)
+    duration = time.time() - start
+    log.info('Pulled %d bytes of files from %s in %.1fs', size,
+             remote.shortname, duration)
+    return (remote.shortname, dict(size=size, duration=duration))
+
+
 @contextlib.contextmanager
 def archive(ctx, config):
     """
@@ -461,11 +531,15 @@ def archive(ctx, config):
             logdir = os.path.join(ctx.archive, 'remote')
             if (not os.path.exists(logdir)):
                 os.mkdir(logdir)
-            for rem in ctx.cluster.remotes.iterkeys():
-                path = os.path.join(logdir, rem.shortname)
-                misc.pull_directory(rem, archive_dir, path)
-                # Check for coredumps and pull binaries
-                fetch_binaries_for_coredumps(path, rem)
+            transfers = dict()
+            with parallel(
+                    max_concurrency=teuth_config.archive_concurrency) as p:
+                for rem in ctx.cluster.remotes.iterkeys():
+                    path = os.path.join(logdir, rem.shortname)
+                    p.spawn(pull_archive, rem, archive_dir, path)
+                for (shortname, transfer) in p:
+                    transfers[shortname] = transfer
+            ctx.summary['archive_transfers'] = transfers
 
         log.info('Removing archive directory...')
         run.wait(
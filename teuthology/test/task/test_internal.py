@@ -0,0 +1,61 @@
+from mock import patch, Mock
+
+from teuthology.config import config, FakeNamespace
+from teuthology.task import internal
+
+
+class TestArchive(object):
+    def setup(self):
+        self.ctx = FakeNamespace()
+        self.ctx.config = dict()
+        self.ctx.summary = dict(success=True)
+        self.remotes = [Mock(shortname='host%d' % i) for i in range(3)]
+        self.ctx.cluster = Mock(remotes=dict(
+            (rem, ['role%d' % i]) for (i, rem) in enumerate(self.remotes)))
+
+    @patch('teuthology.task.internal.run.wait')
+    @patch('teuthology.task.internal.fetch_binaries_for_coredumps')
+    @patch('teuthology.task.internal.misc')
+    def test_archive(self, m_misc, m_fetch, m_wait, tmpdir):
+        self.ctx.archive = str(tmpdir)
+        m_misc.get_archive_dir.return_value = '/archive'
+        m_misc.pull_directory.side_effect = \
+            lambda rem, archive_dir, path, bandwidth_limit: \
+            int(rem.shortname[-1]) * 1000
+        with patch.dict(config._conf, archive_concurrency=2,
+                        archive_bandwidth_limit=1000000):
+            with internal.archive(self.ctx, None):
+                pass
+        assert m_misc.pull_directory.call_count == 3
+        for rem in self.remotes:
+            m_misc.pull_directory.assert_any_call(
+                rem, '/archive', str(tmpdir.join('remote', rem.shortname)),
+                bandwidth_limit=1000000)
+            m_fetch.assert_any_call(
+                str(tmpdir.join('remote', rem.shortname)), rem)
+        transfers = self.ctx.summary['archive_transfers']
+        assert sorted(transfers.keys()) == ['host0', 'host1', 'host2']
+        assert transfers['host2']['size'] == 2000
+        assert transfers['host2']['duration'] >= 0
+
+
+class TestFacts(object):
+    def test_save_and_load(self, tmpdir):
+        path = str(tmpdir.join('facts.yaml'))
+        remotes = [Mock(facts=dict(arch='x86_64')),
+                   Mock(facts=dict(arch='aarch64'))]
+        remotes[0].name = 'host1'
+        remotes[1].name = 'host2'
+        internal.save_facts(remotes, path)
+        new_remotes = [Mock(), Mock(), Mock()]
+        for (i, rem) in enumerate(new_remotes):
+            rem.name = 'host%d' % (i + 1)
+        internal.load_facts(new_remotes, path)
+        assert new_remotes[0].facts == dict(arch='x86_64')
+        assert new_remotes[1].facts == dict(arch='aarch64')
+        assert isinstance(new_remotes[2].facts, Mock)
+
+    def test_load_missing(self, tmpdir):
+        rem = Mock()
+        internal.load_facts([rem], str(tmpdir.join('facts.yaml')))
+        assert isinstance(rem.facts, Mock)
@@ -0,0 +1,233 @@
+import beanstalkc
+import time
+import yaml
+
+from mock import patch, Mock
+
+from .. import beanstalk
+from ..config import config
+
+
+class FakeConnection(object):
+    """
+    Just enough of beanstalkc.Connection to walk a queue. Reserving is not
+    supported, so walking must not reserve anything.
+    """
+    host = 'queue.example.com'
+    port = 11300
+
+    def __init__(self):
+        self.jobs = dict()
+        self.next_id = 1
+        self.tube = 'default'
+        self.peeks = 0
+        self.stats_jobs = 0
+
+    def add(self, tube, job_config, state='ready', created=None):
+        jid = self.next_id
+        self.next_id += 1
+        if created is None:
+            created = int(time.time())
+        self.jobs[jid] = dict(tube=tube, state=state, created=created,
+                              body=yaml.safe_dump(job_config))
+        return jid
+
+    def using(self):
+        return self.tube
+
+    def use(self, tube):
+        self.tube = tube
+
+    def put(self, body):
+        return self.add(self.tube, body)
+
+    def delete(self, jid):
+        if jid not in self.jobs:
+            raise beanstalkc.CommandFailed('delete', 'NOT_FOUND', [])
+        del self.jobs[jid]
+
+    def stats_tube(self, tube):
+        ready = [job for job in self.jobs.values()
+                 if job['tube'] == tube and job['state'] == 'ready']
+        return {'current-jobs-ready': len(ready)}
+
+    def stats_job(self, jid):
+        self.stats_jobs += 1
+        if jid not in self.jobs:
+            raise beanstalkc.CommandFailed('stats-job', 'NOT_FOUND', [])
+        job = self.jobs[jid]
+        return dict(id=jid, tube=job['tube'], state=job['state'],
+                    age=int(time.time()) - job['created'])
+
+    def peek(self, jid):
+        self.peeks += 1
+        if jid not in self.jobs:
+            return None
+        return beanstalkc.Job(self, jid, self.jobs[jid]['body'],
+                              reserved=False)
+
+    def peek_ready(self):
+        ready = [jid for (jid, job) in self.jobs.items()
+                 if job['tube'] == self.tube and job['state'] == 'ready']
+        if ready:
+            return self.peek(min(ready))
+
+
+class TestWalkJobs(object):
+    def setup(self):
+        self.conn = FakeConnection()
+        self.ids = []
+        for i in range(3):
+            self.ids.append(self.conn.add(
+                'plana', dict(name='run%d' % i, description='desc',
+                              priority=100, extra='stuff')))
+            # Noise the walk has to skip over
+            self.conn.add('mira', dict(name='other'))
+            self.conn.add('plana', dict(name='reserved'), state='reserved')
+        gone = self.conn.add('plana', dict(name='gone'))
+        self.conn.delete(gone)
+
+    def test_iter_jobs(self):
+        jobs = list(beanstalk.iter_jobs(self.conn, 'plana'))
+        assert [job_id for (job_id, _, _) in jobs] == self.ids[::-1]
+        assert [c['name'] for (_, c, _) in jobs] == ['run2', 'run1', 'run0']
+        assert jobs[0][1]['extra'] == 'stuff'
+        # Nothing was reserved, and the probe job is gone
+        assert [j['state'] for j in self.conn.jobs.values()].count(
+            'ready') == 6
+
+    def test_iter_jobs_clears_old_probes(self):
+        self.conn.add(beanstalk.probe_tube, '')
+        list(beanstalk.iter_jobs(self.conn, 'plana'))
+        assert self.conn.stats_tube(beanstalk.probe_tube) == \
+            {'current-jobs-ready': 0}
+
+    def test_iter_jobs_delete(self):
+        for (job_id, job_config, job) in beanstalk.iter_jobs(self.conn,
+                                                             'plana'):
+            if job_config['name'] == 'run1':
+                job.delete()
+        assert self.ids[1] not in self.conn.jobs
+        assert self.ids[0] in self.conn.jobs
+
+    def test_walk_jobs_caches_headers(self, tmpdir):
+        with patch.dict(config._conf, suite_cache_dir=str(tmpdir)):
+            processor = beanstalk.JobProcessor()
+            beanstalk.walk_jobs(self.conn, 'plana', processor)
+            assert self.conn.peeks == 3
+            assert processor.jobs[str(self.ids[0])]['job_config'] == \
+                dict(name='run0', description='desc', priority=100)
+
+            self.conn.peeks = 0
+            processor = beanstalk.JobProcessor()
+            beanstalk.walk_jobs(self.conn, 'plana', processor, pattern='run1')
+            assert self.conn.peeks == 0
+            assert processor.jobs.keys() == [str(self.ids[1])]
+
+    def test_walk_jobs_full(self, tmpdir):
+        with patch.dict(config._conf, suite_cache_dir=str(tmpdir)):
+            beanstalk.walk_jobs(self.conn, 'plana', beanstalk.JobProcessor())
+            self.conn.peeks = 0
+            processor = beanstalk.JobProcessor()
+            processor.needs_body = True
+            beanstalk.walk_jobs(self.conn, 'plana', processor)
+            assert processor.jobs[str(self.ids[0])]['job_config']['extra'] \
+                == 'stuff'
+            assert self.conn.peeks == 3
+
+    def test_walk_jobs_reused_ids(self, tmpdir):
+        with patch.dict(config._conf, suite_cache_dir=str(tmpdir)):
+            beanstalk.walk_jobs(self.conn, 'plana', beanstalk.JobProcessor())
+            # The server restarts without a binlog, and hands out the same
+            # ids to new jobs
+            self.conn = FakeConnection()
+            old = int(time.time()) - 3600
+            self.conn.add('plana', dict(name='new0'), created=old)
+            self.conn.add('plana', dict(name='new1'), created=old)
+            processor = beanstalk.JobProcessor()
+            beanstalk.walk_jobs(self.conn, 'plana', processor)
+            assert self.conn.peeks == 2
+            assert [job['job_config']['name'] for job in
+                    processor.jobs.values()] == ['new1', 'new0']
+
+    def test_delete_ignores_cache(self, tmpdir):
+        with patch.dict(config._conf, suite_cache_dir=str(tmpdir)):
+            beanstalk.walk_jobs(self.conn, 'plana', beanstalk.JobProcessor())
+            # Make the cached header for run1 wrong
+            self.conn.jobs[self.ids[1]]['body'] = yaml.safe_dump(
+                dict(name='keep', description=None, priority=100))
+            with patch.object(beanstalk.report, 'try_delete_jobs'):
+                beanstalk.walk_jobs(self.conn, 'plana',
+                                    beanstalk.JobDeleter('run1'))
+            assert self.ids[1] in self.conn.jobs
+
+    def test_walk_stops_below_floor(self, tmpdir):
+        self.conn = FakeConnection()
+        for i in range(50):
+            self.conn.delete(self.conn.add('plana', dict(name='done')))
+        old = self.conn.add('plana', dict(name='run0'))
+        new = self.conn.add('plana', dict(name='run1'))
+        with patch.dict(config._conf, suite_cache_dir=str(tmpdir)):
+            beanstalk.walk_jobs(self.conn, 'plana', beanstalk.JobProcessor())
+            # A worker reserves the oldest job after the ready jobs were
+            # counted, so this walk can never find them all
+            self.conn.jobs[old]['state'] = 'reserved'
+            self.conn.stats_jobs = 0
+            cache = beanstalk.JobHeaderCache.for_connection(self.conn)
+            with patch.object(self.conn, 'stats_tube',
+                              return_value={'current-jobs-ready': 2}):
+                with patch.object(beanstalk, 'max_misses', 5):
+                    jobs = list(beanstalk.iter_jobs(self.conn, 'plana',
+                                                    cache))
+        assert [job_id for (job_id, _, _) in jobs] == [new]
+        # The last walk's probe, both jobs, then misses down to five below
+        # the last run1
+        assert self.conn.stats_jobs == 7
+
+    def test_walk_rechecks_count(self):
+        self.conn = FakeConnection()
+        for i in range(50):
+            self.conn.delete(self.conn.add('plana', dict(name='done')))
+        old = self.conn.add('plana', dict(name='run0'))
+        new = self.conn.add('plana', dict(name='run1'))
+        stats_tube = self.conn.stats_tube
+
+        def reserve_old(tube):
+            # A worker reserves the oldest job just after the ready jobs
+            # were counted
+            stats = stats_tube(tube)
+            self.conn.jobs[old]['state'] = 'reserved'
+            return stats
+        with patch.object(self.conn, 'stats_tube', side_effect=reserve_old):
+            with patch.object(beanstalk, 'max_misses', 5):
+                jobs = list(beanstalk.iter_jobs(self.conn, 'plana'))
+        assert [job_id for (job_id, _, _) in jobs] == [new]
+        # run1, then five misses, after which there was nothing left to find
+        assert self.conn.stats_jobs == 6
+
+    def test_walk_jobs_without_cache_dir(self, tmpdir):
+        with patch.dict(config._conf, suite_cache_dir=''):
+            processor = beanstalk.JobProcessor()
+            beanstalk.walk_jobs(self.conn, 'plana', processor)
+            beanstalk.walk_jobs(self.conn, 'plana', processor)
+        assert self.conn.peeks == 6
+
+    def test_walk_jobs_empty(self):
+        processor = Mock()
+        beanstalk.walk_jobs(self.conn, 'smithi', processor)
+        assert not processor.add_job.called
+
+
+class TestWaitStats(object):
+    def test_print_wait_stats(self, capsys):
+        connection = Mock()
+        connection.wait_stats.return_value = dict(
+            alice=dict(jobs=1, mean=5.0, p50=5.0, p90=5.0, p99=5.0, max=5.0))
+        with patch('time.time', return_value=7200):
+            beanstalk.print_wait_stats(connection, '1')
+        connection.wait_stats.assert_called_once_with(since=3600)
+        out, err = capsys.readouterr()
+        assert yaml.safe_load(out)['alice']['jobs'] == 1
+
+    def test_beanstalkd_has_no_stats(self):
+        beanstalk.print_wait_stats(FakeConnection())
@@ -0,0 +1,365 @@
+import beanstalkc
+import sqlite3
+import yaml
+
+from mock import patch
+from pytest import raises
+
+from .. import beanstalk
+from .. import local_queue
+
+
+class QueueTest(object):
+    def setup(self):
+        self.patcher = patch.object(local_queue, 'poll_interval', 0.01)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def connect(self, tmpdir, fair_share=None):
+        return local_queue.Connection(str(tmpdir.join('queue.sqlite')),
+                                      fair_share=fair_share)
+
+    def put(self, conn, name, owner=None, **kwargs):
+        return conn.put(yaml.safe_dump(dict(name=name, owner=owner)),
+                        **kwargs)
+
+
+class TestLocalQueue(QueueTest):
+
+    def test_priority_order(self, tmpdir):
+        conn = self.connect(tmpdir)
+        conn.use('plana')
+        low = self.put(conn, 'run', priority=1000)
+        high = self.put(conn, 'run', priority=10)
+        also_high = self.put(conn, 'run', priority=10)
+        beanstalk.watch_tube(conn, 'plana')
+        reserved = [conn.reserve(timeout=0).jid for i in range(3)]
+        assert reserved == [high, also_high, low]
+        assert conn.reserve(timeout=0) is None
+
+    def test_tubes_are_separate(self, tmpdir):
+        conn = self.connect(tmpdir)
+        conn.use('mira')
+        self.put(conn, 'run')
+        beanstalk.watch_tube(conn, 'plana')
+        assert conn.reserve(timeout=0.05) is None
+        assert conn.stats_tube('mira')['current-jobs-ready'] == 1
+        assert conn.stats_tube('plana')['current-jobs-ready'] == 0
+
+    def test_delay(self, tmpdir):
+        conn = self.connect(tmpdir)
+        jid = self.put(conn, 'run', delay=0.05)
+        assert conn.stats_job(jid)['state'] == 'delayed'
+        assert conn.reserve(timeout=0) is None
+        assert conn.reserve(timeout=1).jid == jid
+
+    def test_two_connections_dont_share_jobs(self, tmpdir):
+        conn = self.connect(tmpdir)
+        other = self.connect(tmpdir)
+        jid = self.put(conn, 'run')
+        assert other.reserve(timeout=0).jid == jid
+        assert conn.reserve(timeout=0) is None
+        assert conn.stats_job(jid)['state'] == 'reserved'
+
+    def test_bury_and_kick(self, tmpdir):
+        conn = self.connect(tmpdir)
+        jid = self.put(conn, 'run')
+        job = conn.reserve(timeout=0)
+        job.bury()
+        assert conn.stats_job(jid)['state'] == 'buried'
+        assert conn.reserve(timeout=0) is None
+        assert conn.peek_buried().jid == jid
+        assert conn.kick(10) == 1
+        assert conn.reserve(timeout=0).jid == jid
+
+    def test_ttr(self, tmpdir):
+        conn = self.connect(tmpdir)
+        jid = self.put(conn, 'run', ttr=0)
+        assert conn.reserve(timeout=0).jid == jid
+        assert conn.stats_job(jid)['state'] == 'ready'
+        assert conn.reserve(timeout=0).jid == jid
+
+    def test_close_releases(self, tmpdir):
+        conn = self.connect(tmpdir)
+        jid = self.put(conn, 'run')
+        conn.reserve(timeout=0)
+        conn.close()
+        conn = self.connect(tmpdir)
+        assert conn.stats_job(jid)['state'] == 'ready'
+
+    def test_not_found(self, tmpdir):
+        conn = self.connect(tmpdir)
+        with raises(beanstalkc.CommandFailed):
+            conn.delete(42)
+        with raises(beanstalkc.CommandFailed):
+            conn.stats_job(42)
+        assert conn.peek(42) is None
+
+    def test_ids_not_reused(self, tmpdir):
+        conn = self.connect(tmpdir)
+        jid = self.put(conn, 'run')
+        conn.delete(jid)
+        assert self.put(conn, 'run') > jid
+
+    def test_body_roundtrip(self, tmpdir):
+        conn = self.connect(tmpdir)
+        body = yaml.safe_dump(dict(name='run', description='desc'))
+        jid = conn.put(body)
+        job = conn.peek(jid)
+        assert job.body == body
+        assert isinstance(job.body, str)
+
+    def test_delete_run(self, tmpdir):
+        conn = self.connect(tmpdir)
+        conn.use('plana')
+        doomed = [self.put(conn, 'doomed') for i in range(3)]
+        kept = self.put(conn, 'kept')
+        beanstalk.watch_tube(conn, 'plana')
+        running = conn.reserve(timeout=0)
+        assert running.jid == doomed[0]
+        # Workers bury the jobs they are running
+        conn.reserve(timeout=0).bury()
+        assert conn.delete_run('doomed', 'plana') == doomed[2:]
+        assert conn.stats_job(running.jid)['state'] == 'reserved'
+        assert conn.stats_job(doomed[1])['state'] == 'buried'
+        assert conn.stats_job(kept)['state'] == 'ready'
+        assert conn.run_job_ids('doomed', state='reserved') == [doomed[0]]
+
+    def test_walk_jobs(self, tmpdir):
+        conn = self.connect(tmpdir)
+        conn.use('plana')
+        ids = [self.put(conn, 'run%d' % i) for i in range(3)]
+        jobs = list(beanstalk.iter_jobs(conn, 'plana'))
+        assert [job_id for (job_id, _, _) in jobs] == ids[::-1]
+        # Walks check the age of cached jobs
+        assert conn.stats_job(ids[0])['age'] == 0
+
+    def test_queue_id(self, tmpdir):
+        conn = self.connect(tmpdir)
+        other = local_queue.Connection(
+            str(tmpdir.mkdir('other').join('queue.sqlite')))
+        assert conn.queue_id.startswith('local.queue.sqlite.')
+        assert conn.queue_id != other.queue_id
+        assert self.connect(tmpdir).queue_id == conn.queue_id
+
+    @patch('teuthology.beanstalk.config')
+    def test_connect(self, m_config, tmpdir):
+        m_config.queue_backend = 'local'
+        m_config.queue_path = str(tmpdir.join('queue.sqlite'))
+        conn = beanstalk.connect()
+        assert isinstance(conn, local_queue.Connection)
+        m_config.queue_path = None
+        with raises(RuntimeError):
+            beanstalk.connect()
+
+    @patch('teuthology.beanstalk.beanstalkc.Connection')
+    @patch('teuthology.beanstalk.log')
+    @patch('teuthology.beanstalk.config')
+    def test_beanstalkd_ignores_fair_share(self, m_config, m_log, m_conn):
+        m_config.queue_backend = 'beanstalk'
+        m_config.fair_share = dict(weights=dict(alice=2))
+        beanstalk.connect()
+        assert m_log.warning.called
+        m_config.fair_share = None
+        m_log.reset_mock()
+        beanstalk.connect()
+        assert not m_log.warning.called
+
+    def test_delete_big_run(self, tmpdir):
+        conn = self.connect(tmpdir)
+        body = yaml.safe_dump(dict(name='big'))
+        conn._execute("BEGIN")
+        for i in range(1500):
+            conn.put(body)
+        conn._execute("COMMIT")
+        assert len(conn.delete_run('big')) == 1500
+        assert conn.stats_tube('default')['current-jobs-ready'] == 0
+
+
+class TestFairShare(QueueTest):
+    def dispatch(self, conn, count):
+        owners = []
+        for i in range(count):
+            job = conn.reserve(timeout=0)
+            # Workers bury the jobs they are running
+            job.bury()
+            owners.append(yaml.safe_load(job.body)['owner'])
+        return owners
+
+    def test_owners_take_turns(self, tmpdir):
+        conn = self.connect(tmpdir, local_queue.FairShare())
+        for i in range(5):
+            self.put(conn, 'big', 'alice')
+        for i in range(2):
+            self.put(conn, 'small', 'bob')
+        assert self.dispatch(conn, 6) == \
+            ['alice', 'bob', 'alice', 'bob', 'alice', 'alice']
+
+    def test_without_fair_share(self, tmpdir):
+        conn = self.connect(tmpdir, None)
+        for i in range(3):
+            self.put(conn, 'big', 'alice')
+        self.put(conn, 'small', 'bob')
+        assert self.dispatch(conn, 4) == ['alice', 'alice', 'alice', 'bob']
+
+    def test_finished_jobs_free_the_share(self, tmpdir):
+        conn = self.connect(tmpdir, local_queue.FairShare())
+        for i in range(3):
+            self.put(conn, 'big', 'alice')
+            self.put(conn, 'small', 'bob')
+        job = conn.reserve(timeout=0)
+        job.bury()
+        job.delete()
+        # Nobody is running anything, so the oldest job goes first
+        assert self.dispatch(conn, 2) == ['bob', 'alice']
+
+    def test_dead_workers_jobs_stop_counting(self, tmpdir):
+        fair_share = local_queue.FairShare(running_window=100)
+        conn = self.connect(tmpdir, fair_share)
+        with patch.object(local_queue.time, 'time') as m_time:
+            m_time.return_value = 1000
+            self.put(conn, 'run1', 'alice')
+            second = self.put(conn, 'run1', 'alice')
+            other_run = self.put(conn, 'run2', 'alice')
+            # A worker dies while running run1's first job, leaving it
+            # buried
+            conn.reserve(timeout=0).bury()
+            m_time.return_value = 1200
+            # Counting every buried job, run1 would still be held back
+            forever = self.connect(tmpdir, local_queue.FairShare())
+            assert forever._next_job(1200) == other_run
+            assert conn.reserve(timeout=0).jid == second
+
+    def test_weights(self, tmpdir):
+        fair_share = local_queue.FairShare(weights=dict(alice=2))
+        conn = self.connect(tmpdir, fair_share)
+        for i in range(6):
+            self.put(conn, 'big', 'alice')
+            self.put(conn, 'small', 'bob')
+        assert self.dispatch(conn, 6).count('alice') == 4
+
+    def test_priority_is_strict(self, tmpdir):
+        conn = self.connect(tmpdir, local_queue.FairShare())
+        self.put(conn, 'big', 'alice', priority=10)
+        self.put(conn, 'big', 'alice', priority=10)
+        self.put(conn, 'small', 'bob', priority=100)
+        assert self.dispatch(conn, 3) == ['alice', 'alice', 'bob']
+
+    def test_runs_take_turns(self):
+        fair_share = local_queue.FairShare()
+        candidates = [
+            (1, 'alice', 'run1', 100, 0),
+            (5, 'alice', 'run2', 100, 0),
+        ]
+        running = {'alice': 3, ('alice', 'run1'): 3}
+        assert fair_share.choose(candidates, running, 0) == 5
+        assert fair_share.choose(candidates, dict(), 0) == 1
+        assert fair_share.choose([], dict(), 0) is None
+
+    def test_aging(self):
+        candidates = [
+            (1, 'alice', 'run1', 10, 0),
+            (2, 'bob', 'run2', 100, 0),
+        ]
+        running = {'alice': 5, ('alice', 'run1'): 5}
+        fair_share = local_queue.FairShare()
+        assert fair_share.choose(candidates, running, 1000) == 1
+        # After waiting 90 aging intervals, bob's job has caught up to the
+        # best ready priority, and bob is using less of his share
+        fair_share = local_queue.FairShare(aging=10)
+        assert fair_share.choose(candidates, running, 890) == 1
+        assert fair_share.choose(candidates, running, 900) == 2
+        # Aging never puts a job ahead of the best ready priority
+        assert fair_share.choose(candidates, dict(), 5000) == 1
+
+    def test_from_config(self):
+        assert local_queue.FairShare.from_config(None) is None
+        fair_share = local_queue.FairShare.from_config(True)
+        assert fair_share.weights == dict() and fair_share.aging is None
+        assert fair_share.running_window is None
+        fair_share = local_queue.FairShare.from_config(
+            dict(weights=dict(alice=2), aging=3600), max_job_time=7200)
+        assert fair_share.weight('alice') == 2
+        assert fair_share.weight('bob') == 1
+        assert fair_share.aging == 3600
+        assert fair_share.running_window == 7200
+        fair_share = local_queue.FairShare.from_config(
+            dict(running_window=600), max_job_time=7200)
+        assert fair_share.running_window == 600
+        for weight in (0, -1, 'heavy'):
+            with raises(ValueError):
+                local_queue.FairShare.from_config(
+                    dict(weights=dict(alice=weight)))
+
+    def test_failed_reserve_rolls_back(self, tmpdir):
+        conn = self.connect(tmpdir, local_queue.FairShare())
+        jid = self.put(conn, 'run', 'alice')
+        conn._execute("DROP TABLE dispatches")
+        with raises(sqlite3.OperationalError):
+            conn.reserve(timeout=0)
+        assert conn.stats_job(jid)['state'] == 'ready'
+        # The write lock was released
+        other = self.connect(tmpdir)
+        other.delete(jid)
+
+    def test_wait_stats(self, tmpdir):
+        conn = self.connect(tmpdir, local_queue.FairShare())
+        with patch.object(local_queue.time, 'time') as m_time:
+            m_time.return_value = 1000
+            for i in range(4):
+                self.put(conn, 'big', 'alice')
+            self.put(conn, 'small', 'bob')
+            for i in range(5):
+                m_time.return_value += 10
+                conn.reserve(timeout=0).bury()
+            stats = conn.wait_stats()
+            assert conn.wait_stats(since=1045) == dict(
+                alice=dict(jobs=1, mean=50, p50=50, p90=50, p99=50,
+                           max=50))
+        assert stats['bob'] == dict(jobs=1, mean=20, p50=20, p90=20,
+                                    p99=20, max=20)
+        assert stats['alice']['jobs'] == 4
+        assert stats['alice']['p50'] == 30
+        assert stats['alice']['max'] == 50
+        assert stats['alice']['mean'] == 32.5
+
+    def test_wait_stats_after_timeout(self, tmpdir):
+        conn = self.connect(tmpdir, local_queue.FairShare())
+        with patch.object(local_queue.time, 'time') as m_time:
+            m_time.return_value = 1000
+            self.put(conn, 'run', 'alice', ttr=100)
+            conn.reserve(timeout=0)
+            # The worker hangs, so the job times out and goes back in the
+            # queue, and is only waiting again from then on
+            m_time.return_value = 1100
+            conn.reserve(timeout=0)
+            assert conn.wait_stats()['alice']['max'] == 0
+
+    def test_prunes_dispatches(self, tmpdir):
+        conn = self.connect(tmpdir, local_queue.FairShare())
+        with patch.object(local_queue.time, 'time') as m_time:
+            m_time.return_value = 1000
+            self.put(conn, 'old', 'alice')
+            self.put(conn, 'new', 'bob')
+            conn.reserve(timeout=0).bury()
+            m_time.return_value += local_queue.dispatch_retention + 1
+            conn.reserve(timeout=0).bury()
+        assert conn.wait_stats().keys() == ['bob']
+
+    def test_adds_owner_column(self, tmpdir):
+        path = str(tmpdir.join('queue.sqlite'))
+        # The jobs table as it was before owners were indexed
+        db = sqlite3.connect(path)
+        db.executescript(
+            "CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "tube TEXT NOT NULL, priority INTEGER NOT NULL, "
+            "state TEXT NOT NULL, ready_at REAL NOT NULL, "
+            "ttr INTEGER NOT NULL, deadline REAL, run_name TEXT, "
+            "body TEXT NOT NULL)")
+        db.close()
+        conn = local_queue.Connection(path, local_queue.FairShare())
+        jid = self.put(conn, 'run', 'alice')
+        assert conn.reserve(timeout=0) is not None
+        assert conn.stats_job(jid)['age'] == 0
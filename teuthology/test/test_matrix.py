@@ -1,3 +1,5 @@
+from fractions import gcd
+
 from .. import matrix
 
 def verify_matrix_output_diversity(res):
@@ -69,3 +71,139 @@ class TestMatrix(object):
                             mbs(5, range(4))])
                     ]
                 ))
+
+
+def reference_product_index(mat, i, submats=None):
+    """
+    The original recursive implementation of Product._index()
+    """
+    if submats is None:
+        submats = mat.submats
+    if len(submats) == 1:
+        return frozenset([submats[0][1].index(i)])
+    lmat = submats[0][1]
+    lsize = lmat.size()
+    rsize = submats[0][0]
+    cycles = gcd(rsize, lsize)
+    clen = (rsize * lsize) / cycles
+    off = (i / clen) % cycles
+
+    def combine(r, s=frozenset()):
+        if type(r) is frozenset:
+            return s | r
+        return s | frozenset([r])
+
+    litems = lmat.index(i + off)
+    ritems = reference_product_index(mat, i, submats[1:])
+    return combine(litems, combine(ritems))
+
+
+def reference_sum_index(mat, _i, submats=None):
+    """
+    The original recursive implementation of Sum._index()
+    """
+    if submats is None:
+        submats = mat.submats
+    if len(submats) == 1:
+        return submats[0][1].index(_i)
+    lmat = submats[0][1]
+    lsize = lmat.size()
+    rsize = submats[0][0]
+    mult = rsize / lsize
+    clen = mult + 1
+    thresh = lsize * clen
+    i = _i % (rsize + lsize)
+    base = (_i / (rsize + lsize))
+    if i < thresh:
+        if i % clen == 0:
+            return lmat.index((i / clen) + (base * lsize))
+        else:
+            return reference_sum_index(
+                mat, ((i / clen) * mult + ((i % clen) - 1)) + (base * rsize),
+                submats[1:])
+    else:
+        return reference_sum_index(mat, i - lsize, submats[1:])
+
+
+class TestMatrixIndex(object):
+    def make_matrix(self):
+        return matrix.Product(0, [
+            mbs(1, range(2)),
+            mbs(2, range(6)),
+            matrix.Sum(3, [
+                mbs(4, range(3)),
+                matrix.Product(5, [mbs(6, range(2)), mbs(7, range(4))]),
+            ]),
+            matrix.Concat(8, [mbs(9, range(3))]),
+            matrix.Cycle(2, mbs(10, range(5))),
+        ])
+
+    def test_product_matches_reference(self):
+        mat = self.make_matrix()
+        for i in range(mat.size() * 2):
+            assert mat.index(i) == (mat.item,
+                                    reference_product_index(mat, i))
+
+    def test_sum_matches_reference(self):
+        mat = matrix.Sum(1, [
+            mbs(2, range(7)),
+            mbs(3, range(3)),
+            mbs(4, range(2)),
+            self.make_matrix(),
+        ])
+        for i in range(mat.size() * 2):
+            assert mat.index(i) == (mat.item, reference_sum_index(mat, i))
+
+    def test_index_range(self):
+        mat = self.make_matrix()
+        size = mat.size()
+        assert list(mat.index_range(0, size)) == \
+            [mat.index(i) for i in range(size)]
+        assert list(mat.index_range(size / 3, size / 2)) == \
+            [mat.index(i) for i in range(size / 3, size / 2)]
+        sum_mat = mbs(1, range(5))
+        assert list(sum_mat.index_range(1, 4)) == \
+            [sum_mat.index(i) for i in range(1, 4)]
+
+
+def enumerated_coverage(mat, start=0, stop=None):
+    if stop is None:
+        stop = mat.size()
+    counts = dict()
+    for i in range(start, stop):
+        for path in matrix.generate_lists(mat.index(i)):
+            counts[path] = counts.get(path, 0) + 1
+    return counts
+
+
+class TestCoverage(object):
+    def test_sum(self):
+        mat = mbs(1, range(5))
+        assert mat.coverage() == enumerated_coverage(mat)
+
+    def test_product(self):
+        mat = matrix.Product(1, [
+            mbs(1, range(2)),
+            mbs(2, range(5)),
+            mbs(4, range(4)),
+        ])
+        assert mat.coverage() == enumerated_coverage(mat)
+
+    def test_nested(self):
+        mat = matrix.Sum(0, [
+            matrix.Cycle(3, matrix.Product(1, [
+                mbs(2, range(6)),
+                matrix.Concat(3, [mbs(4, range(3)), mbs(5, range(2))]),
+                mbs(6, range(4)),
+            ])),
+            matrix.Product(7, [
+                mbs(8, range(2)),
+                matrix.Sum(9, [
+                    mbs(10, range(3)),
+                    matrix.Product(11, [mbs(12, range(2)),
+                                        mbs(13, range(3))]),
+                ]),
+            ]),
+            mbs(14, range(7)),
+        ])
+        assert mat.coverage() == enumerated_coverage(mat)
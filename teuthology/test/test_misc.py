@@ -1,4 +1,8 @@
 import argparse
+import contextlib
+import os
+import tarfile
+from cStringIO import StringIO
 
 from mock import patch
 from ..orchestra import cluster
@@ -151,6 +155,31 @@ class TestMergeConfigs(object):
         with pytest.raises(AssertionError):
             misc.deep_merge({"a": "b"}, "invalid")
 
+    def test_deep_merged(self):
+        a = {"a": {"b": [1], "c": "d"}, "e": {"f": "g"}}
+        b = {"a": {"b": [2], "c": "overwritten"}, "h": "i"}
+        result = misc.deep_merged(a, b)
+        assert result == misc.deep_merge(
+            {"a": {"b": [1], "c": "d"}, "e": {"f": "g"}},
+            {"a": {"b": [2], "c": "overwritten"}, "h": "i"})
+        assert a == {"a": {"b": [1], "c": "d"}, "e": {"f": "g"}}
+        assert b == {"a": {"b": [2], "c": "overwritten"}, "h": "i"}
+
+    def test_deep_merged_shares_unmerged(self):
+        a = {"a": {"b": "c"}}
+        b = {"d": {"e": "f"}}
+        result = misc.deep_merged(a, b)
+        assert result["a"] is a["a"]
+        assert result["d"] is b["d"]
+
+    def test_missing_deep_merged(self):
+        assert misc.deep_merged(None, [1, 2]) == [1, 2]
+        assert misc.deep_merged([1, 2], None) == [1, 2]
+
+    def test_invalid_b_deep_merged(self):
+        with pytest.raises(AssertionError):
+            misc.deep_merged({"a": "b"}, "invalid")
+
 
 class TestIsInDict(object):
     def test_simple_membership(self):
@@ -167,3 +196,29 @@ class TestIsInDict(object):
 
     def test_nonmembership_with_presence_at_lower_level(self):
         assert not misc.is_in_dict('a', 'foo', {'a':{'a': 'foo'}})
+
+
+class TestPullDirectory(object):
+    def test_pull_directory(self, tmpdir):
+        buf = StringIO()
+        tar = tarfile.open(mode='w:gz', fileobj=buf)
+        for name in ['./a.log', './sub/b.log']:
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            tar.addfile(info, StringIO(name[-5:-4] * 3))
+        tar.close()
+
+        class FakeRemote(object):
+            shortname = 'host'
+
+            @contextlib.contextmanager
+            def tar_stream(self, path, sudo=False, compression=None,
+                           bandwidth_limit=None):
+                assert (path, sudo, compression) == ('/dir', True, 'gzip')
+                buf.seek(0)
+                yield tarfile.open(mode='r|gz', fileobj=buf)
+
+        localdir = str(tmpdir.join('out'))
+        assert misc.pull_directory(FakeRemote(), '/dir', localdir) == 6
+        assert sorted(os.listdir(localdir)) == ['a.log', 'sub']
+        assert open(os.path.join(localdir, 'sub', 'b.log')).read() == 'bbb'
@@ -1,3 +1,5 @@
+import gevent
+
 from ..parallel import parallel
 
 
@@ -26,3 +28,23 @@ class TestParallel(object):
             for result in para:
                 in_set.remove(result)
 
+
+    def test_max_concurrency(self):
+        running = set()
+        seen = []
+
+        def track(item):
+            running.add(item)
+            seen.append(len(running))
+            gevent.sleep(0.01)
+            running.remove(item)
+            return item
+
+        in_set = set(range(10))
+        with parallel(max_concurrency=3) as para:
+            for i in in_set:
+                para.spawn(track, i)
+            for result in para:
+                in_set.remove(result)
+        assert not in_set
+        assert max(seen) == 3
@@ -1,3 +1,4 @@
+from mock import Mock
 import yaml
 import json
 import fake_archive
@@ -75,3 +76,33 @@ class TestSerializer(object):
         assert full_obj == out_obj
 
 
+class TestReportHeartbeats(object):
+    def setup(self):
+        self.reporter = report.ResultsReporter(base_uri="http://results")
+        self.reporter.session = Mock()
+
+    def test_put(self):
+        self.reporter.session.put.return_value = Mock(status_code=200)
+        job_infos = [dict(name="run", job_id="1"),
+                     dict(name="run", job_id="2")]
+        assert self.reporter.report_heartbeats(job_infos) == 2
+        uris = [c[0][0] for c in self.reporter.session.put.call_args_list]
+        assert uris == ["http://results/runs/run/jobs/1/",
+                        "http://results/runs/run/jobs/2/"]
+        assert not self.reporter.session.post.called
+
+    def test_unknown_job(self):
+        self.reporter.session.put.return_value = Mock(status_code=404)
+        self.reporter.session.post.return_value = Mock(status_code=200)
+        job_infos = [dict(name="run", job_id="1")]
+        assert self.reporter.report_heartbeats(job_infos) == 1
+        assert self.reporter.session.post.called
+
+    def test_failure(self):
+        self.reporter.session.put.side_effect = [
+            report.requests.exceptions.ConnectionError,
+            Mock(status_code=200),
+        ]
+        job_infos = [dict(name="run", job_id="1"),
+                     dict(name="run", job_id="2")]
+        assert self.reporter.report_heartbeats(job_infos) == 1
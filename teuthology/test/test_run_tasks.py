@@ -0,0 +1,33 @@
+from mock import patch, Mock
+from pytest import raises
+
+from .. import run_tasks
+from ..orchestra import run
+
+
+class TestRunTasks(object):
+    def teardown(self):
+        run.timings = None
+
+    @patch("teuthology.run_tasks.teuth_config")
+    def test_timings_saved(self, m_t_config, tmpdir):
+        m_t_config.command_timing = True
+        ctx = Mock(archive=str(tmpdir), summary=dict())
+        run_tasks.run_tasks([], ctx)
+        assert tmpdir.join('timing.yaml').check()
+        assert run.timings is None
+
+    @patch("teuthology.orchestra.run.CommandTimings.save")
+    @patch("teuthology.run_tasks.get_sentry_client")
+    @patch("teuthology.run_tasks.run_one_task")
+    @patch("teuthology.run_tasks.teuth_config")
+    def test_save_failure_keeps_outcome(self, m_t_config, m_run_one_task,
+                                        m_get_sentry_client, m_save, tmpdir):
+        m_t_config.command_timing = True
+        m_get_sentry_client.return_value = None
+        m_run_one_task.side_effect = RuntimeError("task failed")
+        m_save.side_effect = IOError("archive is full")
+        ctx = Mock(archive=str(tmpdir), summary=dict())
+        with raises(SystemExit):
+            run_tasks.run_tasks([dict(mytask=None)], ctx)
+        assert ctx.summary['failure_reason'] == "task failed"
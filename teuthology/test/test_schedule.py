@@ -1,4 +1,6 @@
-from ..schedule import build_config
+from mock import patch
+
+from ..schedule import build_config, schedule_jobs
 from ..misc import get_user
 
 
@@ -41,3 +43,24 @@ class TestSchedule(object):
         job_dict = build_config(self.basic_args)
         assert job_dict['owner'] == 'scheduled_%s' % get_user()
 
+
+    @patch('teuthology.schedule.report')
+    @patch('teuthology.beanstalk.connect')
+    def test_schedule_jobs(self, m_connect, m_report):
+        m_beanstalk = m_connect.return_value
+        m_beanstalk.put.side_effect = range(1, 10)
+        job_configs = [
+            (dict(name='NAME', priority=99, tube='tala', description=str(i)),
+             num)
+            for (i, num) in enumerate([1, 2, '3'])
+        ]
+        assert schedule_jobs(job_configs) == 6
+        assert m_connect.call_count == 1
+        m_beanstalk.use.assert_called_with('tala')
+        m_beanstalk.close.assert_called_once_with()
+        pushed = [call[0][0] for call in
+                  m_report.try_push_job_info.call_args_list]
+        assert sorted(int(c['job_id']) for c in pushed) == range(1, 7)
+        assert sorted(c['description'] for c in pushed) == \
+            ['0', '1', '1', '2', '2', '2']
+        assert all('tube' not in c for c in pushed)
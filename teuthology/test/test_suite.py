@@ -1,10 +1,20 @@
+import os
+import requests
+import shutil
+import tempfile
+import yaml
 from copy import deepcopy
 from datetime import datetime
 
 from mock import patch, Mock
+from pytest import raises
 
+from teuthology import matrix
 from teuthology import suite
-from teuthology.config import config
+from teuthology.misc import merge_configs
+from teuthology.schedule import build_config
+from teuthology.test.fake_archive import FakeArchive
+from teuthology.config import config, JobConfig
 
 
 class TestSuiteOffline(object):
@@ -275,6 +285,57 @@ class TestMissingPackages(object):
         assert not result
 
 
+class TestPackageVersionCache(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'package_versions.yaml')
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_persisted(self):
+        cache = suite.PackageVersionCache(path=self.path, ttl=60)
+        assert cache.get('sha1', 'ubuntu', 'basic') is None
+        cache.set('sha1', 'ubuntu', 'basic', '1.0')
+        cache.save()
+        cache = suite.PackageVersionCache(path=self.path, ttl=60)
+        assert cache.get('sha1', 'ubuntu', 'basic') == '1.0'
+        assert cache.get('sha1', 'rhel', 'basic') is None
+
+    @patch('teuthology.suite.time.time')
+    def test_expired(self, m_time):
+        m_time.return_value = 1000
+        cache = suite.PackageVersionCache(path=self.path, ttl=60)
+        cache.set('sha1', 'ubuntu', 'basic', '1.0')
+        m_time.return_value = 1061
+        assert cache.get('sha1', 'ubuntu', 'basic') is None
+        cache.save()
+        assert suite.PackageVersionCache(path=self.path).entries == dict()
+
+    @patch('teuthology.suite.package_version_for_hash')
+    def test_prefetch(self, m_package_version_for_hash):
+        versions = {('sha1', 'ubuntu'): '1.0', ('sha1', 'centos'): None}
+        m_package_version_for_hash.side_effect = \
+            lambda sha1, flavor, distro: versions[(sha1, distro)]
+        cache = suite.PackageVersionCache(path=self.path, ttl=60)
+        result = suite.prefetch_package_versions(
+            [('sha1', 'ubuntu', 'basic'), ('sha1', 'centos', 'basic'),
+             ('sha1', 'ubuntu', 'basic')],
+            cache=cache)
+        assert result == dict(sha1=dict(ubuntu=dict(basic='1.0'),
+                                         centos=dict(basic=None)))
+        assert m_package_version_for_hash.call_count == 2
+        # Only found versions are cached
+        m_package_version_for_hash.reset_mock()
+        cache = suite.PackageVersionCache(path=self.path, ttl=60)
+        result = suite.prefetch_package_versions(
+            [('sha1', 'ubuntu', 'basic'), ('sha1', 'centos', 'basic')],
+            cache=cache)
+        assert result['sha1']['ubuntu']['basic'] == '1.0'
+        m_package_version_for_hash.assert_called_once_with(
+            'sha1', 'basic', distro='centos')
+
+
 class TestDistroDefaults(object):
 
     def test_distro_defaults_saya(self):
@@ -699,3 +760,410 @@ class TestBuildMatrix(object):
         assert fragments[0] == 'thrash/ceph/base.yaml'
         assert fragments[1] == 'thrash/ceph-thrash/default.yaml'
 
+
+    def test_iter_matrix_matches_build_matrix(self):
+        fake_fs = {
+            'd0_0': {
+                '%': None,
+                'd1_0': {
+                    'd1_0_0.yaml': None,
+                    'd1_0_1.yaml': None,
+                },
+                'd1_1': {
+                    'd1_1_0.yaml': None,
+                    'd1_1_1.yaml': None,
+                    'd1_1_2.yaml': None,
+                },
+            },
+        }
+        fake_listdir, fake_isfile, fake_isdir = make_fake_fstools(fake_fs)
+        result = suite.build_matrix('d0_0', fake_isfile, fake_isdir,
+                                    fake_listdir)
+        jobs = suite.iter_matrix('d0_0', fake_isfile, fake_isdir,
+                                 fake_listdir)
+        assert not isinstance(jobs, list)
+        assert next(jobs) == result[0]
+        assert [result[0]] + list(jobs) == result
+        for subset in [(0, 2), (1, 2)]:
+            assert list(suite.iter_matrix(
+                'd0_0', fake_isfile, fake_isdir, fake_listdir,
+                subset=subset)) == suite.build_matrix(
+                    'd0_0', fake_isfile, fake_isdir, fake_listdir,
+                    subset=subset)
+
+
+def make_tree(tree, path):
+    """
+    Create a directory tree at path from a dict. Dicts become directories;
+    other values become files with that content, or empty files for None.
+    """
+    os.makedirs(path)
+    for name, contents in tree.items():
+        if isinstance(contents, dict):
+            make_tree(contents, os.path.join(path, name))
+        else:
+            with open(os.path.join(path, name), 'w') as f:
+                f.write(contents or '')
+
+
+class TestBuildMatrixCached(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.suite_path = os.path.join(self.tmpdir, 'suite')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        make_tree({
+            '%': None,
+            'd1_0': {'d1_0_0.yaml': None, 'd1_0_1.yaml': None},
+            'd1_1': {'d1_1_0.yaml': None, 'd1_1_1.yaml': None},
+        }, self.suite_path)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def descriptions(self, mat):
+        return [matrix.generate_desc(suite.combine_path, mat.index(i))
+                for i in range(mat.size())]
+
+    def test_cache_hit_skips_walk(self):
+        mat = suite.build_matrix_cached(self.suite_path,
+                                        cache_dir=self.cache_dir)
+        with patch('os.listdir') as m_listdir:
+            with patch('os.path.isfile') as m_isfile:
+                cached = suite.build_matrix_cached(self.suite_path,
+                                                   cache_dir=self.cache_dir)
+        assert not m_listdir.called
+        assert not m_isfile.called
+        assert cached.size() == mat.size() == 4
+        assert self.descriptions(cached) == self.descriptions(mat)
+
+    def test_cache_invalidated_by_new_fragment(self):
+        mat = suite.build_matrix_cached(self.suite_path,
+                                        cache_dir=self.cache_dir)
+        assert mat.size() == 4
+        facet = os.path.join(self.suite_path, 'd1_1')
+        open(os.path.join(facet, 'd1_1_2.yaml'), 'w').close()
+        # Don't rely on the filesystem's timestamp granularity
+        mtime = os.stat(facet).st_mtime + 10
+        os.utime(facet, (mtime, mtime))
+        mat = suite.build_matrix_cached(self.suite_path,
+                                        cache_dir=self.cache_dir)
+        assert mat.size() == 6
+
+    def test_cache_keyed_on_mincyclicity(self):
+        suite.build_matrix_cached(self.suite_path, cache_dir=self.cache_dir)
+        suite.build_matrix_cached(self.suite_path, mincyclicity=8,
+                                  cache_dir=self.cache_dir)
+        assert len(os.listdir(os.path.join(self.cache_dir, 'matrix'))) == 2
+
+    def test_unwritable_cache_dir(self):
+        cache_dir = os.path.join(self.tmpdir, 'not_a_dir')
+        open(cache_dir, 'w').close()
+        mat = suite.build_matrix_cached(self.suite_path, cache_dir=cache_dir)
+        assert mat.size() == 4
+
+
+class TestFragmentCache(object):
+    fragments = {
+        'a.yaml': 'overrides:\n  ceph:\n    conf: {osd: {a: 1}}\nos_type: ubuntu\n',
+        'b.yaml': '# a comment\noverrides:\n  install: {flavor: notcmalloc}\n',
+        'c.yaml': 'tasks:\n- install:\n- ceph:\n    log-whitelist: [x]\n',
+        'empty.yaml': '# nothing but a comment\n',
+        'anchor.yaml': 'base: &base {a: 1}\n',
+        'alias.yaml': 'derived: *base\n',
+        'indented.yaml': '    debug: true\n',
+        'markers.yaml': '---\nos_type: centos\n',
+    }
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, text in self.fragments.items():
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write(text)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, cache, names):
+        paths = [os.path.join(self.tmpdir, name) for name in names]
+        raw_yaml = '\n'.join([open(path).read() for path in paths])
+        result = cache.load(paths)
+        assert result == yaml.load(raw_yaml, Loader=yaml.Loader)
+        return result
+
+    def test_matches_concatenation(self):
+        cache = suite.FragmentCache()
+        self.check(cache, ['a.yaml', 'b.yaml', 'c.yaml'])
+        self.check(cache, ['b.yaml', 'a.yaml', 'empty.yaml', 'c.yaml'])
+        self.check(cache, ['anchor.yaml', 'alias.yaml'])
+        self.check(cache, ['c.yaml', 'indented.yaml'])
+
+    def test_fragments_parsed_once(self):
+        cache = suite.FragmentCache()
+        with patch('teuthology.suite.yaml.load', wraps=yaml.load) as m_load:
+            self.check(cache, ['a.yaml', 'b.yaml'])
+            self.check(cache, ['b.yaml', 'a.yaml', 'c.yaml'])
+        # one call each for a, b and c, plus the two in check() itself
+        assert m_load.call_count == 5
+
+    def test_results_not_shared(self):
+        cache = suite.FragmentCache()
+        result = self.check(cache, ['a.yaml', 'c.yaml'])
+        result['overrides']['ceph']['conf']['osd']['a'] = 2
+        result['tasks'][1]['ceph']['log-whitelist'].append('y')
+        self.check(cache, ['a.yaml', 'c.yaml'])
+
+    def test_merge_configs(self):
+        cache = suite.FragmentCache()
+        names = ['a.yaml', 'b.yaml', 'does_not_exist.yaml', 'c.yaml',
+                 'empty.yaml']
+        paths = [os.path.join(self.tmpdir, name) for name in names]
+        result = cache.merge_configs(paths)
+        assert result == merge_configs(paths)
+        result['tasks'].append('more')
+        assert cache.merge_configs(paths) == merge_configs(paths)
+
+    def test_document_markers_fall_back(self):
+        cache = suite.FragmentCache()
+        paths = [os.path.join(self.tmpdir, name) for name in
+                 ['a.yaml', 'markers.yaml']]
+        with raises(yaml.YAMLError):
+            cache.load(paths)
+
+
+class TestScheduleSuite(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.suite_path = os.path.join(self.tmpdir, 'suite')
+        tree = {
+            '%': '',
+            'clusters': {'fixed-1.yaml': 'roles:\n- [mon.a, osd.0]\n'},
+            'tasks': {
+                'a.yaml': 'tasks:\n- install:\n- ceph:\n',
+                'b.yaml': 'tasks:\n- install:\n    flavor: notcmalloc\n',
+            },
+        }
+        make_tree(tree, self.suite_path)
+        self.base_yaml = os.path.join(self.tmpdir, 'base.yaml')
+        with open(self.base_yaml, 'w') as f:
+            f.write('overrides:\n  ceph:\n    log-whitelist: [slow]\n')
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def schedule(self, **kwargs):
+        schedule_args = {
+            '--name': 'NAME',
+            '--num': '1',
+            '--worker': 'plana',
+            '--priority': '50',
+            '--verbose': False,
+            '--owner': 'OWNER',
+            '--description': None,
+            '--last-in-suite': False,
+            '--email': None,
+            '--timeout': None,
+            '<conf_file>': [],
+        }
+        job_config = JobConfig.from_dict(dict(suite='suite', sha1='sha1',
+                                              os_type='ubuntu'))
+        scheduled = []
+
+        def fake_schedule_jobs(job_configs):
+            scheduled.extend(job_configs)
+
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        with patch('teuthology.suite.schedule.schedule_jobs',
+                   fake_schedule_jobs), \
+                patch.dict(config._conf, suite_cache_dir=cache_dir):
+            count = suite.schedule_suite(
+                job_config=job_config,
+                path=self.suite_path,
+                base_yamls=[self.base_yaml],
+                base_args=['teuthology-schedule'],
+                arch='x86_64',
+                dry_run=False,
+                schedule_args=schedule_args,
+                **kwargs)
+        return count, scheduled, schedule_args
+
+    def test_in_process(self):
+        count, scheduled, schedule_args = self.schedule()
+        assert count == len(scheduled) == 2
+        for (job_config, num) in scheduled:
+            assert num == '1'
+            fragments = sorted(
+                os.path.join(self.suite_path, path) for path in
+                ['clusters/fixed-1.yaml', 'tasks/' +
+                 job_config['description'].split('/')[-1][:-1]])
+            args = dict(schedule_args)
+            args['--description'] = job_config['description']
+            args['<conf_file>'] = [self.base_yaml] + fragments
+            assert job_config == build_config(args)
+
+    def test_limit(self):
+        count, scheduled, _ = self.schedule(limit=1)
+        assert count == len(scheduled) == 1
+
+    def test_stats(self, capsys):
+        with patch.dict(config._conf, suite_cache_dir=None):
+            suite.print_suite_stats('suite', self.suite_path, fragments=True)
+        out = capsys.readouterr()[0].splitlines()
+        assert out[0] == 'Suite suite: 2 jobs'
+        assert out[1] == 'minscanlen: 2, cyclicity: 1'
+        assert out[2] == 'clusters/'
+        assert out[3].split() == ['fixed-1.yaml', '2', '100.0%']
+        assert out[5].split() == ['a.yaml', '1', '50.0%']
+
+    def test_stats_subset(self, capsys):
+        with patch.dict(config._conf, suite_cache_dir=None):
+            suite.print_suite_stats('suite', self.suite_path, subset=(1, 2),
+                                    fragments=True)
+        out = capsys.readouterr()[0].splitlines()
+        assert out[2] == 'Subset 1/2: 1 jobs (1-1)'
+        assert out[4].split() == ['fixed-1.yaml', '1', '100.0%']
+        assert out[6].split() == ['b.yaml', '1', '100.0%']
+
+    def test_rerun(self):
+        description = 'suite/{clusters/fixed-1.yaml tasks/b.yaml}'
+        count, scheduled, _ = self.schedule(
+            rerun_descriptions=set([description, 'suite/{gone.yaml}']))
+        assert count == 1
+        assert scheduled[0][0]['description'] == description
+
+    def test_filters(self):
+        count, scheduled, _ = self.schedule(filter_in='nothing, b.yaml')
+        assert count == 1
+        assert 'tasks/b.yaml' in scheduled[0][0]['description']
+        count, scheduled, _ = self.schedule(filter_out='b.yaml')
+        assert count == 1
+        assert 'tasks/a.yaml' in scheduled[0][0]['description']
+        count, scheduled, _ = self.schedule(filter_in='fixed-1',
+                                            filter_out='a.yaml,b.yaml')
+        assert count == 0
+
+    @patch('teuthology.suite.prefetch_package_versions')
+    @patch('teuthology.suite.has_packages_for_distro')
+    def test_dry_run_flavors(self, m_has_packages, m_prefetch):
+        m_prefetch.return_value = dict()
+        m_has_packages.return_value = True
+        with open(os.path.join(self.suite_path, 'tasks', 'b.yaml'), 'w') as f:
+            f.write('overrides:\n  install:\n    valgrind: true\n'
+                    'tasks:\n- install:\n')
+        overrides = dict(ceph=dict(log_whitelist=['slow']),
+                         install=dict(ceph=dict(sha1='sha1')))
+        job_config = JobConfig.from_dict(dict(
+            suite='suite', sha1='sha1', os_type='ubuntu',
+            overrides=deepcopy(overrides)))
+        with patch.dict(config._conf, suite_cache_dir=None):
+            count = suite.schedule_suite(
+                job_config=job_config,
+                path=self.suite_path,
+                base_yamls=[self.base_yaml],
+                base_args=['teuthology-schedule'],
+                arch='x86_64',
+                dry_run=True)
+        assert count == 2
+        # Each job's fragments must not leak into the shared job_config, or
+        # into the jobs after it
+        assert job_config.overrides == overrides
+        flavors = sorted(
+            call[0][2] for call in m_has_packages.call_args_list)
+        assert flavors == ['basic', 'notcmalloc']
+
+
+class TestKeywordFilter(object):
+    description = 'rados/{clusters/fixed-2.yaml fs/xfs.yaml tasks/rbd.yaml}'
+    fragments = ['/qa/suites/rados/clusters/fixed-2.yaml',
+                 '/qa/suites/rados/fs/xfs.yaml',
+                 '/qa/suites/rados/tasks/rbd.yaml']
+
+    def test_description(self):
+        assert suite.KeywordFilter('xfs').matches(self.description, [])
+        assert suite.KeywordFilter('btrfs, fs/xfs').matches(
+            self.description, [])
+        assert not suite.KeywordFilter('btrfs,ext4').matches(
+            self.description, [])
+
+    def test_fragments(self):
+        assert suite.KeywordFilter('/qa/').matches('', self.fragments)
+        assert not suite.KeywordFilter('btrfs').matches('', self.fragments)
+
+    def test_special_characters(self):
+        assert suite.KeywordFilter('{clusters').matches(self.description, [])
+        assert not suite.KeywordFilter('x.s').matches(self.description, [])
+
+    def test_fragment_results_remembered(self):
+        keyword_filter = suite.KeywordFilter('rbd')
+        assert keyword_filter.matches('', self.fragments)
+        assert keyword_filter._fragment_matches[self.fragments[2]] is True
+        assert keyword_filter._fragment_matches[self.fragments[0]] is False
+
+
+class TestRerun(object):
+    def setup(self):
+        self.archive = FakeArchive(tempfile.mkdtemp())
+        jobs = []
+        for (job_id, success) in [(1, True), (2, False), (3, None)]:
+            job = dict(job_id=job_id, info=dict(description='desc%s' % job_id))
+            if success is not None:
+                job['summary'] = dict(success=success)
+            jobs.append(job)
+        jobs.append(dict(job_id=4, info=dict(description='desc4'),
+                         summary=dict(status='dead')))
+        self.archive.populate_archive('run', jobs)
+
+    def teardown(self):
+        self.archive.teardown()
+
+    def test_from_archive(self):
+        with patch.dict(config._conf, results_server=None,
+                        archive_base=self.archive.archive_base):
+            assert suite.get_rerun_descriptions('run') == \
+                set(['desc2', 'desc4'])
+            assert suite.get_rerun_descriptions('run', ['pass']) == \
+                set(['desc1'])
+
+    @patch('teuthology.suite.ResultsReporter')
+    def test_from_results_server(self, m_reporter):
+        m_reporter.return_value.get_jobs.return_value = [
+            dict(job_id='1', description='desc1', status='fail'),
+            dict(job_id='2', description='desc2', status='running'),
+            dict(job_id='3', description='desc3', status='dead'),
+        ]
+        with patch.dict(config._conf, results_server='http://paddles/',
+                        archive_base=self.archive.archive_base):
+            assert suite.get_rerun_descriptions('run') == \
+                set(['desc1', 'desc3'])
+        m_reporter.return_value.get_jobs.assert_called_once_with(
+            'run', fields=['description', 'status'])
+
+    @patch('teuthology.suite.ResultsReporter')
+    def test_results_server_down(self, m_reporter):
+        m_reporter.return_value.get_jobs.side_effect = \
+            requests.exceptions.ConnectionError()
+        with patch.dict(config._conf, results_server='http://paddles/',
+                        archive_base=self.archive.archive_base):
+            assert suite.get_rerun_descriptions('run') == \
+                set(['desc2', 'desc4'])
+
+
+class TestParseScheduleArgs(object):
+    def test_defaults(self):
+        args = suite.parse_schedule_args([
+            'bin/teuthology-schedule', '--name', 'NAME', '--num', '2',
+            '--worker', 'plana', '--owner', 'OWNER'])
+        assert args['--name'] == 'NAME'
+        assert args['--num'] == '2'
+        assert args['--owner'] == 'OWNER'
+        assert args['--priority'] == '1000'
+        assert args['--last-in-suite'] is False
+        assert args['<conf_file>'] == []
+
+    def test_last_in_suite(self):
+        args = suite.parse_schedule_args([
+            'bin/teuthology-schedule', '--name', 'NAME', '--last-in-suite',
+            '--email', 'me@example.com', '--timeout', '60'])
+        config = build_config(args, dict())
+        assert config['last_in_suite'] is True
+        assert config['email'] == 'me@example.com'
+        assert config['results_timeout'] == '60'
@@ -0,0 +1,76 @@
+from mock import patch, Mock
+
+from .. import watchdog
+
+
+class TestWatchdog(object):
+    def setup(self):
+        self.watchdog = watchdog.Watchdog(interval=120, max_job_time=3600)
+
+    def job_config(self, job_id):
+        return dict(name="the_name", job_id=job_id, owner="the_owner")
+
+    @patch("teuthology.watchdog.teuth_config")
+    def test_heartbeat_batches_jobs(self, m_t_config):
+        m_t_config.results_server = "http://results/"
+        self.watchdog.add(self.job_config("1"))
+        self.watchdog.add(self.job_config("2"))
+        reporter = Mock()
+        self.watchdog._reporter = reporter
+        self.watchdog.heartbeat()
+        assert reporter.report_heartbeats.call_count == 1
+        job_infos = reporter.report_heartbeats.call_args[0][0]
+        assert sorted(job_infos) == [
+            dict(name="the_name", job_id="1"),
+            dict(name="the_name", job_id="2"),
+        ]
+
+    @patch("teuthology.watchdog.teuth_config")
+    def test_heartbeat_without_results_server(self, m_t_config):
+        m_t_config.results_server = None
+        self.watchdog.add(self.job_config("1"))
+        self.watchdog.heartbeat()
+        assert self.watchdog._reporter is None
+
+    @patch("teuthology.watchdog.kill_job")
+    def test_expire(self, m_kill_job):
+        self.watchdog.add(self.job_config("1"), start_time=1000)
+        self.watchdog.add(self.job_config("2"), start_time=2000)
+        assert self.watchdog.expire(now=4600) == ["1"]
+        m_kill_job.assert_called_once_with(
+            "the_name", "1", watchdog.teuth_config.archive_base)
+        # An expired job is only killed once
+        assert self.watchdog.expire(now=4700) == []
+        assert len(self.watchdog) == 2
+
+    @patch("teuthology.watchdog.kill_job")
+    def test_expire_kill_fails(self, m_kill_job):
+        m_kill_job.side_effect = [RuntimeError, None]
+        self.watchdog.add(self.job_config("1"), start_time=1000)
+        assert self.watchdog.expire(now=4600) == ["1"]
+        # Retried once another interval has passed
+        assert self.watchdog.expire(now=4700) == []
+        assert self.watchdog.next_wakeup(now=4700) == 20
+        assert self.watchdog.expire(now=4720) == ["1"]
+        assert m_kill_job.call_count == 2
+        assert self.watchdog.expire(now=5000) == []
+
+    def test_next_wakeup(self):
+        self.watchdog.last_heartbeat = 1000
+        assert self.watchdog.next_wakeup(now=1000) == 120
+        self.watchdog.add(self.job_config("1"), start_time=1000 - 3590)
+        assert self.watchdog.next_wakeup(now=1000) == 10
+        self.watchdog.remove("1")
+        assert self.watchdog.next_wakeup(now=1200) == 0
+
+    @patch("teuthology.watchdog.kill_job")
+    def test_background_kill_is_prompt(self, m_kill_job):
+        self.watchdog.max_job_time = 0.05
+        self.watchdog.start()
+        try:
+            self.watchdog.add(self.job_config("1"))
+            watchdog.gevent.sleep(0.2)
+        finally:
+            self.watchdog.stop()
+        m_kill_job.assert_called_once_with(
+            "the_name", "1", watchdog.teuth_config.archive_base)
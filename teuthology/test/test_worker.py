@@ -63,9 +63,7 @@ class TestWorker(object):
             "description": "the_description"
         }
         m_tmp = MagicMock()
-        temp_file = Mock()
-        temp_file.name = "the_name"
-        m_tmp.__enter__.return_value = temp_file
+        m_tmp.name = "the_name"
         m_tempfile.return_value = m_tmp
         env = dict(PYTHONPATH="python/path")
         m_environ.copy.return_value = env
@@ -75,6 +73,7 @@ class TestWorker(object):
         m_t_config.results_server = True
         worker.run_job(config, "teuth/bin/path")
         m_run_watchdog.assert_called_with(m_p, config)
+        assert m_tmp.__exit__.called
         expected_args = [
             'teuth/bin/path/teuthology',
             '-v',
@@ -110,9 +109,7 @@ class TestWorker(object):
             "worker_log": "worker/log.log"
         }
         m_tmp = MagicMock()
-        temp_file = Mock()
-        temp_file.name = "the_name"
-        m_tmp.__enter__.return_value = temp_file
+        m_tmp.name = "the_name"
         m_tempfile.return_value = m_tmp
         env = dict(PYTHONPATH="python/path")
         m_environ.copy.return_value = env
@@ -168,3 +165,114 @@ class TestWorker(object):
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT
         )
+
+
+class TestJobSupervisor(object):
+    def setup(self):
+        self.config = {
+            "name": "the_name",
+            "job_id": "1",
+            "worker_log": "worker_log",
+            "archive_path": "archive/path",
+            "teuthology_branch": "master",
+        }
+
+    def make_running(self, supervisor, returncode=None):
+        process = Mock()
+        process.poll.return_value = returncode
+        process.returncode = returncode
+        job = Mock()
+        supervisor.jobs.append(
+            worker.RunningJob(job, dict(self.config), process, Mock()))
+        return supervisor.jobs[-1]
+
+    @patch("teuthology.worker.start_job")
+    def test_start(self, m_start_job):
+        m_start_job.return_value = (Mock(), Mock())
+        supervisor = worker.JobSupervisor(2)
+        assert supervisor.free() == 2
+        supervisor.start(Mock(), self.config, "teuth/bin/path")
+        m_start_job.assert_called_once_with(self.config, "teuth/bin/path")
+        assert supervisor.free() == 1
+        assert len(supervisor) == 1
+
+    @patch("teuthology.worker.report.try_push_job_info")
+    @patch("teuthology.worker.symlink_worker_log")
+    @patch("teuthology.worker.teuth_config")
+    def test_poll_reaps_finished(self, m_t_config, m_symlink_log, m_try_push):
+        m_t_config.results_server = "http://results/"
+        supervisor = worker.JobSupervisor(2)
+        done = self.make_running(supervisor, returncode=0)
+        running = self.make_running(supervisor)
+        running.symlinked = True
+        supervisor.poll()
+        assert supervisor.jobs == [running]
+        assert done.job.delete.called
+        assert done.config_file.close.called
+        assert not running.job.delete.called
+        m_symlink_log.assert_called_once_with("worker_log", "archive/path")
+        m_try_push.assert_called_once_with(
+            dict(name="the_name", job_id="1"), dict(status='dead'))
+
+    @patch("teuthology.worker.symlink_worker_log")
+    @patch("teuthology.worker.teuth_config")
+    def test_watch_symlinks_once(self, m_t_config, m_symlink_log):
+        supervisor = worker.JobSupervisor(2)
+        supervisor.watchdog.interval = 120
+        fresh = self.make_running(supervisor)
+        old = self.make_running(supervisor)
+        old.start_time -= 180
+        supervisor.poll()
+        supervisor.poll()
+        m_symlink_log.assert_called_once_with("worker_log", "archive/path")
+        assert old.symlinked and not fresh.symlinked
+        assert len(supervisor) == 2
+
+    @patch("teuthology.worker.start_job")
+    def test_jobs_share_watchdog(self, m_start_job):
+        m_start_job.return_value = (Mock(returncode=0), Mock())
+        supervisor = worker.JobSupervisor(2)
+        supervisor.watchdog = Mock()
+        supervisor.start(Mock(), self.config, "teuth/bin/path")
+        supervisor.watchdog.add.assert_called_once_with(
+            self.config, start_time=supervisor.jobs[0].start_time)
+        assert supervisor.watchdog.start.called
+        with patch("teuthology.worker.symlink_worker_log"):
+            supervisor.poll()
+        supervisor.watchdog.remove.assert_called_once_with("1")
+
+
+class TestRunSlots(object):
+    @patch("teuthology.worker.restart")
+    @patch("teuthology.worker.need_restart")
+    @patch("time.sleep")
+    @patch("teuthology.worker.run_results")
+    @patch("teuthology.worker.prep_job")
+    @patch("teuthology.worker.JobSupervisor")
+    def test_fills_slots_then_drains(self, m_supervisor, m_prep_job,
+                                     m_run_results, m_sleep, m_need_restart,
+                                     m_restart):
+        supervisor = m_supervisor.return_value
+        supervisor.poll_interval = 5
+        supervisor.free.side_effect = [1, 1, 0]
+        supervisor.__nonzero__ = Mock(side_effect=[True, False])
+        m_need_restart.side_effect = [False, False, False, True]
+        m_restart.side_effect = SystemExit
+        jobs = [Mock(jid=1), Mock(jid=2)]
+        connection = Mock()
+        connection.reserve.side_effect = jobs
+        m_prep_job.side_effect = [
+            (dict(last_in_suite=True), "bin"),
+            (dict(), "bin"),
+        ]
+        ctx = Mock()
+        try:
+            worker.run_slots(ctx, connection, "worker.log", 2)
+        except SystemExit:
+            pass
+        assert connection.reserve.call_count == 2
+        m_run_results.assert_called_once_with(
+            ctx, dict(last_in_suite=True), "bin")
+        assert jobs[0].delete.called
+        supervisor.start.assert_called_once_with(jobs[1], dict(), "bin")
+        assert m_restart.called
@@ -0,0 +1,163 @@
+"""
+A watchdog shared by every job running on a host.
+
+Rather than each job sleeping watchdog_interval and pushing its own
+heartbeat, jobs are registered with a Watchdog, which pushes all of their
+heartbeats in one pass over a single results-server session, and kills each
+job as soon as it passes max_job_time.
+"""
+import gevent
+import gevent.event
+import logging
+import time
+
+from . import report
+from .config import config as teuth_config
+from .kill import kill_job
+
+log = logging.getLogger(__name__)
+
+
+class WatchedJob(object):
+    def __init__(self, job_config, deadline):
+        self.name = job_config['name']
+        self.job_id = job_config['job_id']
+        self.deadline = deadline
+
+    @property
+    def job_info(self):
+        # Only push the information that's relevant to the watchdog, to save
+        # db load
+        return dict(name=self.name, job_id=self.job_id)
+
+
+class Watchdog(object):
+    """
+    Keep running jobs alive on the results server, and kill them once they
+    have run longer than max_job_time.
+
+    Call start() to do this in a background greenlet, or call poll()
+    yourself; next_wakeup() says how long it is safe to wait before the next
+    call.
+
+    :param interval:     Seconds between heartbeats. Defaults to
+                         config.watchdog_interval.
+    :param max_job_time: Seconds a job may run before it is killed. Defaults
+                         to config.max_job_time.
+    """
+    def __init__(self, interval=None, max_job_time=None):
+        self.interval = interval or teuth_config.watchdog_interval
+        self.max_job_time = max_job_time or teuth_config.max_job_time
+        self.jobs = dict()
+        self.last_heartbeat = time.time()
+        self._reporter = None
+        self._wake = gevent.event.Event()
+        self._greenlet = None
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, job_config, start_time=None):
+        """
+        Start watching a job.
+
+        :param job_config: The job's config; only 'name' and 'job_id' are
+                           used.
+        :param start_time: When the job started, as returned by time.time().
+                           Defaults to now.
+        """
+        if start_time is None:
+            start_time = time.time()
+        job = WatchedJob(job_config, start_time + self.max_job_time)
+        self.jobs[job.job_id] = job
+        # The new job's deadline may be sooner than anything we were waiting
+        # for
+        self._wake.set()
+
+    def remove(self, job_id):
+        """
+        Stop watching a job, e.g. because it has exited.
+        """
+        self.jobs.pop(job_id, None)
+
+    @property
+    def reporter(self):
+        if self._reporter is None and teuth_config.results_server:
+            self._reporter = report.ResultsReporter()
+        return self._reporter
+
+    def heartbeat(self):
+        """
+        Push a heartbeat for every watched job.
+        """
+        self.last_heartbeat = time.time()
+        if not self.jobs or self.reporter is None:
+            return
+        job_infos = [job.job_info for job in self.jobs.values()]
+        log.debug("Pushing heartbeats for %d jobs", len(job_infos))
+        self.reporter.report_heartbeats(job_infos)
+
+    def expire(self, now=None):
+        """
+        Kill every job that has passed its deadline. A kill that fails is
+        retried after another interval.
+
+        :returns: The ids of the jobs we tried to kill.
+        """
+        if now is None:
+            now = time.time()
+        expired = [job for job in self.jobs.values()
+                   if job.deadline is not None and job.deadline <= now]
+        for job in expired:
+            log.warning("Job {job_id} ran longer than {max}s. "
+                        "Killing...".format(job_id=job.job_id,
+                                            max=self.max_job_time))
+            try:
+                kill_job(job.name, job.job_id, teuth_config.archive_base)
+            except Exception:
+                log.exception("Failed to kill job %s; retrying in %ss",
+                              job.job_id, self.interval)
+                job.deadline = now + self.interval
+            else:
+                # The job stays watched until it actually exits
+                job.deadline = None
+        return [job.job_id for job in expired]
+
+    def next_wakeup(self, now=None):
+        """
+        How many seconds until the next heartbeat or deadline is due.
+        """
+        if now is None:
+            now = time.time()
+        wakeups = [self.last_heartbeat + self.interval]
+        wakeups.extend(job.deadline for job in self.jobs.values()
+                       if job.deadline is not None)
+        return max(min(wakeups) - now, 0)
+
+    def poll(self):
+        """
+        Kill any expired jobs, and push heartbeats if they are due.
+        """
+        now = time.time()
+        self.expire(now)
+        if now >= self.last_heartbeat + self.interval:
+            self.heartbeat()
+
+    def _watch_forever(self):
+        while True:
+            self._wake.wait(timeout=self.next_wakeup())
+            self._wake.clear()
+            self.poll()
+
+    def start(self):
+        """
+        Start watching in a background greenlet. Does nothing if it is
+        already running.
+        """
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._watch_forever)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
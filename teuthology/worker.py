@@ -17,6 +17,7 @@ from .exceptions import BranchNotFoundError
 from .kill import kill_job
 from .misc import read_config
 from .repo_utils import fetch_qa_suite, fetch_teuthology
+from .watchdog import Watchdog
 
 log = logging.getLogger(__name__)
 start_time = datetime.utcnow()
@@ -77,11 +78,17 @@ def main(ctx):
 
     connection = beanstalk.connect()
     beanstalk.watch_tube(connection, ctx.tube)
-    result_proc = None
 
     #fetch_teuthology('master')
     #fetch_qa_suite('master')
 
+    slots = getattr(ctx, 'slots', None) or 1
+    if slots > 1:
+        run_slots(ctx, connection, log_file_path, slots)
+        return
+
+    result_proc = None
+
     while True:
         # Check to see if we have a teuthology-results process hanging around
         # and if so, read its return code so that it can exit.
@@ -97,75 +104,232 @@ def main(ctx):
         if job is None:
             continue
 
-        # bury the job so it won't be re-run if it fails
-        job.bury()
-        log.info('Reserved job %d', job.jid)
-        log.info('Config is: %s', job.body)
-        job_config = yaml.safe_load(job.body)
+        prepared = prep_job(ctx, job, log_file_path)
+        if prepared is None:
+            continue
+        job_config, teuth_bin_path = prepared
+
+        if job_config.get('last_in_suite'):
+            result_proc = run_results(ctx, job_config, teuth_bin_path)
+        else:
+            log.info('Running job %d', job.jid)
+            run_job(job_config, teuth_bin_path)
+        job.delete()
+
 
-        job_config['job_id'] = str(job.jid)
-        safe_archive = safepath.munge(job_config['name'])
-        job_config['worker_log'] = log_file_path
-        archive_path_full = os.path.join(
-            ctx.archive_dir, safe_archive, str(job.jid))
-        job_config['archive_path'] = archive_path_full
+def prep_job(ctx, job, log_file_path):
+    """
+    Bury a freshly-reserved job and build its job_config.
 
-        # If the teuthology branch was not specified, default to master and
-        # store that value.
-        teuthology_branch = job_config.get('teuthology_branch', 'master')
-        job_config['teuthology_branch'] = teuthology_branch
+    :returns: A (job_config, teuth_bin_path) tuple, or None if the job could
+              not be prepared and was marked dead.
+    """
+    # bury the job so it won't be re-run if it fails
+    job.bury()
+    log.info('Reserved job %d', job.jid)
+    log.info('Config is: %s', job.body)
+    job_config = yaml.safe_load(job.body)
+
+    job_config['job_id'] = str(job.jid)
+    safe_archive = safepath.munge(job_config['name'])
+    job_config['worker_log'] = log_file_path
+    archive_path_full = os.path.join(
+        ctx.archive_dir, safe_archive, str(job.jid))
+    job_config['archive_path'] = archive_path_full
+
+    # If the teuthology branch was not specified, default to master and
+    # store that value.
+    teuthology_branch = job_config.get('teuthology_branch', 'master')
+    job_config['teuthology_branch'] = teuthology_branch
 
-        try:
-            #teuth_path = fetch_teuthology(branch=teuthology_branch)
-            teuth_path = '/home/ubuntu/src/teuthology_master'
-            # For the teuthology tasks, we look for suite_branch, and if we
-            # don't get that, we look for branch, and fall back to 'master'.
-            # last-in-suite jobs don't have suite_branch or branch set.
-            ceph_branch = job_config.get('branch', 'master')
-            suite_branch = job_config.get('suite_branch', ceph_branch)
-            #job_config['suite_path'] = fetch_qa_suite(suite_branch)
-            job_config['suite_path'] = '/home/ubuntu/src/ceph-qa-suite_master'
-        except BranchNotFoundError as exc:
-            log.exception("Branch not found; marking job as dead")
-            report.try_push_job_info(
-                job_config,
-                dict(status='dead', failure_reason=str(exc))
-            )
+    try:
+        #teuth_path = fetch_teuthology(branch=teuthology_branch)
+        teuth_path = '/home/ubuntu/src/teuthology_master'
+        # For the teuthology tasks, we look for suite_branch, and if we
+        # don't get that, we look for branch, and fall back to 'master'.
+        # last-in-suite jobs don't have suite_branch or branch set.
+        ceph_branch = job_config.get('branch', 'master')
+        suite_branch = job_config.get('suite_branch', ceph_branch)
+        #job_config['suite_path'] = fetch_qa_suite(suite_branch)
+        job_config['suite_path'] = '/home/ubuntu/src/ceph-qa-suite_master'
+    except BranchNotFoundError as exc:
+        log.exception("Branch not found; marking job as dead")
+        report.try_push_job_info(
+            job_config,
+            dict(status='dead', failure_reason=str(exc))
+        )
+        return None
+
+    teuth_bin_path = os.path.join(teuth_path, 'virtualenv', 'bin')
+    if not os.path.isdir(teuth_bin_path):
+        raise RuntimeError("teuthology branch %s at %s not bootstrapped!" %
+                           (teuthology_branch, teuth_bin_path))
+
+    if not job_config.get('last_in_suite'):
+        log.info('Creating archive dir %s', archive_path_full)
+        safepath.makedirs(ctx.archive_dir, safe_archive)
+    return job_config, teuth_bin_path
+
+
+def run_results(ctx, job_config, teuth_bin_path):
+    """
+    Start teuthology-results for a last-in-suite job and return its Popen
+    object.
+    """
+    if teuth_config.results_server:
+        report.try_delete_jobs(job_config['name'],
+                               job_config['job_id'])
+    log.info('Generating results email for %s', job_config['name'])
+    args = [
+        os.path.join(teuth_bin_path, 'teuthology-results'),
+        '--timeout',
+        str(job_config.get('results_timeout',
+                           teuth_config.results_timeout)),
+        '--email',
+        job_config['email'],
+        '--archive-dir',
+        os.path.join(ctx.archive_dir, safepath.munge(job_config['name'])),
+        '--name',
+        job_config['name'],
+    ]
+    # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
+    # make sure that it will continue to run if this worker process
+    # dies (e.g. because of a restart)
+    result_proc = subprocess.Popen(args=args, preexec_fn=os.setpgrp)
+    log.info("teuthology-results PID: %s", result_proc.pid)
+    return result_proc
+
+
+def run_slots(ctx, connection, log_file_path, slots):
+    """
+    Run up to ``slots`` jobs at once, supervising all of them from this
+    process.
+
+    Jobs are reserved over the single beanstalk connection whenever a slot is
+    free, and one watchdog loop takes care of every running child. When a
+    restart is requested we stop reserving new jobs and restart once the
+    running ones have finished.
+    """
+    supervisor = JobSupervisor(slots)
+    result_procs = []
+    draining = False
+
+    while True:
+        for proc in result_procs[:]:
+            if proc.poll() is not None:
+                log.debug("teuthology-results exited with code: %s",
+                          proc.returncode)
+                result_procs.remove(proc)
+
+        supervisor.poll()
+
+        if not draining and need_restart():
+            log.info('Restart requested; waiting for %d running job(s)',
+                     len(supervisor))
+            draining = True
+        if draining:
+            if not supervisor:
+                restart()
+            time.sleep(supervisor.poll_interval)
+            continue
+
+        if not supervisor.free():
+            time.sleep(supervisor.poll_interval)
             continue
 
-        teuth_bin_path = os.path.join(teuth_path, 'virtualenv', 'bin')
-        if not os.path.isdir(teuth_bin_path):
-            raise RuntimeError("teuthology branch %s at %s not bootstrapped!" %
-                               (teuthology_branch, teuth_bin_path))
+        job = connection.reserve(timeout=supervisor.poll_interval)
+        if job is None:
+            continue
+
+        prepared = prep_job(ctx, job, log_file_path)
+        if prepared is None:
+            continue
+        job_config, teuth_bin_path = prepared
 
         if job_config.get('last_in_suite'):
-            if teuth_config.results_server:
-                report.try_delete_jobs(job_config['name'],
-                                       job_config['job_id'])
-            log.info('Generating results email for %s', job_config['name'])
-            args = [
-                os.path.join(teuth_bin_path, 'teuthology-results'),
-                '--timeout',
-                str(job_config.get('results_timeout',
-                                   teuth_config.results_timeout)),
-                '--email',
-                job_config['email'],
-                '--archive-dir',
-                os.path.join(ctx.archive_dir, safe_archive),
-                '--name',
-                job_config['name'],
-            ]
-            # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
-            # make sure that it will continue to run if this worker process
-            # dies (e.g. because of a restart)
-            result_proc = subprocess.Popen(args=args, preexec_fn=os.setpgrp)
-            log.info("teuthology-results PID: %s", result_proc.pid)
+            result_procs.append(run_results(ctx, job_config, teuth_bin_path))
+            job.delete()
         else:
-            log.info('Creating archive dir %s', archive_path_full)
-            safepath.makedirs(ctx.archive_dir, safe_archive)
             log.info('Running job %d', job.jid)
-            run_job(job_config, teuth_bin_path)
-        job.delete()
+            supervisor.start(job, job_config, teuth_bin_path)
+
+
+class RunningJob(object):
+    """
+    A child teuthology process started by a :class:`JobSupervisor`.
+    """
+    def __init__(self, job, job_config, process, config_file):
+        self.job = job
+        self.job_config = job_config
+        self.process = process
+        self.config_file = config_file
+        self.start_time = time.time()
+        self.symlinked = False
+
+
+class JobSupervisor(object):
+    """
+    Keep track of up to ``slots`` concurrently-running jobs and watch over
+    them: symlink the worker log into each archive and report each job once
+    it exits. Heartbeats and max_job_time are handled by one
+    :class:`teuthology.watchdog.Watchdog` shared by all of the jobs.
+    """
+    poll_interval = 5
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.jobs = []
+        self.watchdog = Watchdog()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def free(self):
+        return self.slots - len(self.jobs)
+
+    def start(self, job, job_config, teuth_bin_path):
+        process, config_file = start_job(job_config, teuth_bin_path)
+        running = RunningJob(job, job_config, process, config_file)
+        self.jobs.append(running)
+        self.watchdog.add(job_config, start_time=running.start_time)
+        self.watchdog.start()
+
+    def poll(self):
+        """
+        Reap the jobs that have finished, and symlink the worker log into
+        the archives of the ones that have been running a while.
+        """
+        for running in self.jobs[:]:
+            if running.process.poll() is None:
+                self.watch(running)
+            else:
+                self.finish(running)
+
+    def watch(self, running):
+        # Give the child watchdog_interval to create its archive dir
+        if running.symlinked or \
+                time.time() - running.start_time < self.watchdog.interval:
+            return
+        symlink_worker_log(running.job_config['worker_log'],
+                           running.job_config['archive_path'])
+        running.symlinked = True
+
+    def finish(self, running):
+        self.jobs.remove(running)
+        job_config = running.job_config
+        self.watchdog.remove(job_config['job_id'])
+        running.config_file.close()
+        if not running.symlinked:
+            symlink_worker_log(job_config['worker_log'],
+                               job_config['archive_path'])
+        if teuth_config.results_server:
+            report_finished_job(job_config)
+        if running.process.returncode != 0:
+            log.error('Job %s exited with code %d', job_config['job_id'],
+                      running.process.returncode)
+        else:
+            log.info('Job %s succeeded', job_config['job_id'])
+        running.job.delete()
 
 
 def run_with_watchdog(process, job_config):
@@ -196,6 +360,14 @@ def run_with_watchdog(process, job_config):
         time.sleep(teuth_config.watchdog_interval)
 
     # The job finished. Let's make sure paddles knows.
+    report_finished_job(job_config)
+
+
+def report_finished_job(job_config):
+    job_info = dict(
+        name=job_config['name'],
+        job_id=job_config['job_id'],
+    )
     branches_sans_reporting = ('argonaut', 'bobtail', 'cuttlefish', 'dumpling')
     if job_config.get('teuthology_branch') in branches_sans_reporting:
         # The job ran with a teuthology branch that may not have the reporting
@@ -224,8 +396,11 @@ def run_with_watchdog(process, job_config):
         report.try_push_job_info(job_info, dict(status='dead'))
 
 
-def run_job(job_config, teuth_bin_path):
-    suite_path = job_config['suite_path']
+def job_args(job_config, teuth_bin_path):
+    """
+    Build the teuthology command line for a job, minus the path to its
+    config file.
+    """
     arg = [
         os.path.join(teuth_bin_path, 'teuthology'),
     ]
@@ -253,20 +428,39 @@ def run_job(job_config, teuth_bin_path):
     if job_config['description'] is not None:
         arg.extend(['--description', job_config['description']])
     arg.append('--')
+    return arg
+
 
-    with tempfile.NamedTemporaryFile(prefix='teuthology-worker.',
-                                     suffix='.tmp',) as tmp:
-        yaml.safe_dump(data=job_config, stream=tmp)
-        tmp.flush()
-        arg.append(tmp.name)
-        env = os.environ.copy()
-        python_path = env.get('PYTHONPATH', '')
-        python_path = ':'.join([suite_path, python_path]).strip(':')
-        env['PYTHONPATH'] = python_path
-        p = subprocess.Popen(args=arg, env=env)
-        log.info("Job archive: %s", job_config['archive_path'])
-        log.info("Job PID: %s", str(p.pid))
+def job_env(job_config):
+    env = os.environ.copy()
+    python_path = env.get('PYTHONPATH', '')
+    python_path = ':'.join([job_config['suite_path'], python_path]).strip(':')
+    env['PYTHONPATH'] = python_path
+    return env
 
+
+def start_job(job_config, teuth_bin_path):
+    """
+    Start a job without waiting for it.
+
+    :returns: A (process, config_file) tuple. The caller must close
+              config_file, which deletes it, once the job has exited.
+    """
+    arg = job_args(job_config, teuth_bin_path)
+    tmp = tempfile.NamedTemporaryFile(prefix='teuthology-worker.',
+                                      suffix='.tmp',)
+    yaml.safe_dump(data=job_config, stream=tmp)
+    tmp.flush()
+    arg.append(tmp.name)
+    p = subprocess.Popen(args=arg, env=job_env(job_config))
+    log.info("Job archive: %s", job_config['archive_path'])
+    log.info("Job PID: %s", str(p.pid))
+    return p, tmp
+
+
+def run_job(job_config, teuth_bin_path):
+    p, tmp = start_job(job_config, teuth_bin_path)
+    with tmp:
         if teuth_config.results_server:
             log.info("Running with watchdog")
             try: